@@ -0,0 +1,300 @@
+import json
+import logging
+import platform
+import shutil
+import tempfile
+import time
+import traceback
+
+from datetime import date, datetime
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from io import StringIO
+from pathlib import Path
+
+from fmrif_archive.management.commands.parse_gold_data import FMRIF_SCANNERS, PARSER_VERSION
+from fmrif_archive.management.utils.archive_discovery import walk_gold_archives
+from fmrif_archive.management.utils.parser_utils import (
+    get_archive_checksums,
+    parse_metadata,
+    uncompress_tgz_files,
+)
+from fmrif_archive.management.utils.synthetic_gold import make_synthetic_gold_tree
+from fmrif_archive.management.utils.worker_pool import ParserWorkerPool
+
+
+LOADER_COMMANDS = [
+    'load_parsed_studies',
+    'load_parsed_instances',
+    'load_scan_dicom_metadata',
+    'load_parsed_scans_mongo',
+]
+
+
+def _tree_size(path):
+    return sum(f.stat().st_size for f in Path(path).glob("**/*") if f.is_file())
+
+
+def _rates(elapsed, num_exams, num_bytes):
+    return {
+        'seconds': round(elapsed, 4),
+        'exams_per_sec': round(num_exams / elapsed, 3) if elapsed else None,
+        'mb_per_sec': round(num_bytes / elapsed / 1e6, 3) if elapsed else None,
+    }
+
+
+class Command(BaseCommand):
+
+    help = "Generate a synthetic Gold archive tree and time the ingest stages, parse_gold_data and the loaders"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            "--bench_dir",
+            help="Directory in which to write the synthetic Gold tree and parsed outputs. Defaults to a "
+                 "temporary directory that is removed at the end of the run.",
+            default=None
+        )
+
+        parser.add_argument(
+            "--output",
+            help="Path of the JSON file to write the benchmark results to",
+            default="ingest_benchmark_{}.json".format(datetime.today().strftime("%Y%m%d_%H%M%S"))
+        )
+
+        parser.add_argument(
+            "--scanners",
+            default=['fmrif3ta', 'fmrif3tc'],
+            help="Scanners to generate archives for. Scanners fmrif3tc and fmrif3td get GE archives, "
+                 "the others Siemens archives.",
+            choices=FMRIF_SCANNERS,
+            nargs="*"
+        )
+
+        parser.add_argument("--days", type=int, default=2, help="Number of exam days per scanner")
+
+        parser.add_argument("--exams_per_day", type=int, default=2)
+
+        parser.add_argument("--scans_per_exam", type=int, default=4)
+
+        parser.add_argument("--slices", type=int, default=16, help="Number of slices per scan")
+
+        parser.add_argument("--echoes", type=int, default=3, help="Number of echoes of the multiecho scans")
+
+        parser.add_argument("--matrix", type=int, default=64, help="Rows and columns of the images")
+
+        parser.add_argument("--seed", type=int, default=0)
+
+        parser.add_argument(
+            "--reuse_tree",
+            help="Reuse the synthetic Gold tree already in --bench_dir instead of generating a new one",
+            action='store_true',
+        )
+
+        parser.add_argument("--tgz_cores", type=int, default=6)
+
+        parser.add_argument("--parse_cores", type=int, default=8)
+
+        parser.add_argument("--checksum_cores", type=int, default=4)
+
+        parser.add_argument(
+            "--parser_options",
+            help="Extra parse_gold_data flags to benchmark, e.g. --parser_options stream targeted_reads",
+            nargs="*",
+            default=[],
+        )
+
+        parser.add_argument(
+            "--skip_loaders",
+            help="Do not run the loader commands (they need the SQL and Mongo databases)",
+            action='store_true',
+        )
+
+    def handle(self, *args, **options):
+
+        bench_dir = Path(options['bench_dir']) if options['bench_dir'] else Path(tempfile.mkdtemp(prefix="osmium_"))
+
+        data_dir = bench_dir / "gold"
+        scanners = options['scanners']
+
+        # Silence the per-file logging of the parsing utilities while they are being timed
+        bench_log = logging.getLogger('benchmark')
+        bench_log.addHandler(logging.NullHandler())
+        bench_log.propagate = False
+
+        results = {
+            'started': datetime.now().isoformat(),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'parser_version': PARSER_VERSION,
+            'options': {k: v for k, v in options.items() if k in (
+                'scanners', 'days', 'exams_per_day', 'scans_per_exam', 'slices', 'echoes', 'matrix', 'seed',
+                'tgz_cores', 'parse_cores', 'checksum_cores', 'parser_options',
+            )},
+            'stages': {},
+            'commands': {},
+        }
+
+        try:
+
+            if not options['reuse_tree']:
+
+                if data_dir.is_dir():
+                    shutil.rmtree(str(data_dir))
+
+                self.stdout.write("Generating synthetic Gold tree in {}...".format(data_dir))
+
+                start = time.perf_counter()
+
+                make_synthetic_gold_tree(
+                    data_dir,
+                    scanners,
+                    start_date=date(2019, 1, 1),
+                    num_days=options['days'],
+                    exams_per_day=options['exams_per_day'],
+                    scans_per_exam=options['scans_per_exam'],
+                    num_slices=options['slices'],
+                    num_echoes=options['echoes'],
+                    matrix=options['matrix'],
+                    seed=options['seed']
+                )
+
+                results['generate_seconds'] = round(time.perf_counter() - start, 4)
+
+            archives = sorted(data_dir.glob("*/*/*/*/*/*.tgz"))
+
+            if not archives:
+                raise CommandError("No archives found in {}".format(data_dir))
+
+            num_exams = len(archives)
+            num_bytes = sum(a.stat().st_size for a in archives)
+
+            results['tree'] = {
+                'archives': num_exams,
+                'compressed_bytes': num_bytes,
+            }
+
+            self.stdout.write("Benchmarking on {} archives ({:.1f} MB)".format(num_exams, num_bytes / 1e6))
+
+            self.time_stages(results, data_dir, scanners, bench_dir / "stages", num_exams, num_bytes, options,
+                             bench_log)
+
+            results['tree']['uncompressed_bytes'] = results['stages']['extraction'].pop('extracted_bytes')
+
+            work_dir = bench_dir / "parsed"
+
+            self.time_parse_gold_data(results, data_dir, scanners, work_dir, num_exams, num_bytes, options)
+
+            if not options['skip_loaders']:
+                for loader in LOADER_COMMANDS:
+                    self.time_loader(results, loader, work_dir, num_exams, num_bytes)
+
+        finally:
+
+            if not options['bench_dir']:
+                shutil.rmtree(str(bench_dir), ignore_errors=True)
+
+        with open(options['output'], "wt") as outfile:
+            json.dump(results, outfile, indent=4)
+
+        self.stdout.write("Benchmark results written to {}".format(options['output']))
+
+    def time_stages(self, results, data_dir, scanners, work_dir, num_exams, num_bytes, options, log):
+        """Times each ingest stage on its own by calling the parsing utilities directly"""
+
+        if work_dir.is_dir():
+            shutil.rmtree(str(work_dir))
+
+        work_dir.mkdir(parents=True)
+
+        self.stdout.write("Timing discovery...")
+
+        start = time.perf_counter()
+        candidate_files = list(walk_gold_archives(data_dir, scanners))
+        results['stages']['discovery'] = _rates(time.perf_counter() - start, num_exams, num_bytes)
+
+        self.stdout.write("Timing archive hashing...")
+
+        start = time.perf_counter()
+        compressed_files = sorted(get_archive_checksums(candidate_files, num_workers=options['checksum_cores']),
+                                  key=lambda f: str(f[0]))
+        results['stages']['hashing'] = _rates(time.perf_counter() - start, num_exams, num_bytes)
+
+        self.stdout.write("Timing extraction...")
+
+        start = time.perf_counter()
+        extracted_archives, _ = uncompress_tgz_files(compressed_files, {'work_dir': work_dir,
+                                                                        'tgz_cores': options['tgz_cores']})
+        results['stages']['extraction'] = _rates(time.perf_counter() - start, num_exams, num_bytes)
+
+        extracted_bytes = _tree_size(work_dir)
+        results['stages']['extraction']['extracted_bytes'] = extracted_bytes
+
+        self.stdout.write("Timing header parsing...")
+
+        with ParserWorkerPool(num_workers=options['parse_cores'], log=log) as pool:
+
+            start = time.perf_counter()
+            parse_metadata(extracted_archives, parser_version=PARSER_VERSION, log=log, pool=pool,
+                           targeted_reads='targeted_reads' in options['parser_options'],
+                           instance_headers='instance_headers' in options['parser_options'],
+                           instance_columns='instance_columns' in options['parser_options'],
+                           csa_whitelist='csa_whitelist' in options['parser_options'])
+            elapsed = time.perf_counter() - start
+
+        # Parsing reads the extracted files, so its byte rate is given over the uncompressed size
+        results['stages']['parsing'] = _rates(elapsed, num_exams, extracted_bytes)
+
+        shutil.rmtree(str(work_dir))
+
+    def time_parse_gold_data(self, results, data_dir, scanners, work_dir, num_exams, num_bytes, options):
+
+        self.stdout.write("Timing parse_gold_data...")
+
+        if work_dir.is_dir():
+            shutil.rmtree(str(work_dir))
+
+        cmd_options = {
+            'data_dir': str(data_dir),
+            'work_dir': str(work_dir),
+            'scanners': scanners,
+            'from': "01012019",
+            'tgz_cores': options['tgz_cores'],
+            'parse_cores': options['parse_cores'],
+            'checksum_cores': options['checksum_cores'],
+        }
+
+        for flag in options['parser_options']:
+            cmd_options[flag] = True
+
+        start = time.perf_counter()
+        call_command('parse_gold_data', **cmd_options)
+        results['commands']['parse_gold_data'] = _rates(time.perf_counter() - start, num_exams, num_bytes)
+
+        # Include the per-stage summaries of the run report of parse_gold_data
+        stages = {}
+
+        for report in work_dir.glob("gold_parsing_*_report.jsonl"):
+            with open(str(report), "rt") as infile:
+                for line in infile:
+                    record = json.loads(line)
+                    if record['type'] == 'stage':
+                        stages[record.pop('stage')] = record
+
+        results['commands']['parse_gold_data']['stages'] = stages
+
+    def time_loader(self, results, loader, work_dir, num_exams, num_bytes):
+
+        self.stdout.write("Timing {}...".format(loader))
+
+        start = time.perf_counter()
+
+        try:
+            call_command(loader, data=str(work_dir), stdout=StringIO())
+        except Exception as e:
+            self.stdout.write("Error: {} failed: {}".format(loader, e))
+            self.stdout.write(traceback.format_exc())
+            results['commands'][loader] = {'error': str(e)}
+            return
+
+        results['commands'][loader] = _rates(time.perf_counter() - start, num_exams, num_bytes)
@@ -0,0 +1,194 @@
+import pydicom
+import random
+import rapidjson as json
+import shutil
+import tarfile
+import tempfile
+import time
+
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from io import BytesIO
+from pathlib import Path
+from pydicom.errors import InvalidDicomError
+
+from fmrif_archive.management.utils.dicom_json import encode_dataset
+from fmrif_archive.management.utils.parser_utils import parse_dicom_dataset
+from fmrif_archive.management.utils.synthetic_gold import SYNTHETIC_MANUFACTURERS, make_synthetic_archive
+
+
+def _read_dataset(fp):
+    try:
+        return pydicom.dcmread(fp, stop_before_pixels=True)
+    except (InvalidDicomError, EOFError, OSError):
+        return None
+
+
+def iter_corpus(corpus_dir):
+    """Yields (name, dataset) for the DICOM files under a directory, including the files inside TGZ archives"""
+
+    for fpath in sorted(Path(corpus_dir).glob("**/*")):
+
+        if not fpath.is_file():
+            continue
+
+        if fpath.name.endswith((".tgz", ".tar.gz")):
+
+            with tarfile.open(str(fpath), "r:gz") as tar:
+                for member in tar:
+                    if member.isfile():
+                        ds = _read_dataset(BytesIO(tar.extractfile(member).read()))
+                        if ds is not None:
+                            yield "{}/{}".format(fpath.relative_to(corpus_dir), member.name), ds
+
+        else:
+
+            ds = _read_dataset(str(fpath))
+
+            if ds is not None:
+                yield str(fpath.relative_to(corpus_dir)), ds
+
+
+def _golden_path(golden_dir, name):
+    return Path(golden_dir) / "{}.json".format(name.replace("/", "__"))
+
+
+class Command(BaseCommand):
+
+    help = "Check that the DICOM to JSON encoder produces the same JSON as the reference encoder, " \
+           "and time both"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            "--corpus",
+            help="Directory of DICOM files and/or TGZ archives to encode. Defaults to a synthetic corpus with "
+                 "one archive per scanner type.",
+            default=None
+        )
+
+        parser.add_argument(
+            "--golden_dir",
+            help="Directory of golden JSON outputs of the reference encoder, one per corpus file. The output "
+                 "of the encoder is checked against these instead of the reference encoder's.",
+            default=None
+        )
+
+        parser.add_argument(
+            "--write_golden",
+            help="Write the outputs of the reference encoder to --golden_dir instead of checking them",
+            action='store_true',
+        )
+
+        parser.add_argument(
+            "--iterations",
+            help="Number of times to encode the corpus with each encoder when timing them",
+            type=int,
+            default=20
+        )
+
+        parser.add_argument("--output", help="Path of a JSON file to write the results to", default=None)
+
+    def handle(self, *args, **options):
+
+        if options['write_golden'] and not options['golden_dir']:
+            raise CommandError("--write_golden requires --golden_dir")
+
+        tmp_dir = None
+
+        try:
+
+            if options['corpus']:
+                corpus_dir = Path(options['corpus'])
+            else:
+                tmp_dir = Path(tempfile.mkdtemp(prefix="dicom_json_"))
+                corpus_dir = tmp_dir
+                for scanner in SYNTHETIC_MANUFACTURERS:
+                    make_synthetic_archive(corpus_dir / "{}.tgz".format(scanner), scanner, date(2019, 1, 1), 0,
+                                           scans_per_exam=2, num_slices=4, num_echoes=2, matrix=16,
+                                           rng=random.Random(scanner))
+
+            corpus = list(iter_corpus(corpus_dir))
+
+        finally:
+
+            if tmp_dir:
+                shutil.rmtree(str(tmp_dir), ignore_errors=True)
+
+        if not corpus:
+            raise CommandError("No DICOM files found in {}".format(corpus_dir))
+
+        self.stdout.write("Checking {} DICOM files...".format(len(corpus)))
+
+        results = {
+            'files': len(corpus),
+            'mismatches': [],
+        }
+
+        if options['golden_dir']:
+            Path(options['golden_dir']).mkdir(parents=True, exist_ok=True)
+
+        for name, ds in corpus:
+
+            encoded = json.dumps(encode_dataset(ds))
+
+            if options['golden_dir']:
+
+                golden_path = _golden_path(options['golden_dir'], name)
+
+                if options['write_golden']:
+                    with open(str(golden_path), "wt") as outfile:
+                        outfile.write(json.dumps(parse_dicom_dataset(ds)))
+                    continue
+
+                if not golden_path.is_file():
+                    raise CommandError("No golden output for {} in {}".format(name, options['golden_dir']))
+
+                with open(str(golden_path), "rt") as infile:
+                    expected = infile.read()
+
+            else:
+
+                expected = json.dumps(parse_dicom_dataset(ds))
+
+            if encoded != expected:
+                results['mismatches'].append(name)
+                self.stdout.write("Error: JSON of {} differs from the reference encoder's".format(name))
+
+        if options['write_golden']:
+            self.stdout.write("Golden outputs written to {}".format(options['golden_dir']))
+            return
+
+        datasets = [ds for _, ds in corpus]
+
+        for label, encoder in (('reference', parse_dicom_dataset), ('encoder', encode_dataset)):
+
+            start = time.perf_counter()
+
+            for _ in range(options['iterations']):
+                for ds in datasets:
+                    json.dumps(encoder(ds))
+
+            elapsed = time.perf_counter() - start
+
+            results[label] = {
+                'seconds': round(elapsed, 4),
+                'files_per_sec': round(options['iterations'] * len(datasets) / elapsed, 1) if elapsed else None,
+            }
+
+            self.stdout.write("{}: {:.3f}s for {} encodings ({} files/s)".format(
+                label, elapsed, options['iterations'] * len(datasets), results[label]['files_per_sec']))
+
+        if results['encoder']['seconds']:
+            results['speedup'] = round(results['reference']['seconds'] / results['encoder']['seconds'], 2)
+            self.stdout.write("Speedup: {}x".format(results['speedup']))
+
+        if options['output']:
+            with open(options['output'], "wt") as outfile:
+                json.dump(results, outfile, indent=4)
+
+        if results['mismatches']:
+            raise CommandError("{} of {} files differ from the reference encoder's output".format(
+                len(results['mismatches']), len(corpus)))
+
+        self.stdout.write("All {} files match the reference encoder's output".format(len(corpus)))
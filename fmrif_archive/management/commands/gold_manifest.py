@@ -0,0 +1,182 @@
+from django.conf import settings as django_settings
+from django.core.management.base import BaseCommand, CommandError
+from pathlib import Path
+
+from fmrif_archive.management.commands.parse_gold_data import FMRIF_SCANNERS
+from fmrif_archive.management.utils.archive_discovery import walk_scanner_archives
+from fmrif_archive.management.utils.archive_manifest import ArchiveManifest, resolve_archive_checksums
+from fmrif_archive.management.utils.parser_utils import CHECKSUM_READ_SIZE, get_archive_checksums
+
+
+class Command(BaseCommand):
+
+    help = "Rebuild or verify the manifest of Gold archive checksums used by parse_gold_data --use_manifest"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            "--data_dir",
+            help="Path to the Gold archives directory",
+            default=django_settings.ARCHIVE_BASE_PATH
+        )
+
+        parser.add_argument(
+            "--manifest",
+            help="Path to the archive manifest database",
+            default=Path(django_settings.PARSED_DATA_PATH) / "gold_archive_manifest.db"
+        )
+
+        parser.add_argument(
+            "--scanners",
+            default=FMRIF_SCANNERS,
+            help="Scanners to consider.",
+            choices=FMRIF_SCANNERS,
+            nargs="*"
+        )
+
+        parser.add_argument(
+            "--checksum_cores",
+            help="Number of threads to use when computing checksums of TGZ files",
+            type=int,
+            default=4,
+        )
+
+        parser.add_argument(
+            "--checksum_read_size",
+            help="Size in bytes of the chunks read when computing checksums of TGZ files",
+            type=int,
+            default=CHECKSUM_READ_SIZE,
+        )
+
+        parser.add_argument(
+            "--rebuild",
+            help="Walk the Gold archives directory and add or refresh manifest entries. Archives whose "
+                 "stat signature is unchanged are not re-hashed unless --force is given.",
+            action='store_true',
+        )
+
+        parser.add_argument(
+            "--verify",
+            help="Re-hash every archive in the manifest and report entries that are missing or whose "
+                 "checksum no longer matches",
+            action='store_true',
+        )
+
+        parser.add_argument(
+            "--force",
+            help="With --rebuild, re-hash every archive even if its stat signature is unchanged",
+            action='store_true',
+        )
+
+        parser.add_argument(
+            "--prune",
+            help="Remove manifest entries for archives that no longer exist",
+            action='store_true',
+        )
+
+    def handle(self, *args, **options):
+
+        if not (options['rebuild'] or options['verify'] or options['prune']):
+            raise CommandError("Specify at least one of --rebuild, --verify or --prune")
+
+        data_dir = Path(options['data_dir'])
+
+        self.checksum_cores = options['checksum_cores']
+        self.checksum_read_size = options['checksum_read_size']
+
+        with ArchiveManifest(options['manifest']) as manifest:
+
+            if options['prune']:
+                self.prune(manifest, options['scanners'])
+
+            if options['rebuild']:
+                self.rebuild(manifest, data_dir, options['scanners'], options['force'])
+
+            if options['verify']:
+                self.verify(manifest, options['scanners'])
+
+    def prune(self, manifest, scanners):
+
+        num_removed = 0
+
+        for fpath, _, _ in manifest.entries(scanners=scanners):
+
+            if not fpath.is_file():
+                self.stdout.write("Removing missing archive {} from manifest".format(fpath))
+                manifest.remove(fpath)
+                num_removed += 1
+
+        manifest.commit()
+
+        self.stdout.write("Removed {} entries from manifest".format(num_removed))
+
+    def rebuild(self, manifest, data_dir, scanners, force):
+
+        num_archives = 0
+        num_errors = 0
+
+        for scanner in scanners:
+
+            scanner_dir = data_dir / scanner
+
+            if not scanner_dir.is_dir():
+                self.stdout.write("Error: Scanner directory {} does not exist".format(scanner_dir))
+                continue
+
+            self.stdout.write("Indexing archives in {}...".format(scanner_dir))
+
+            compressed_files = list(walk_scanner_archives(data_dir, scanner))
+
+            if force:
+                for compressed_file in compressed_files:
+                    manifest.remove(compressed_file)
+
+            for compressed_file, checksum, _ in resolve_archive_checksums(
+                    compressed_files,
+                    manifest=manifest,
+                    num_workers=self.checksum_cores,
+                    read_size=self.checksum_read_size
+            ):
+
+                if not checksum:
+                    self.stdout.write("Error: Unable to compute checksum for {}".format(compressed_file))
+                    num_errors += 1
+                    continue
+
+                num_archives += 1
+
+            manifest.commit()
+
+        self.stdout.write("Indexed {} archives ({} errors)".format(num_archives, num_errors))
+
+    def verify(self, manifest, scanners):
+
+        num_ok = 0
+        num_bad = 0
+
+        expected = {}
+
+        for fpath, md5, _ in manifest.entries(scanners=scanners):
+
+            if not fpath.is_file():
+                self.stdout.write("Error: Archive {} is missing".format(fpath))
+                num_bad += 1
+                continue
+
+            expected[fpath] = md5
+
+        for fpath, checksum, _ in get_archive_checksums(
+                list(expected.keys()),
+                num_workers=self.checksum_cores,
+                read_size=self.checksum_read_size
+        ):
+
+            if checksum != expected[fpath]:
+                self.stdout.write("Error: Checksum mismatch for {} (manifest: {}, "
+                                  "actual: {})".format(fpath, expected[fpath], checksum))
+                num_bad += 1
+                continue
+
+            num_ok += 1
+
+        self.stdout.write("Verified {} archives, {} missing or mismatched".format(num_ok, num_bad))
@@ -0,0 +1,53 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from pathlib import Path
+from fmrif_archive.management.utils.parsed_tree_index import ParsedTreeIndex
+
+
+class Command(BaseCommand):
+
+    help = "Index the study, scan metadata and checksum files of a directory of parsed data, for the load_* " \
+           "commands to look them up instead of walking the directory"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("--data", type=str, default=settings.PARSED_DATA_PATH)
+
+        parser.add_argument("--scanners", nargs="*", type=str, default=[])
+
+        parser.add_argument("--years", nargs="*", type=str, default=[])
+
+        parser.add_argument("--months", nargs="*", type=str, default=[])
+
+        parser.add_argument("--days", nargs="*", type=str, default=[])
+
+        parser.add_argument(
+            "--index",
+            help="Path to the index. Defaults to parsed_tree_index.db in --data.",
+            default=None
+        )
+
+        parser.add_argument(
+            "--full",
+            help="List every session directory again, rather than only the ones modified since they were "
+                 "indexed, e.g. after metadata files were rewritten in place",
+            action='store_true',
+        )
+
+    def handle(self, *args, **options):
+
+        parsed_data_path = Path(options['data'])
+
+        if not parsed_data_path.is_dir():
+            raise CommandError("Parsed data directory {} does not exist".format(parsed_data_path))
+
+        start = time.perf_counter()
+
+        with ParsedTreeIndex(parsed_data_path, db_path=options['index']) as index:
+            stats = index.refresh(scanners=options['scanners'], years=options['years'], months=options['months'],
+                                  days=options['days'], full=options['full'])
+
+        self.stdout.write("Indexed {} of {} sessions ({} files), removed {}, in {:.1f}s".format(
+            stats['indexed'], stats['sessions'], stats['files'], stats['removed'], time.perf_counter() - start))
@@ -4,6 +4,7 @@ import traceback
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.db import Error as DjangoDBError
+from django.db import connection, transaction
 from psycopg2 import Error as PgError
 from psycopg2 import Warning as PgWarning
 from pathlib import Path
@@ -14,6 +15,14 @@ from fmrif_archive.models import (
     FileCollection,
     File
 )
+from fmrif_archive.management.utils.instance_copy import (
+    clean_integer_field,
+    copy_dicom_instances,
+    copy_files,
+    ECHO_NUMBER_MAX,
+    SLICE_INDEX_MAX,
+)
+from fmrif_archive.management.utils.parsed_tree_index import add_index_arguments, open_parsed_tree_index
 
 
 def process_dicom_instances(parent_exam, instance_files):
@@ -53,43 +62,34 @@ def process_dicom_instances(parent_exam, instance_files):
             if "readme" not in filename.lower():
                 instances_data[filename]['metadata'] = json.loads(instance_meta)
 
+    # Instances of the scan already loaded, to skip
+    existing = set(DICOMInstance.objects.filter(parent_scan=curr_scan).values_list('filename', 'checksum'))
+
     new_dicom_instances = []
 
     for filename, data in instances_data.items():
 
+        if (filename, data['checksum']) in existing:
+            continue
+
         echo_number = None
         sop_instance_uid = None
         slice_index = None
         image_position_patient = None
+        header_delta = None
 
         if data['metadata']:
-            echo_number = data['metadata'].get('echo_number', None)
+            # Values that are not valid integers are stored as NULL, as the --copy loader does
+            echo_number = clean_integer_field(data['metadata'].get('echo_number', None), ECHO_NUMBER_MAX)
 
             sop_instance_uid = data['metadata'].get('sop_instance_uid', None)
 
-            slice_index = data['metadata'].get('raw_data_run_number', None)
+            slice_index = clean_integer_field(data['metadata'].get('raw_data_run_number', None), SLICE_INDEX_MAX)
 
             image_position_patient = data['metadata'].get('image_position_patient',
                                                           None)
-        
-        try:
 
-            inst = DICOMInstance.objects.filter(
-                parent_scan=curr_scan,
-                file_type='dicom',
-                filename=filename,
-                checksum=data['checksum'],
-                echo_number=echo_number,
-                sop_instance_uid=sop_instance_uid,
-                slice_index=slice_index,
-                image_position_patient=image_position_patient
-            )
-            
-            if inst:
-                continue
-        
-        except DICOMInstance.DoesNotExist:
-            pass
+            header_delta = data['metadata'].get('header_delta', None)
 
         new_dicom_instances.append(
             DICOMInstance(
@@ -100,7 +100,8 @@ def process_dicom_instances(parent_exam, instance_files):
                 echo_number=echo_number,
                 sop_instance_uid=sop_instance_uid,
                 slice_index=slice_index,
-                image_position_patient=image_position_patient
+                image_position_patient=image_position_patient,
+                header_delta=header_delta
             )
         )
 
@@ -130,24 +131,15 @@ def process_file_instances(parent_exam, checksum_file):
                     'checksum': checksum
                 }
 
+    # Files of the collection already loaded, to skip
+    existing = set(File.objects.filter(parent_collection=curr_subdir).values_list('filename', 'checksum'))
+
     new_file_instances = []
 
     for filename, data in subdir_data.items():
 
-        try:
-            
-            f = File.objects.filter(
-                parent_collection=curr_subdir,
-                file_type='other',
-                filename=filename,
-                checksum=data['checksum']
-            )
-
-            if f:
-                continue
-        
-        except File.DoesNotExist:
-            pass
+        if (filename, data['checksum']) in existing:
+            continue
 
         new_file_instances.append(
             File(
@@ -177,195 +169,230 @@ class Command(BaseCommand):
 
         parser.add_argument("--days", nargs="*", type=str, default=[])
 
-    def handle(self, *args, **options):
+        add_index_arguments(parser)
 
-        scanners = options['scanners']
-        years = options['years']
-        months = options['months']
-        days = options['days']
+        parser.add_argument(
+            "--copy",
+            help="Stream the checksum and metadata files of each exam into staging tables with COPY, and insert "
+                 "the new DICOMInstance and File rows from there, instead of creating them through the ORM. "
+                 "PostgreSQL only.",
+            action='store_true',
+        )
 
-        parsed_data_path = Path(options['data'])
+    def copy_instances(self, parent_exam, study_meta_file, dicom_instances, file_instances):
+        """Loads the DICOMInstance and File rows of an exam with copy_dicom_instances and copy_files, in one
+        transaction"""
 
-        if not scanners:
-            scanner_paths = [scanner_path for scanner_path in parsed_data_path.iterdir() if scanner_path.is_dir()]
-        else:
-            scanner_paths = [scanner_path for scanner_path in parsed_data_path.iterdir()
-                             if (scanner_path.is_dir() and scanner_path.name in scanners)]
+        scan_ids = dict(MRScan.objects.filter(parent_exam=parent_exam).values_list('name', 'id'))
+        collection_ids = dict(FileCollection.objects.filter(parent_exam=parent_exam).values_list('name', 'id'))
 
-        for scanner_path in sorted(scanner_paths):
+        scans = []
 
-            if not years:
-                year_paths = [year_path for year_path in scanner_path.iterdir() if year_path.is_dir()]
-            else:
-                year_paths = [year_path for year_path in scanner_path.iterdir()
-                              if (year_path.is_dir() and year_path.name in years)]
+        for checksum_file, metadata_file in dicom_instances:
 
-            for year_path in sorted(year_paths):
+            scan_name = checksum_file.name.replace("_checksum.txt", "").split("_scan_")[-1]
 
-                if not months:
-                    month_paths = [month_path for month_path in year_path.iterdir() if month_path.is_dir()]
-                else:
-                    month_paths = [month_path for month_path in year_path.iterdir()
-                                   if (month_path.is_dir() and month_path.name in months)]
+            if scan_name not in scan_ids:
+                self.stdout.write("Error opening MRScan model for metadata file {}".format(metadata_file))
+                continue
 
-                for month_path in sorted(month_paths):
+            scans.append((scan_ids[scan_name], checksum_file, metadata_file))
 
-                    if not days:
-                        day_paths = [day_path for day_path in month_path.iterdir() if day_path.is_dir()]
-                    else:
-                        day_paths = [day_path for day_path in month_path.iterdir()
-                                     if (day_path.is_dir() and day_path.name in days)]
+        collections = []
 
-                    for day_path in sorted(day_paths):
+        for checksum_file in file_instances:
 
-                        for exam_id in sorted([e for e in day_path.iterdir() if e.is_dir()]):
+            scan_name = checksum_file.name.replace("_checksum.txt", "").split("_scan_")[-1]
 
-                            for pt_dir in sorted([p for p in exam_id.iterdir() if p.is_dir()]):
+            if scan_name not in collection_ids:
+                self.stdout.write("Error opening FileCollection model for checksum file {}".format(checksum_file))
+                continue
+
+            collections.append((collection_ids[scan_name], checksum_file))
+
+        try:
 
-                                for session_dir in sorted([s for s in pt_dir.iterdir() if s.is_dir()]):
+            with transaction.atomic(), connection.cursor() as cursor:
 
-                                    study_metadata_files = list(session_dir.glob("study_*_metadata.txt"))
+                num_instances = copy_dicom_instances(cursor, scans) if scans else 0
+                num_files = copy_files(cursor, collections) if collections else 0
 
-                                    if not study_metadata_files:
-                                        self.stdout.write("Error: No study metadata found in {}".format(session_dir))
-                                        continue
+        except (DjangoDBError, PgError) as e:
 
-                                    if len(study_metadata_files) > 1:
-                                        self.stdout.write("Error: Multiple study metadata "
-                                                          "files for {} found".format(session_dir))
-                                        continue
+            self.stdout.write("Warning: Unable to copy DICOMInstance and File "
+                              "objects for exam {}".format(study_meta_file))
+            self.stdout.write(str(e))
+            self.stdout.write(traceback.format_exc())
 
-                                    study_meta_file = study_metadata_files[0]
+            return
+
+        self.stdout.write("Copied {} DICOMInstance and {} File objects "
+                          "for exam {}".format(num_instances, num_files, study_meta_file))
+
+    def handle(self, *args, **options):
 
-                                    if not study_meta_file.is_file():
-                                        self.stdout.write("Error: Cannot load file {}".format(study_meta_file))
-                                        continue
+        if options['copy'] and connection.vendor != 'postgresql':
+            raise CommandError("--copy requires a PostgreSQL database")
 
-                                    self.stdout.write("Loading instances for exam  {}".format(str(study_meta_file)))
+        parsed_data_path = Path(options['data'])
 
-                                    exam_id = study_meta_file.name.replace("study_", "").replace("_metadata.txt", "")
+        index = open_parsed_tree_index(parsed_data_path, options, stdout=self.stdout)
 
-                                    try:
+        sessions = index.sessions(scanners=options['scanners'], years=options['years'], months=options['months'],
+                                  days=options['days'])
 
-                                        parent_exam = Exam.objects.get(exam_id=exam_id)
+        for session in sessions:
 
-                                    except Exam.DoesNotExist:
-                                        self.stdout.write("Error: Cannot load Exam model for "
-                                                          "study {}".format(study_meta_file))
-                                        continue
+            session_dir = session['session_dir']
 
-                                    # Get checksum and metadata files for the current exam
-                                    metadata_files = list(session_dir.glob("*_scan_*_metadata.txt"))
-                                    checksum_files = list(session_dir.glob("*_scan_*_checksum.txt"))
+            study_metadata_files = session['study']
 
-                                    # Pair metadata files with corresponding checksum files, if there is a match
+            if not study_metadata_files:
+                self.stdout.write("Error: No study metadata found in {}".format(session_dir))
+                continue
 
-                                    dicom_instances = []
-                                    used_checksums = []
+            if len(study_metadata_files) > 1:
+                self.stdout.write("Error: Multiple study metadata "
+                                  "files for {} found".format(session_dir))
+                continue
 
-                                    for mf in metadata_files:
+            study_meta_file = study_metadata_files[0]
 
-                                        wanted_checksum = mf.name.replace("_metadata.txt", "_checksum.txt")
+            if not study_meta_file.is_file():
+                self.stdout.write("Error: Cannot load file {}".format(study_meta_file))
+                continue
 
-                                        matching_checksum = list(filter(lambda cf: cf.name == wanted_checksum,
-                                                                        checksum_files))
+            self.stdout.write("Loading instances for exam  {}".format(str(study_meta_file)))
 
-                                        if not matching_checksum:
-                                            self.stdout.write("Error: Cannot find matching checksum file for metadata"
-                                                              "file {} in study {}".format(mf, study_meta_file))
-                                            continue
+            exam_id = study_meta_file.name.replace("study_", "").replace("_metadata.txt", "")
 
-                                        if len(matching_checksum) > 1:
-                                            self.stdout.write("Error: More than one checksum file retrieved for "
-                                                              "metadata file {} in "
-                                                              "study {}".format(mf, study_meta_file))
-                                            continue
+            try:
 
-                                        used_checksums.append(matching_checksum[0])
-                                        dicom_instances.append((matching_checksum[0], mf))
+                parent_exam = Exam.objects.get(exam_id=exam_id)
 
-                                    # Get the remaining checksum files which dont match any metadata, to create
-                                    # File instances
-                                    non_dicom_checksums = list(filter(lambda cf: cf not in used_checksums,
-                                                                      checksum_files))
+            except Exam.DoesNotExist:
+                self.stdout.write("Error: Cannot load Exam model for "
+                                  "study {}".format(study_meta_file))
+                continue
 
-                                    file_instances = []
+            # Get checksum and metadata files for the current exam
+            metadata_files = session['scan_metadata']
+            checksum_files = session['scan_checksum']
 
-                                    for cf in non_dicom_checksums:
-                                        file_instances.append(cf)
+            # Pair metadata files with corresponding checksum files, if there is a match
 
-                                    if dicom_instances:
+            dicom_instances = []
+            used_checksums = []
 
-                                        dicom_instances_to_create = []
+            for mf in metadata_files:
 
-                                        for dicom_instance in dicom_instances:
+                wanted_checksum = mf.name.replace("_metadata.txt", "_checksum.txt")
 
-                                            result = process_dicom_instances(parent_exam, dicom_instance)
+                matching_checksum = list(filter(lambda cf: cf.name == wanted_checksum,
+                                                checksum_files))
 
-                                            if type(result) == str:
+                if not matching_checksum:
+                    self.stdout.write("Error: Cannot find matching checksum file for metadata"
+                                      "file {} in study {}".format(mf, study_meta_file))
+                    continue
 
-                                                self.stdout.write(result)
+                if len(matching_checksum) > 1:
+                    self.stdout.write("Error: More than one checksum file retrieved for "
+                                      "metadata file {} in "
+                                      "study {}".format(mf, study_meta_file))
+                    continue
 
-                                            else:
+                used_checksums.append(matching_checksum[0])
+                dicom_instances.append((matching_checksum[0], mf))
 
-                                                dicom_instances_to_create.extend(result)
+            # Get the remaining checksum files which dont match any metadata, to create
+            # File instances
+            non_dicom_checksums = list(filter(lambda cf: cf not in used_checksums,
+                                              checksum_files))
 
-                                        try:
+            file_instances = []
 
-                                            self.stdout.write("Writing DICOMInstance "
-                                                              "objects for exam {}".format(study_meta_file))
+            for cf in non_dicom_checksums:
+                file_instances.append(cf)
 
-                                            DICOMInstance.objects.bulk_create(dicom_instances_to_create)
+            if options['copy']:
+                self.copy_instances(parent_exam, study_meta_file, dicom_instances, file_instances)
+                continue
 
-                                        except (DjangoDBError, PgError) as e:
+            if dicom_instances:
 
-                                            self.stdout.write("Warning: Unable to write "
-                                                              "DICOMInstance objects for "
-                                                              "exam {}".format(study_meta_file))
-                                            self.stdout.write(e)
-                                            self.stdout.write(traceback.format_exc())
+                dicom_instances_to_create = []
 
-                                        except PgWarning as w:
+                for dicom_instance in dicom_instances:
 
-                                            self.stdout.write("Warning: Postgres warning creating "
-                                                              "DICOMInstance objects for "
-                                                              "exam {}".format(study_meta_file))
-                                            self.stdout.write(w)
-                                            self.stdout.write(traceback.format_exc())
+                    result = process_dicom_instances(parent_exam, dicom_instance)
 
-                                    if file_instances:
+                    if type(result) == str:
 
-                                        file_instances_to_create = []
+                        self.stdout.write(result)
 
-                                        for file_instance in file_instances:
+                    else:
 
-                                            result = process_file_instances(parent_exam, file_instance)
+                        dicom_instances_to_create.extend(result)
 
-                                            if type(result) == str:
+                try:
 
-                                                self.stdout.write(result)
+                    self.stdout.write("Writing DICOMInstance "
+                                      "objects for exam {}".format(study_meta_file))
+
+                    DICOMInstance.objects.bulk_create(dicom_instances_to_create, ignore_conflicts=True)
+
+                except (DjangoDBError, PgError) as e:
+
+                    self.stdout.write("Warning: Unable to write "
+                                      "DICOMInstance objects for "
+                                      "exam {}".format(study_meta_file))
+                    self.stdout.write(e)
+                    self.stdout.write(traceback.format_exc())
+
+                except PgWarning as w:
+
+                    self.stdout.write("Warning: Postgres warning creating "
+                                      "DICOMInstance objects for "
+                                      "exam {}".format(study_meta_file))
+                    self.stdout.write(w)
+                    self.stdout.write(traceback.format_exc())
+
+            if file_instances:
+
+                file_instances_to_create = []
+
+                for file_instance in file_instances:
+
+                    result = process_file_instances(parent_exam, file_instance)
+
+                    if type(result) == str:
+
+                        self.stdout.write(result)
+
+                    else:
 
-                                            else:
+                        file_instances_to_create.extend(result)
 
-                                                file_instances_to_create.extend(result)
+                try:
 
-                                        try:
+                    self.stdout.write("Writing File objects for "
+                                      "exam {}".format(study_meta_file))
 
-                                            self.stdout.write("Writing File objects for "
-                                                              "exam {}".format(study_meta_file))
+                    File.objects.bulk_create(file_instances_to_create, ignore_conflicts=True)
 
-                                            File.objects.bulk_create(file_instances_to_create)
+                except (DjangoDBError, PgError) as e:
 
-                                        except (DjangoDBError, PgError) as e:
+                    self.stdout.write("Warning: Unable to create "
+                                      "File objects for exam {}".format(study_meta_file))
+                    self.stdout.write(e)
+                    self.stdout.write(traceback.format_exc())
 
-                                            self.stdout.write("Warning: Unable to create "
-                                                              "File objects for exam {}".format(study_meta_file))
-                                            self.stdout.write(e)
-                                            self.stdout.write(traceback.format_exc())
+                except PgWarning as w:
 
-                                        except PgWarning as w:
+                    self.stdout.write("Warning: Postgres warning creating "
+                                      "File objects for exam {}".format(study_meta_file))
+                    self.stdout.write(w)
+                    self.stdout.write(traceback.format_exc())
 
-                                            self.stdout.write("Warning: Postgres warning creating "
-                                                              "File objects for exam {}".format(study_meta_file))
-                                            self.stdout.write(w)
-                                            self.stdout.write(traceback.format_exc())
+        index.close()
@@ -4,6 +4,7 @@ import traceback
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.db import Error as DjangoDBError
+from django.db import transaction
 from psycopg2 import Error as PgError
 from psycopg2 import Warning as PgWarning
 from pathlib import Path
@@ -14,6 +15,12 @@ from fmrif_archive.models import (
 )
 from datetime import datetime
 from fmrif_archive.utils import parse_pn, get_fmrif_scanner
+from fmrif_archive.management.utils.scan_geometry import SCAN_GEOMETRY_FIELDS
+from fmrif_archive.management.utils.parsed_tree_index import add_index_arguments, open_parsed_tree_index
+
+
+# Rows per INSERT statement in the bulk_create calls of a batch of exams
+INSERT_BATCH_SIZE = 1000
 
 
 class Command(BaseCommand):
@@ -32,372 +39,482 @@ class Command(BaseCommand):
 
         parser.add_argument("--days", nargs="*", type=str, default=[])
 
-    def handle(self, *args, **options):
+        add_index_arguments(parser)
+
+        parser.add_argument(
+            "--exam_batch_size",
+            help="Create exams, with their scans and other collections, in batches of this many exams, each in "
+                 "one transaction, instead of one exam at a time. The exams of a batch already in the database "
+                 "are looked up in one query.",
+            type=int,
+            default=None
+        )
+
+    def skip_existing(self, batch):
+        """The items of a batch of exams, as given to load_batch, whose exams are not in the database yet"""
+
+        existing_exams = set(Exam.objects.filter(
+            exam_id__in=[exam.exam_id for _, exam, _, _ in batch]
+        ).values_list('exam_id', 'revision'))
+
+        new_items = []
+
+        for item in batch:
+
+            exam = item[1]
+
+            if (exam.exam_id, exam.revision) in existing_exams:
+                self.stdout.write("Exam {} already has a database entry. Skipping.".format(exam.exam_id))
+                continue
+
+            new_items.append(item)
+
+        return new_items
+
+    def load_batch(self, batch):
+        """Creates a batch of exams, as (study metadata file, Exam, MRScans, FileCollections) tuples of unsaved
+        models, in one transaction. If the batch fails, its exams are retried one at a time so that a bad exam
+        does not lose the rest of the batch."""
+
+        if not batch:
+            return
+
+        exams = [exam for _, exam, _, _ in batch]
+
+        try:
+
+            with transaction.atomic():
+
+                Exam.objects.bulk_create(exams, batch_size=INSERT_BATCH_SIZE)
+
+                # Only PostgreSQL returns the primary keys of bulk-created rows
+                if any(exam.pk is None for exam in exams):
+
+                    pks = dict(
+                        ((exam_id, revision), pk) for pk, exam_id, revision in Exam.objects.filter(
+                            exam_id__in=[exam.exam_id for exam in exams]
+                        ).values_list('pk', 'exam_id', 'revision')
+                    )
+
+                    for exam in exams:
+                        exam.pk = pks[(exam.exam_id, exam.revision)]
 
-        scanners = options['scanners']
-        years = options['years']
-        months = options['months']
-        days = options['days']
+                mr_scans_to_create = []
+                other_subdirs_to_create = []
+
+                for _, exam, mr_scans, other_subdirs in batch:
+
+                    # Re-assign the parent now that it has a primary key
+                    for obj in mr_scans + other_subdirs:
+                        obj.parent_exam = exam
+
+                    mr_scans_to_create.extend(mr_scans)
+                    other_subdirs_to_create.extend(other_subdirs)
+
+                MRScan.objects.bulk_create(mr_scans_to_create, batch_size=INSERT_BATCH_SIZE)
+                FileCollection.objects.bulk_create(other_subdirs_to_create, batch_size=INSERT_BATCH_SIZE)
+
+        except (DjangoDBError, PgError) as e:
+
+            if len(batch) == 1:
+
+                self.stdout.write("Error: Unable to create exam models "
+                                  "for {}".format(batch[0][0]))
+                self.stdout.write(str(e))
+                self.stdout.write(traceback.format_exc())
+
+                return
+
+            self.stdout.write("Warning: Unable to create batch of {} exams, "
+                              "retrying one exam at a time".format(len(batch)))
+
+            for item in batch:
+
+                for obj in [item[1]] + item[2] + item[3]:
+                    obj.pk = None
+                    obj._state.adding = True
+
+                self.load_batch([item])
+
+            return
+
+        except PgWarning as w:
+
+            self.stdout.write("Warning: Postgres warning creating batch of {} exams".format(len(batch)))
+            self.stdout.write(str(w))
+            self.stdout.write(traceback.format_exc())
+
+        self.stdout.write("Created {} exams".format(len(batch)))
+
+    def handle(self, *args, **options):
 
         parsed_data_path = Path(options['data'])
 
-        if not scanners:
-            scanner_paths = [scanner_path for scanner_path in parsed_data_path.iterdir() if scanner_path.is_dir()]
-        else:
-            scanner_paths = [scanner_path for scanner_path in parsed_data_path.iterdir()
-                             if (scanner_path.is_dir() and scanner_path.name in scanners)]
+        index = open_parsed_tree_index(parsed_data_path, options, stdout=self.stdout)
 
-        for scanner_path in sorted(scanner_paths):
+        sessions = index.sessions(scanners=options['scanners'], years=options['years'], months=options['months'],
+                                  days=options['days'])
 
-            if not years:
-                year_paths = [year_path for year_path in scanner_path.iterdir() if year_path.is_dir()]
-            else:
-                year_paths = [year_path for year_path in scanner_path.iterdir()
-                              if (year_path.is_dir() and year_path.name in years)]
+        exam_batch_size = options['exam_batch_size']
+
+        # Exams queued for a batch in this run, to skip repeats of them before their batch is loaded
+        queued_exams = set()
 
-            for year_path in sorted(year_paths):
+        batch = []
 
-                if not months:
-                    month_paths = [month_path for month_path in year_path.iterdir() if month_path.is_dir()]
+        for session in sessions:
+
+            session_dir = session['session_dir']
+
+            study_metadata_files = session['study']
+
+            if not study_metadata_files:
+                self.stdout.write("Error: No study metadata found in {}".format(session_dir))
+                continue
+
+            if len(study_metadata_files) > 1:
+                self.stdout.write("Error: Multiple study metadata "
+                                  "files for {} found".format(session_dir))
+                continue
+
+            study_meta_file = study_metadata_files[0]
+
+            if not study_meta_file.is_file():
+                self.stdout.write("Error: Cannot load file {}".format(study_meta_file))
+                continue
+
+            self.stdout.write("Loading data from {}".format(str(study_meta_file)))
+
+            try:
+                with open(str(study_meta_file), "rt") as sm:
+                    study_metadata = json.load(sm)
+            except ValueError:
+                self.stdout.write("Error: Cannot load file {}".format(study_meta_file))
+                continue
+
+            metadata = study_metadata['metadata']
+            data = study_metadata['data']
+
+            dicom_data = None
+            for subdir in data:
+                if subdir.get('dicom_data', None):
+                    dicom_data = subdir['dicom_data']
+                    break
+
+            if not dicom_data:
+                self.stdout.write("Error: No DICOM metadata "
+                                  "for exam {}".format(study_meta_file))
+                continue
+
+            try:
+                exam_id = metadata['exam_id']
+                revision = 1
+                parser_version = metadata['parser_version']
+                filepath = metadata['gold_fpath']
+                checksum = metadata['gold_archive_checksum']
+            except KeyError:
+                self.stdout.write("Error: Required metadata field not "
+                                  "available for exam {}".format(study_meta_file))
+                continue
+                                    
+            if exam_batch_size:
+
+                # Exams already in the database are skipped when their batch is loaded
+                if (exam_id, revision) in queued_exams:
+                    self.stdout.write("Exam {} already has a database entry. Skipping.".format(exam_id))
+                    continue
+
+            else:
+
+                try:
+                    exam = Exam.objects.get(exam_id=exam_id, revision=1)
+                    self.stdout.write("Exam {} already has a database entry. Skipping.".format(exam_id))
+                    continue
+                except Exam.DoesNotExist:
+                    pass
+                                    
+            try:
+                station_name = get_fmrif_scanner(dicom_data["00081010"]["Value"][0])
+            except (KeyError, IndexError):
+                station_name = None
+
+            if not station_name:
+                station_name = filepath.split("/")[0]
+
+            try:
+                study_instance_uid = dicom_data["0020000D"]['Value'][0]
+            except (KeyError, IndexError):
+                study_instance_uid = None
+
+            try:
+                study_id = dicom_data["00200010"]['Value'][0]
+            except (KeyError, IndexError):
+                study_id = None
+
+            try:
+                study_date = dicom_data["00080020"]['Value'][0]
+                study_date = datetime.strptime(study_date, '%Y%m%d').date()
+            except (KeyError, IndexError):
+                study_date = None
+
+            if not study_date:
+                year, month, day = filepath.split("/")[1:4]
+                study_date = "{}{}{}".format(year, month, day)
+                study_date = datetime.strptime(study_date, '%Y%m%d').date()
+
+            try:
+                study_time = dicom_data["00080030"]['Value'][0]
+                if "." in study_time:
+                    study_time = datetime.strptime(study_time, '%H%M%S.%f').time()
                 else:
-                    month_paths = [month_path for month_path in year_path.iterdir()
-                                   if (month_path.is_dir() and month_path.name in months)]
+                    study_time = datetime.strptime(study_time, '%H%M%S').time()
+            except (KeyError, IndexError):
+                study_time = None
+
+            try:
+                study_description = dicom_data["00081030"]['Value'][0]
+            except (KeyError, IndexError):
+                study_description = None
+
+            protocol = None  # Not implemented yet
+
+            try:
+                accession_number = dicom_data["00080050"]['Value'][0]
+            except (KeyError, IndexError):
+                accession_number = None
+
+            try:
+                name = dicom_data["00100010"]['Value'][0]['Alphabetic']
+            except (KeyError, IndexError):
+                name = None
+
+            if name:
+                name_fields = parse_pn(name)
+                last_name = name_fields['family_name']
+                first_name = name_fields['given_name']
+            else:
+                first_name, last_name = None, None
+
+            try:
+                patient_id = dicom_data["00100020"]['Value'][0]
+            except (KeyError, IndexError):
+                patient_id = None
+
+            try:
+                sex = dicom_data["00100040"]['Value'][0]
+            except (KeyError, IndexError):
+                sex = None
+
+            try:
+                birth_date = dicom_data["00100030"]['Value'][0]
+                birth_date = datetime.strptime(birth_date, '%Y%m%d').date()
+            except (KeyError, IndexError):
+                birth_date = None
+
+            exam_fields = {
+                'exam_id': exam_id,
+                'revision': revision,
+                'parser_version': parser_version,
+                'filepath': filepath,
+                'checksum': checksum,
+                'station_name': station_name,
+                'study_instance_uid': study_instance_uid,
+                'study_id': study_id,
+                'study_date': study_date,
+                'study_time': study_time,
+                'study_description': study_description,
+                'protocol': protocol,
+                'accession_number': accession_number,
+                'name': name,
+                'last_name': last_name,
+                'first_name': first_name,
+                'patient_id': patient_id,
+                'sex': sex,
+                'birth_date': birth_date,
+            }
+
+            try:
+
+                exam = Exam(**exam_fields) if exam_batch_size else Exam.objects.create(**exam_fields)
+
+            except (DjangoDBError, PgError) as e:
+
+                self.stdout.write("Error: Unable to create exam model "
+                                  "for {}".format(study_meta_file))
+                self.stdout.write(e)
+                self.stdout.write(traceback.format_exc())
+
+                continue
+
+            except PgWarning as w:
+
+                self.stdout.write("Warning: Postgres warning "
+                                  "processing {}".format(study_meta_file))
+                self.stdout.write(w)
+                self.stdout.write(traceback.format_exc())
+
+            mr_scans = []
+            other_data = []
+
+            for subdir in data:
+                if subdir.get('dicom_data', None):
+                    mr_scans.append(subdir)
+                else:
+                    other_data.append(subdir)
+
+            mr_scans_to_create = []
 
-                for month_path in sorted(month_paths):
+            for scan in mr_scans:
 
-                    if not days:
-                        day_paths = [day_path for day_path in month_path.iterdir() if day_path.is_dir()]
+                parent_exam = exam
+
+                try:
+                    scan_metadata = scan['metadata']
+                    scan_dicom_data = scan['dicom_data']
+                    scan_name = scan_metadata['gold_scan_dir']
+                    scan_num_files = scan_metadata['num_files']
+                except KeyError:
+
+                    self.stdout.write("Error: Missing mandatory scan metadata, "
+                                      "omitting scan from exam {}".format(study_meta_file))
+                    continue
+
+                try:
+                    series_date = scan_dicom_data["00080021"]['Value'][0]
+                    series_date = datetime.strptime(series_date, '%Y%m%d').date()
+                except (KeyError, IndexError):
+                    series_date = None
+
+                try:
+                    series_time = scan_dicom_data["00080031"]['Value'][0]
+                    if "." in series_time:
+                        series_time = datetime.strptime(series_time, '%H%M%S.%f').time()
                     else:
-                        day_paths = [day_path for day_path in month_path.iterdir()
-                                     if (day_path.is_dir() and day_path.name in days)]
+                        series_time = datetime.strptime(series_time, '%H%M%S').time()
+                except (KeyError, IndexError):
+                    series_time = None
+
+                try:
+                    series_description = scan_dicom_data["0008103E"]['Value'][0]
+                except (KeyError, IndexError):
+                    series_description = None
+
+                try:
+                    sop_class_uid = scan_dicom_data["00080016"]['Value'][0]
+                except (KeyError, IndexError):
+                    sop_class_uid = None
+
+                try:
+                    series_instance_uid = scan_dicom_data["0020000E"]['Value'][0]
+                except (KeyError, IndexError):
+                    series_instance_uid = None
 
-                    for day_path in sorted(day_paths):
+                try:
+                    series_number = scan_dicom_data["00200011"]['Value'][0]
+                except (KeyError, IndexError):
+                    series_number = None
 
-                        for exam_id in sorted([e for e in day_path.iterdir() if e.is_dir()]):
+                try:
+                    scan_sequence = scan_dicom_data["0019109C"]['Value'][0]
+                except (KeyError, IndexError):
+                    try:
+                        scan_sequence = scan_dicom_data["00180024"]['Value'][0]
+                    except (KeyError, IndexError):
+                        scan_sequence = None
 
-                            for pt_dir in sorted([p for p in exam_id.iterdir() if p.is_dir()]):
+                geometry = scan.get('geometry', None) or {}
 
-                                for session_dir in sorted([s for s in pt_dir.iterdir() if s.is_dir()]):
+                mr_scans_to_create.append(
+                    MRScan(
+                        parent_exam=parent_exam,
+                        name=scan_name,
+                        num_files=scan_num_files,
+                        series_date=series_date,
+                        series_time=series_time,
+                        series_description=series_description,
+                        sop_class_uid=sop_class_uid,
+                        series_instance_uid=series_instance_uid,
+                        series_number=series_number,
+                        scan_sequence=scan_sequence,
+                        **{field: geometry.get(field, None) for field in SCAN_GEOMETRY_FIELDS}
+                    )
+                )
 
-                                    study_metadata_files = list(session_dir.glob("study_*_metadata.txt"))
+            other_subdirs_to_create = []
 
-                                    if not study_metadata_files:
-                                        self.stdout.write("Error: No study metadata found in {}".format(session_dir))
-                                        continue
+            for subdir in other_data:
 
-                                    if len(study_metadata_files) > 1:
-                                        self.stdout.write("Error: Multiple study metadata "
-                                                          "files for {} found".format(session_dir))
-                                        continue
+                parent_exam = exam
 
-                                    study_meta_file = study_metadata_files[0]
+                try:
+                    subdir_metadata = subdir['metadata']
+                    subdir_name = subdir_metadata['gold_scan_dir']
+                    subdir_num_files = subdir_metadata['num_files']
+                except KeyError:
+                    self.stdout.write("Error: Missing mandatory scan metadata, "
+                                      "omitting scan from exam {}".format(study_meta_file))
+                    continue
 
-                                    if not study_meta_file.is_file():
-                                        self.stdout.write("Error: Cannot load file {}".format(study_meta_file))
-                                        continue
+                other_subdirs_to_create.append(
+                    FileCollection(
+                        parent_exam=parent_exam,
+                        name=subdir_name,
+                        num_files=subdir_num_files
+                    )
+                )
 
-                                    self.stdout.write("Loading data from {}".format(str(study_meta_file)))
+            if exam_batch_size:
 
-                                    try:
-                                        with open(str(study_meta_file), "rt") as sm:
-                                            study_metadata = json.load(sm)
-                                    except ValueError:
-                                        self.stdout.write("Error: Cannot load file {}".format(study_meta_file))
-                                        continue
+                batch.append((study_meta_file, exam, mr_scans_to_create, other_subdirs_to_create))
+                queued_exams.add((exam_id, revision))
 
-                                    metadata = study_metadata['metadata']
-                                    data = study_metadata['data']
+                if len(batch) >= exam_batch_size:
+                    self.load_batch(self.skip_existing(batch))
+                    batch = []
 
-                                    dicom_data = None
-                                    for subdir in data:
-                                        if subdir.get('dicom_data', None):
-                                            dicom_data = subdir['dicom_data']
-                                            break
+                continue
 
-                                    if not dicom_data:
-                                        self.stdout.write("Error: No DICOM metadata "
-                                                          "for exam {}".format(study_meta_file))
-                                        continue
+            try:
 
-                                    try:
-                                        exam_id = metadata['exam_id']
-                                        revision = 1
-                                        parser_version = metadata['parser_version']
-                                        filepath = metadata['gold_fpath']
-                                        checksum = metadata['gold_archive_checksum']
-                                    except KeyError:
-                                        self.stdout.write("Error: Required metadata field not "
-                                                          "available for exam {}".format(study_meta_file))
-                                        continue
-                                    
-                                    try:
-                                        exam = Exam.objects.get(exam_id=exam_id, revision=1)
-                                        self.stdout.write("Exam {} already has a database entry. Skipping.".format(exam_id))
-                                        continue
-                                    except Exam.DoesNotExist:
-                                        pass
-                                    
-                                    try:
-                                        station_name = get_fmrif_scanner(dicom_data["00081010"]["Value"][0])
-                                    except (KeyError, IndexError):
-                                        station_name = None
-
-                                    if not station_name:
-                                        station_name = filepath.split("/")[0]
-
-                                    try:
-                                        study_instance_uid = dicom_data["0020000D"]['Value'][0]
-                                    except (KeyError, IndexError):
-                                        study_instance_uid = None
-
-                                    try:
-                                        study_id = dicom_data["00200010"]['Value'][0]
-                                    except (KeyError, IndexError):
-                                        study_id = None
-
-                                    try:
-                                        study_date = dicom_data["00080020"]['Value'][0]
-                                        study_date = datetime.strptime(study_date, '%Y%m%d').date()
-                                    except (KeyError, IndexError):
-                                        study_date = None
-
-                                    if not study_date:
-                                        year, month, day = filepath.split("/")[1:4]
-                                        study_date = "{}{}{}".format(year, month, day)
-                                        study_date = datetime.strptime(study_date, '%Y%m%d').date()
-
-                                    try:
-                                        study_time = dicom_data["00080030"]['Value'][0]
-                                        if "." in study_time:
-                                            study_time = datetime.strptime(study_time, '%H%M%S.%f').time()
-                                        else:
-                                            study_time = datetime.strptime(study_time, '%H%M%S').time()
-                                    except (KeyError, IndexError):
-                                        study_time = None
-
-                                    try:
-                                        study_description = dicom_data["00081030"]['Value'][0]
-                                    except (KeyError, IndexError):
-                                        study_description = None
-
-                                    protocol = None  # Not implemented yet
-
-                                    try:
-                                        accession_number = dicom_data["00080050"]['Value'][0]
-                                    except (KeyError, IndexError):
-                                        accession_number = None
-
-                                    try:
-                                        name = dicom_data["00100010"]['Value'][0]['Alphabetic']
-                                    except (KeyError, IndexError):
-                                        name = None
-
-                                    if name:
-                                        name_fields = parse_pn(name)
-                                        last_name = name_fields['family_name']
-                                        first_name = name_fields['given_name']
-                                    else:
-                                        first_name, last_name = None, None
-
-                                    try:
-                                        patient_id = dicom_data["00100020"]['Value'][0]
-                                    except (KeyError, IndexError):
-                                        patient_id = None
-
-                                    try:
-                                        sex = dicom_data["00100040"]['Value'][0]
-                                    except (KeyError, IndexError):
-                                        sex = None
-
-                                    try:
-                                        birth_date = dicom_data["00100030"]['Value'][0]
-                                        birth_date = datetime.strptime(birth_date, '%Y%m%d').date()
-                                    except (KeyError, IndexError):
-                                        birth_date = None
-
-                                    try:
-
-                                        exam = Exam.objects.create(
-                                            exam_id=exam_id,
-                                            revision=revision,
-                                            parser_version=parser_version,
-                                            filepath=filepath,
-                                            checksum=checksum,
-                                            station_name=station_name,
-                                            study_instance_uid=study_instance_uid,
-                                            study_id=study_id,
-                                            study_date=study_date,
-                                            study_time=study_time,
-                                            study_description=study_description,
-                                            protocol=protocol,
-                                            accession_number=accession_number,
-                                            name=name,
-                                            last_name=last_name,
-                                            first_name=first_name,
-                                            patient_id=patient_id,
-                                            sex=sex,
-                                            birth_date=birth_date
-                                        )
-
-                                    except (DjangoDBError, PgError) as e:
-
-                                        self.stdout.write("Error: Unable to create exam model "
-                                                          "for {}".format(study_meta_file))
-                                        self.stdout.write(e)
-                                        self.stdout.write(traceback.format_exc())
-
-                                        continue
-
-                                    except PgWarning as w:
-
-                                        self.stdout.write("Warning: Postgres warning "
-                                                          "processing {}".format(study_meta_file))
-                                        self.stdout.write(w)
-                                        self.stdout.write(traceback.format_exc())
-
-                                    mr_scans = []
-                                    other_data = []
-
-                                    for subdir in data:
-                                        if subdir.get('dicom_data', None):
-                                            mr_scans.append(subdir)
-                                        else:
-                                            other_data.append(subdir)
-
-                                    mr_scans_to_create = []
-
-                                    for scan in mr_scans:
-
-                                        parent_exam = exam
-
-                                        try:
-                                            scan_metadata = scan['metadata']
-                                            scan_dicom_data = scan['dicom_data']
-                                            scan_name = scan_metadata['gold_scan_dir']
-                                            scan_num_files = scan_metadata['num_files']
-                                        except KeyError:
-
-                                            self.stdout.write("Error: Missing mandatory scan metadata, "
-                                                              "omitting scan from exam {}".format(study_meta_file))
-                                            continue
-
-                                        try:
-                                            series_date = scan_dicom_data["00080021"]['Value'][0]
-                                            series_date = datetime.strptime(series_date, '%Y%m%d').date()
-                                        except (KeyError, IndexError):
-                                            series_date = None
-
-                                        try:
-                                            series_time = scan_dicom_data["00080031"]['Value'][0]
-                                            if "." in series_time:
-                                                series_time = datetime.strptime(series_time, '%H%M%S.%f').time()
-                                            else:
-                                                series_time = datetime.strptime(series_time, '%H%M%S').time()
-                                        except (KeyError, IndexError):
-                                            series_time = None
-
-                                        try:
-                                            series_description = scan_dicom_data["0008103E"]['Value'][0]
-                                        except (KeyError, IndexError):
-                                            series_description = None
-
-                                        try:
-                                            sop_class_uid = scan_dicom_data["00080016"]['Value'][0]
-                                        except (KeyError, IndexError):
-                                            sop_class_uid = None
-
-                                        try:
-                                            series_instance_uid = scan_dicom_data["0020000E"]['Value'][0]
-                                        except (KeyError, IndexError):
-                                            series_instance_uid = None
-
-                                        try:
-                                            series_number = scan_dicom_data["00200011"]['Value'][0]
-                                        except (KeyError, IndexError):
-                                            series_number = None
-
-                                        try:
-                                            scan_sequence = scan_dicom_data["0019109C"]['Value'][0]
-                                        except (KeyError, IndexError):
-                                            try:
-                                                scan_sequence = scan_dicom_data["00180024"]['Value'][0]
-                                            except (KeyError, IndexError):
-                                                scan_sequence = None
-
-                                        mr_scans_to_create.append(
-                                            MRScan(
-                                                parent_exam=parent_exam,
-                                                name=scan_name,
-                                                num_files=scan_num_files,
-                                                series_date=series_date,
-                                                series_time=series_time,
-                                                series_description=series_description,
-                                                sop_class_uid=sop_class_uid,
-                                                series_instance_uid=series_instance_uid,
-                                                series_number=series_number,
-                                                scan_sequence=scan_sequence
-                                            )
-                                        )
-
-                                    try:
-
-                                        MRScan.objects.bulk_create(mr_scans_to_create)
-
-                                    except (DjangoDBError, PgError) as e:
-
-                                        self.stdout.write("Error: Unable to create MRScan models "
-                                                          "for exam {}".format(study_meta_file))
-                                        self.stdout.write(e)
-                                        self.stdout.write(traceback.format_exc())
-
-                                        continue
-
-                                    except PgWarning as w:
-
-                                        self.stdout.write("Warning: Postgres warning processing MRScan models "
-                                                          "for exam {}".format(study_meta_file))
-                                        self.stdout.write(w)
-                                        self.stdout.write(traceback.format_exc())
-
-                                    other_subdirs_to_create = []
-
-                                    for subdir in other_data:
-
-                                        parent_exam = exam
-
-                                        try:
-                                            subdir_metadata = subdir['metadata']
-                                            subdir_name = subdir_metadata['gold_scan_dir']
-                                            subdir_num_files = subdir_metadata['num_files']
-                                        except KeyError:
-                                            self.stdout.write("Error: Missing mandatory scan metadata, "
-                                                              "omitting scan from exam {}".format(study_meta_file))
-                                            continue
-
-                                        other_subdirs_to_create.append(
-                                            FileCollection(
-                                                parent_exam=parent_exam,
-                                                name=subdir_name,
-                                                num_files=subdir_num_files
-                                            )
-                                        )
-
-                                    try:
-
-                                        FileCollection.objects.bulk_create(other_subdirs_to_create)
-
-                                    except (DjangoDBError, PgError) as e:
-
-                                        self.stdout.write("Error: Unable to create "
-                                                          "FileCollection models for exam {}".format(study_meta_file))
-                                        self.stdout.write(e)
-                                        self.stdout.write(traceback.format_exc())
-
-                                        continue
-
-                                    except PgWarning as w:
-
-                                        self.stdout.write("Warning: Postgres warning creating "
-                                                          "FileCollection models for exam {}".format(study_meta_file))
-                                        self.stdout.write(w)
-                                        self.stdout.write(traceback.format_exc())
+                MRScan.objects.bulk_create(mr_scans_to_create)
+
+            except (DjangoDBError, PgError) as e:
+
+                self.stdout.write("Error: Unable to create MRScan models "
+                                  "for exam {}".format(study_meta_file))
+                self.stdout.write(e)
+                self.stdout.write(traceback.format_exc())
+
+                continue
+
+            except PgWarning as w:
+
+                self.stdout.write("Warning: Postgres warning processing MRScan models "
+                                  "for exam {}".format(study_meta_file))
+                self.stdout.write(w)
+                self.stdout.write(traceback.format_exc())
+
+            try:
+
+                FileCollection.objects.bulk_create(other_subdirs_to_create)
+
+            except (DjangoDBError, PgError) as e:
+
+                self.stdout.write("Error: Unable to create "
+                                  "FileCollection models for exam {}".format(study_meta_file))
+                self.stdout.write(e)
+                self.stdout.write(traceback.format_exc())
+
+                continue
+
+            except PgWarning as w:
+
+                self.stdout.write("Warning: Postgres warning creating "
+                                  "FileCollection models for exam {}".format(study_meta_file))
+                self.stdout.write(w)
+                self.stdout.write(traceback.format_exc())
+
+        if batch:
+            self.load_batch(self.skip_existing(batch))
+
+        index.close()
@@ -1,17 +1,31 @@
 import logging
 import json
 import itertools
+import shutil
+import time
 
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta
 from django.conf import settings as django_settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
 from pathlib import Path
 from fmrif_archive.models import Exam
 
+from fmrif_archive.management.utils.archive_discovery import walk_gold_archives
+from fmrif_archive.management.utils.archive_manifest import ArchiveManifest, resolve_archive_checksums
+from fmrif_archive.management.utils.exam_loader import ExamLoader
+from fmrif_archive.management.utils.extraction_budget import ExtractionBudget, get_tree_size
+from fmrif_archive.management.utils.ingest_journal import IngestJournal
+from fmrif_archive.management.utils.ingest_metrics import IngestMetrics
+from fmrif_archive.management.utils.ingest_pipeline import run_batch_pipeline
+from fmrif_archive.management.utils.parse_cache import ParseCache
+from fmrif_archive.management.utils.worker_pool import ParserWorkerPool
 from fmrif_archive.management.utils.parser_utils import (
-    get_checksum,
-    get_exam_id,
+    CHECKSUM_READ_SIZE,
+    cleanup_extracted_exam,
+    get_extract_dir,
     parse_metadata,
+    stream_tgz_files,
     uncompress_tgz_files,
 )
 
@@ -28,6 +42,30 @@ FMRIF_SCANNERS = [
 ]
 
 
+def get_known_exam_ids(scanners, from_date=None, to_date=None):
+    """Fetches, in a single query, the ids of the exams already in the database whose Gold archives
+    belong to the given scanners and date window."""
+
+    # Exam filepaths are of the form <scanner>/YYYY/MM/DD/<subdir>/<archive>.tgz, so the date window
+    # maps onto a lexicographic range of paths for each scanner
+    path_filter = Q()
+
+    for scanner in scanners:
+
+        scanner_filter = Q(filepath__startswith="{}/".format(scanner))
+
+        if from_date:
+            scanner_filter &= Q(filepath__gte="{}/{}".format(scanner, from_date.strftime("%Y/%m/%d")))
+
+        if to_date:
+            next_day = to_date + timedelta(days=1)
+            scanner_filter &= Q(filepath__lt="{}/{}".format(scanner, next_day.strftime("%Y/%m/%d")))
+
+        path_filter |= scanner_filter
+
+    return set(Exam.objects.filter(path_filter).values_list('exam_id', flat=True).iterator())
+
+
 class Command(BaseCommand):
 
     help = "Load study and scan metadata obtained from Gold archives into Osmium's SQL database"
@@ -68,6 +106,13 @@ class Command(BaseCommand):
             default=Path(django_settings.PARSED_DATA_PATH) / datetime.today().strftime("%Y%m%d_%H%M%S")
         )
 
+        parser.add_argument(
+            "--resume",
+            help="Resume an interrupted run. Pass the --work_dir of that run: archives its journal records "
+                 "as done are skipped, and half-processed ones are finished or cleaned up and redone.",
+            action='store_true',
+        )
+
         parser.add_argument(
             "--new_exams_only",
             help="Parse only exams that have not already been added to osmium's DB",
@@ -81,6 +126,34 @@ class Command(BaseCommand):
             default=6,
         )
 
+        parser.add_argument(
+            "--parse_cores",
+            help="Number of worker processes used to parse DICOM files for the whole run",
+            type=int,
+            default=32,
+        )
+
+        parser.add_argument(
+            "--parse_chunksize",
+            help="Number of DICOM files handed to a parsing worker at a time",
+            type=int,
+            default=8,
+        )
+
+        parser.add_argument(
+            "--checksum_cores",
+            help="Number of threads to use when computing checksums of TGZ files",
+            type=int,
+            default=4,
+        )
+
+        parser.add_argument(
+            "--checksum_read_size",
+            help="Size in bytes of the chunks read when computing checksums of TGZ files",
+            type=int,
+            default=CHECKSUM_READ_SIZE,
+        )
+
         parser.add_argument(
             "--batch_size",
             help="Number of files to uncompress and process at a time. Specify a small number"
@@ -90,6 +163,128 @@ class Command(BaseCommand):
             type=int
         )
 
+        parser.add_argument(
+            "--extract_budget",
+            help="Space in GB of the working directory that extracted archives may take up at a time. Archives "
+                 "are admitted for extraction while their estimated extracted size fits, and the space is "
+                 "released as each exam is cleaned up. Can be combined with --batch_size.",
+            default=None,
+            type=float
+        )
+
+        parser.add_argument(
+            "--expansion_ratio",
+            help="With --extract_budget, initial estimate of the ratio of extracted to compressed size of an "
+                 "archive. It is refined for each scanner as archives are extracted.",
+            default=3.0,
+            type=float
+        )
+
+        parser.add_argument(
+            "--pipeline",
+            help="Extract the next batch of archives while the current one is being parsed and checksummed",
+            action='store_true',
+        )
+
+        parser.add_argument(
+            "--extract_queue_depth",
+            help="With --pipeline, number of batches that may wait to be extracted",
+            type=int,
+            default=1,
+        )
+
+        parser.add_argument(
+            "--parse_queue_depth",
+            help="With --pipeline, number of extracted batches that may wait to be parsed. Each waiting "
+                 "batch occupies space in the working directory.",
+            type=int,
+            default=1,
+        )
+
+        parser.add_argument(
+            "--targeted_reads",
+            help="Only read the handful of tags stored for each DICOM instance, stopping as soon as the last "
+                 "of them has been parsed, instead of parsing each instance's full header",
+            action='store_true',
+        )
+
+        parser.add_argument(
+            "--instance_headers",
+            help="Keep the full header of every DICOM instance, stored as the elements that differ from the "
+                 "header of its scan. Reads each instance's full header, so overrides --targeted_reads.",
+            action='store_true',
+        )
+
+        parser.add_argument(
+            "--instance_columns",
+            help="Also write the varying attributes of the DICOM instances of each scan (position, orientation, "
+                 "instance number, acquisition and echo times, slice index) as typed arrays to a per-scan .npz "
+                 "file. Ignored with --load.",
+            action='store_true',
+        )
+
+        parser.add_argument(
+            "--csa_whitelist",
+            help="Only keep the commonly queried fields of the Siemens CSA headers (e.g. B_value, "
+                 "MosaicRefAcqTimes, PhaseEncodingDirectionPositive), decoding only those, instead of the "
+                 "whole header",
+            action='store_true',
+        )
+
+        parser.add_argument(
+            "--use_parse_cache",
+            help="Look up the metadata of each DICOM instance in the persistent parse cache by the checksum of "
+                 "the file, only parsing the headers of instances (or recomputing the parts of their metadata) "
+                 "not cached by the current version of the parser, and cache what is parsed",
+            action='store_true',
+        )
+
+        parser.add_argument(
+            "--parse_cache",
+            help="Path to the parse cache database",
+            default=Path(django_settings.PARSED_DATA_PATH) / "dicom_parse_cache.db"
+        )
+
+        parser.add_argument(
+            "--stream",
+            help="Parse DICOM headers directly from the compressed archives instead of extracting them "
+                 "into the working directory first",
+            action='store_true',
+        )
+
+        parser.add_argument(
+            "--load",
+            help="Load each parsed exam straight into the SQL database and Mongo, instead of writing metadata "
+                 "and checksum files to be loaded with the load_* commands",
+            action='store_true',
+        )
+
+        parser.add_argument(
+            "--load_batch_size",
+            help="With --load, number of rows written per INSERT statement",
+            type=int,
+            default=1000,
+        )
+
+        parser.add_argument("--mongo_database", type=str, default="image_archive")
+
+        parser.add_argument("--exam_collection", type=str, default="mr_exams")
+
+        parser.add_argument("--tag_collection", type=str, default="dicom_tags")
+
+        parser.add_argument(
+            "--use_manifest",
+            help="Look up archive checksums in the persistent archive manifest, and only re-hash archives "
+                 "whose size, mtime or inode changed since they were last recorded",
+            action='store_true',
+        )
+
+        parser.add_argument(
+            "--manifest",
+            help="Path to the archive manifest database",
+            default=Path(django_settings.PARSED_DATA_PATH) / "gold_archive_manifest.db"
+        )
+
     def handle(self, *args, **options):
 
         parser_settings = {
@@ -97,8 +292,27 @@ class Command(BaseCommand):
             'work_dir': Path(options['work_dir']),
             'scanners': options['scanners'],
             'new_exams': options.get('new_exams_only', False),
+            'resume': options.get('resume', False),
             'tgz_cores': options['tgz_cores'],
+            'parse_cores': options['parse_cores'],
+            'parse_chunksize': options['parse_chunksize'],
+            'checksum_cores': options['checksum_cores'],
+            'checksum_read_size': options['checksum_read_size'],
             'batch_size': options['batch_size'],
+            'extract_budget': options['extract_budget'],
+            'expansion_ratio': options['expansion_ratio'],
+            'pipeline': options.get('pipeline', False),
+            'extract_queue_depth': options['extract_queue_depth'],
+            'parse_queue_depth': options['parse_queue_depth'],
+            'targeted_reads': options.get('targeted_reads', False),
+            'instance_headers': options.get('instance_headers', False),
+            'instance_columns': options.get('instance_columns', False),
+            'csa_whitelist': options.get('csa_whitelist', False),
+            'parse_cache': Path(options['parse_cache']) if options.get('use_parse_cache', False) else None,
+            'stream': options.get('stream', False),
+            'load': options.get('load', False),
+            'use_manifest': options.get('use_manifest', False),
+            'manifest': Path(options['manifest']),
             'version': PARSER_VERSION,
         }
 
@@ -117,6 +331,9 @@ class Command(BaseCommand):
         parser_log.setLevel(logging.INFO)
         parser_log.addHandler(fh)
 
+        # Structured per-stage timings and counters, written as JSON lines next to the log
+        self.metrics = IngestMetrics(log_fpath.with_name(log_fpath.stem + "_report.jsonl"))
+
         has_from = True if options['from'] else False
         has_to = True if options['to'] else False
 
@@ -158,80 +375,214 @@ class Command(BaseCommand):
 
         compressed_files = []
 
-        for scanner in parser_settings['scanners']:
+        manifest = ArchiveManifest(parser_settings['manifest']) if parser_settings['use_manifest'] else None
 
-            if has_from:
+        if parser_settings['new_exams']:
+            known_exam_ids = get_known_exam_ids(
+                parser_settings['scanners'],
+                from_date=parser_settings.get('from', None),
+                to_date=parser_settings['to']
+            )
+            parser_log.info("{} exams for the selected scanners and dates are "
+                            "already in the database".format(len(known_exam_ids)))
+        else:
+            known_exam_ids = set()
+
+        candidate_files = self.metrics.timed('discovery', walk_gold_archives(
+            parser_settings['data_dir'],
+            parser_settings['scanners'],
+            from_date=parser_settings.get('from', None),
+            to_date=parser_settings['to'],
+            log=parser_log
+        ))
+
+        for compressed_file, chksum, exam_id in resolve_archive_checksums(
+                candidate_files,
+                manifest=manifest,
+                num_workers=parser_settings['checksum_cores'],
+                read_size=parser_settings['checksum_read_size'],
+                log=parser_log,
+                metrics=self.metrics
+        ):
+
+            if not chksum:
+                parser_log.error("Error computing checksum for file {}. "
+                                 "Skipping this file.".format(compressed_file))
+                continue
+
+            # Check that the file has not been added to the DB already. If it has, skip.
+
+            if exam_id not in known_exam_ids:
+                compressed_files.append((compressed_file, chksum, exam_id))
+            else:
+                parser_log.warning("Exam {} already is already in the database. "
+                                   "Skipping.".format(compressed_file))
 
-                delta = (parser_settings['to'] - parser_settings['from']) if has_from else None
+        if manifest:
+            manifest.close()
 
-                dates = [(parser_settings['from'] + timedelta(i)) for i in range(delta.days + 1)]
+        # Checksums complete out of order, so restore the scanner/date ordering of the archives
+        compressed_files.sort(key=lambda f: str(f[0]))
 
-            else:
+        if len(compressed_files) < 1:
+            parser_log.info("No compressed files found. Exiting...")
+            self.metrics.summarize(parser_log)
+            self.metrics.close()
+            return
 
-                scanner_dir = parser_settings['data_dir'] / scanner
+        parser_log.info("Found {} compressed files...".format(len(compressed_files)))
 
-                years = sorted(
-                    [int(y.name) for y in scanner_dir.iterdir() if (y.is_dir() and (len(y.name) == 4) and y.name.isdigit())]
-                )
+        # Begin processing files, in appropriate batch sizes
 
-                if not years:
-                    continue
+        batch_size = parser_settings['batch_size'] if parser_settings['batch_size'] else len(compressed_files)
 
-                from_date = date(years[0], 1, 1)
+        # In streaming mode each worker process handles a whole archive, otherwise individual DICOM files
+        num_workers = parser_settings['tgz_cores'] if parser_settings['stream'] else parser_settings['parse_cores']
 
-                delta = parser_settings['to'] - from_date
+        self.journal = IngestJournal(parser_settings['work_dir'])
 
-                dates = [
-                    (from_date + timedelta(i)) for i in range(delta.days + 1) if
-                    (from_date + timedelta(i)).year in years
-                ]
+        # Create the parse cache before the workers share it
+        if parser_settings['parse_cache']:
+            ParseCache(parser_settings['parse_cache']).close()
 
-            for curr_date in dates:
+        if parser_settings['load']:
+            self.loader = ExamLoader(
+                mongo_client=django_settings.MONGO_CLIENT,
+                mongo_database=options['mongo_database'],
+                exam_collection=options['exam_collection'],
+                tag_collection=options['tag_collection'],
+                batch_size=options['load_batch_size'],
+                log=parser_log
+            )
+        else:
+            self.loader = None
 
-                curr_year = str(curr_date.year)
-                curr_month = str(curr_date.month).rjust(2, "0")
-                curr_day = str(curr_date.day).rjust(2, "0")
+        if parser_settings['extract_budget'] and not parser_settings['stream']:
+            self.budget = ExtractionBudget(int(parser_settings['extract_budget'] * 1e9),
+                                           default_ratio=parser_settings['expansion_ratio'])
+        else:
+            self.budget = None
 
-                search_dir = parser_settings['data_dir'] / scanner / curr_year / curr_month / curr_day
+        with ParserWorkerPool(num_workers=num_workers, chunksize=parser_settings['parse_chunksize'],
+                              log=parser_log) as pool:
 
-                if search_dir.is_dir():
+            if parser_settings['resume']:
+                compressed_files = self.resume_archives(compressed_files, parser_settings, parser_log, pool)
 
-                    parser_log.info("Searching in {}...".format(search_dir))
+            self.process_batches(compressed_files, batch_size, parser_settings, parser_log, pool)
 
-                    file_glob = [f for f in search_dir.glob("*/*.tgz") if f.is_file()]
+            pool.report(parser_log)
 
-                    for compressed_file in file_glob:
+        self.journal.close()
 
-                        # Check that the file has not been added to the DB already. If it has, skip.
+        self.metrics.summarize(parser_log)
+        self.metrics.close()
 
-                        chksum = get_checksum(compressed_file)
+    def resume_archives(self, compressed_files, parser_settings, parser_log, pool):
+        """Finishes the archives left half-done by an interrupted run according to the journal, and returns
+        the archives that still need to be processed from scratch"""
 
-                        if not chksum:
-                            parser_log.error("Error computing checksum for file {}. "
-                                             "Skipping this file.".format(compressed_file))
+        remaining = []
+        to_parse = []
 
-                        exam_id = get_exam_id(chksum, compressed_file)
+        for compressed_file, chksum, exam_id in compressed_files:
 
-                        if parser_settings['new_exams']:
-                            exam = Exam.objects.filter(exam_id=exam_id)
-                        else:
-                            exam = None
+            last_stage = self.journal.last_stage(exam_id)
 
-                        if not exam:
-                            compressed_files.append((compressed_file, chksum, exam_id))
-                        else:
-                            parser_log.warning("Exam {} already is already in the database. "
-                                               "Skipping.".format(compressed_file))
+            extract_dir = get_extract_dir(compressed_file, exam_id, parser_settings['work_dir'])
+
+            if self.journal.is_complete(exam_id):
+
+                parser_log.info("Archive {} was already processed. Skipping.".format(compressed_file))
+
+            elif last_stage == 'parsed':
+
+                parser_log.info("Finishing cleanup of archive {}".format(compressed_file))
+
+                start = time.time()
+
+                if parser_settings['load']:
+                    shutil.rmtree(str(extract_dir))
+                else:
+                    for exam_dir in [d for d in extract_dir.glob("*/*") if d.is_dir()]:
+                        cleanup_extracted_exam(exam_dir)
+
+                self.metrics.record('cleanup', start, time.time(), files=1, archive=compressed_file)
+
+                self.journal.record(compressed_file, exam_id, 'cleaned')
+
+            elif last_stage == 'extracted' and extract_dir.is_dir():
+
+                parser_log.info("Archive {} was already extracted. Resuming from parsing.".format(compressed_file))
+
+                to_parse.append((extract_dir, compressed_file, exam_id, chksum))
+
+            else:
+
+                if extract_dir.is_dir():
+                    parser_log.info("Removing partial outputs of archive {}: {}".format(compressed_file, extract_dir))
+                    shutil.rmtree(str(extract_dir))
+
+                remaining.append((compressed_file, chksum, exam_id))
+
+        if to_parse:
+            self.parse_batch(to_parse, parser_settings, parser_log, pool)
+
+        parser_log.info("{} archives left to process after resuming".format(len(remaining)))
+
+        return remaining
+
+    def process_batches(self, compressed_files, batch_size, parser_settings, parser_log, pool):
+
+        if parser_settings['pipeline'] and not parser_settings['stream']:
+
+            parser_log.info("Extracting and parsing batches in a pipeline...")
+
+            run_batch_pipeline(
+                self.get_batches(compressed_files, batch_size, parser_log),
+                [
+                    ('extract',
+                     lambda batch: self.extract_batch(batch, parser_settings, parser_log),
+                     parser_settings['extract_queue_depth']),
+                    ('parse',
+                     lambda extracted_archives: self.parse_batch(extracted_archives, parser_settings, parser_log,
+                                                                 pool),
+                     parser_settings['parse_queue_depth']),
+                ],
+                log=parser_log
+            )
 
-        if len(compressed_files) < 1:
-            parser_log.info("No compressed files found. Exiting...")
             return
 
-        parser_log.info("Found {} compressed files...".format(len(compressed_files)))
+        for curr_files in self.get_batches(compressed_files, batch_size, parser_log):
 
-        # Begin processing files, in appropriate batch sizes
+            if parser_settings['stream']:
 
-        batch_size = parser_settings['batch_size'] if parser_settings['batch_size'] else len(compressed_files)
+                parser_log.info("Parsing DICOM metadata from compressed archives...")
+
+                for msg in stream_tgz_files(curr_files, parser_settings, parser_settings['version'], log=parser_log,
+                                            pool=pool, journal=self.journal, metrics=self.metrics,
+                                            loader=self.loader):
+                    if msg.startswith(("Parsed", "Loaded")):
+                        parser_log.info(msg)
+                    else:
+                        parser_log.error(msg)
+
+                continue
+
+            extracted_archives = self.extract_batch(curr_files, parser_settings, parser_log)
+
+            if not extracted_archives:
+                parser_log.error("Unable to extract any archive. Exiting...")
+                return
+
+            self.parse_batch(extracted_archives, parser_settings, parser_log, pool)
+
+    def get_batches(self, compressed_files, batch_size, parser_log):
+
+        if self.budget:
+            yield from self.get_budget_batches(compressed_files, batch_size, parser_log)
+            return
 
         compressed_files_iter = iter(compressed_files)
 
@@ -256,18 +607,97 @@ class Command(BaseCommand):
             curr_first_file = curr_iter*batch_size + 1
             curr_iter += 1
 
-            extracted_archives, msgs = uncompress_tgz_files(curr_files, parser_settings)
+            yield curr_files
 
-            for msg in msgs:
-                if msg.startswith("Extracted"):
-                    parser_log.info(msg)
-                else:
-                    parser_log.error(msg)
+    def get_budget_batches(self, compressed_files, batch_size, parser_log):
+        """Yields batches of up to batch_size archives admitted against the extraction budget. Archives are
+        added to the current batch while they fit in the budget; once one does not, the batch is handed
+        on, and the archive waits for the space of earlier batches to be released before starting the
+        next one."""
 
-            if len(extracted_archives) < 1:
-                parser_log.error("Unable to extract any archive. Exiting...")
-                return
+        total_files = len(compressed_files)
+        num_yielded = 0
+
+        batch = []
+
+        for compressed_file in compressed_files:
+
+            admitted = len(batch) < batch_size and self.budget.try_acquire(compressed_file[0])
+
+            if not admitted:
+
+                if batch:
+
+                    parser_log.info("Processing files {} - {} out of {} ({:.1f} GB reserved)...".format(
+                        num_yielded + 1, num_yielded + len(batch), total_files, self.budget.used_bytes / 1e9
+                    ))
+
+                    num_yielded += len(batch)
+
+                    yield batch
+
+                    batch = []
+
+                self.budget.acquire(compressed_file[0])
+
+            batch.append(compressed_file)
+
+        if batch:
+
+            parser_log.info("Processing files {} - {} out of {} ({:.1f} GB reserved)...".format(
+                num_yielded + 1, num_yielded + len(batch), total_files, self.budget.used_bytes / 1e9
+            ))
+
+            yield batch
+
+    def extract_batch(self, curr_files, parser_settings, parser_log):
+
+        extracted_archives, msgs = uncompress_tgz_files(curr_files, parser_settings, metrics=self.metrics)
+
+        for msg in msgs:
+            if msg.startswith("Extracted"):
+                parser_log.info(msg)
+            else:
+                parser_log.error(msg)
+
+        if self.budget:
+
+            extracted_files = set(str(compressed_file) for _, compressed_file, _, _ in extracted_archives)
+
+            for compressed_file, _, _ in curr_files:
+                if str(compressed_file) not in extracted_files:
+                    self.budget.release(compressed_file)
+
+            for extract_dir, compressed_file, _, _ in extracted_archives:
+                self.budget.observe(compressed_file, get_tree_size(extract_dir))
+
+            parser_log.info("Expansion ratios: {}".format(", ".join(
+                "{} {:.2f}".format(scanner, ratio) for scanner, ratio in sorted(self.budget.ratios.items())
+            )))
+
+        for extract_dir, compressed_file, exam_id, _ in extracted_archives:
+            self.journal.record(compressed_file, exam_id, 'extracted')
+
+        if len(extracted_archives) < 1:
+            parser_log.error("Unable to extract any archive in batch.")
+            return None
+
+        return extracted_archives
+
+    def parse_batch(self, extracted_archives, parser_settings, parser_log, pool):
 
-            parser_log.info("Parsing DICOM metadata...")
+        parser_log.info("Parsing DICOM metadata...")
 
-            parse_metadata(extracted_archives, parser_version=parser_settings['version'], log=parser_log)
+        try:
+            parse_metadata(extracted_archives, parser_version=parser_settings['version'], log=parser_log, pool=pool,
+                           targeted_reads=parser_settings['targeted_reads'], journal=self.journal,
+                           metrics=self.metrics, budget=self.budget, loader=self.loader,
+                           instance_headers=parser_settings['instance_headers'],
+                           instance_columns=parser_settings['instance_columns'],
+                           csa_whitelist=parser_settings['csa_whitelist'],
+                           parse_cache=parser_settings['parse_cache'])
+        finally:
+            # Make sure a failure does not leave the batch holding budget that later batches wait on
+            if self.budget:
+                for _, compressed_file, _, _ in extracted_archives:
+                    self.budget.release(compressed_file)
@@ -0,0 +1,138 @@
+import os
+
+from datetime import date
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+
+
+# Marks the end of a scanner walk in the queue shared by the walker threads
+_WALK_DONE = object()
+
+
+def _scandir_dated(path, num_digits, min_val=None, max_val=None, log=None):
+    """Returns the sorted (value, path) pairs of the subdirectories of path named with num_digits digits
+    whose integer value falls within [min_val, max_val]. A directory that cannot be listed has none."""
+
+    dated = []
+
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+
+                if not (len(entry.name) == num_digits and entry.name.isdigit() and entry.is_dir()):
+                    continue
+
+                val = int(entry.name)
+
+                if (min_val is not None and val < min_val) or (max_val is not None and val > max_val):
+                    continue
+
+                dated.append((val, entry.path))
+    except OSError as e:
+        if log:
+            log.error("Unable to list {}: {}".format(path, e))
+
+    return sorted(dated)
+
+
+def _date_bound(bound_date, year=None, month=None, default=None):
+    """The month (if only year given) or day (if year and month given) component of bound_date, if the
+    walk is currently on the bounding year (and month), otherwise default"""
+
+    if bound_date is None or bound_date.year != year:
+        return default
+
+    if month is None:
+        return bound_date.month
+
+    if bound_date.month != month:
+        return default
+
+    return bound_date.day
+
+
+def walk_scanner_archives(data_dir, scanner, from_date=None, to_date=None, log=None):
+    """Yields the TGZ archives under <data_dir>/<scanner>/YYYY/MM/DD/<subdir>/ for the dates within
+    [from_date, to_date], visiting only the year, month and day directories that actually exist"""
+
+    scanner_dir = Path(data_dir) / scanner
+
+    from_year = from_date.year if from_date else None
+    to_year = to_date.year if to_date else None
+
+    for year, year_path in _scandir_dated(scanner_dir, 4, from_year, to_year, log=log):
+
+        min_month = _date_bound(from_date, year)
+        max_month = _date_bound(to_date, year)
+
+        for month, month_path in _scandir_dated(year_path, 2, min_month, max_month, log=log):
+
+            min_day = _date_bound(from_date, year, month)
+            max_day = _date_bound(to_date, year, month)
+
+            for day, day_path in _scandir_dated(month_path, 2, min_day, max_day, log=log):
+
+                try:
+                    date(year, month, day)
+                except ValueError:
+                    continue
+
+                if log:
+                    log.info("Searching in {}...".format(day_path))
+
+                archives = []
+
+                try:
+                    with os.scandir(day_path) as subdirs:
+                        for subdir in subdirs:
+
+                            if not subdir.is_dir():
+                                continue
+
+                            with os.scandir(subdir.path) as files:
+                                archives.extend([
+                                    f.path for f in files if f.name.endswith(".tgz") and f.is_file()
+                                ])
+                except OSError as e:
+                    if log:
+                        log.error("Unable to list {}: {}".format(day_path, e))
+
+                for archive in sorted(archives):
+                    yield Path(archive)
+
+
+def _walk_into_queue(queue, data_dir, scanner, from_date, to_date, log):
+
+    try:
+        for archive in walk_scanner_archives(data_dir, scanner, from_date=from_date, to_date=to_date, log=log):
+            queue.put(archive)
+    finally:
+        queue.put(_WALK_DONE)
+
+
+def walk_gold_archives(data_dir, scanners, from_date=None, to_date=None, queue_size=1024, log=None):
+    """Walks the directories of several scanners concurrently, one thread per scanner, and yields their
+    TGZ archives as soon as they are found so that consumers can start on them before the walk ends"""
+
+    queue = Queue(maxsize=queue_size)
+
+    walkers = [
+        Thread(target=_walk_into_queue, args=(queue, data_dir, scanner, from_date, to_date, log), daemon=True)
+        for scanner in scanners
+    ]
+
+    for walker in walkers:
+        walker.start()
+
+    num_running = len(walkers)
+
+    while num_running:
+
+        archive = queue.get()
+
+        if archive is _WALK_DONE:
+            num_running -= 1
+            continue
+
+        yield archive
@@ -0,0 +1,205 @@
+import sqlite3
+
+from collections import deque
+
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+
+from fmrif_archive.management.utils.parser_utils import CHECKSUM_READ_SIZE, get_archive_checksums
+
+
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    fpath TEXT PRIMARY KEY,
+    scanner TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    exam_id TEXT NOT NULL,
+    hashed_on TEXT NOT NULL
+)
+"""
+
+
+def stat_signature(stat_result):
+    """The parts of a stat result that must be unchanged for a stored checksum to still be trusted"""
+    return stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino
+
+
+class ArchiveManifest:
+    """Persistent record of the checksums and exam ids of Gold TGZ archives, keyed by absolute path.
+
+    An entry is only considered valid while the size, mtime and inode of the archive match the ones
+    recorded when it was hashed."""
+
+    def __init__(self, db_path):
+
+        self.db_path = Path(db_path)
+
+        if not self.db_path.parent.is_dir():
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Lookups happen in the thread feeding the checksum pool, while updates happen in the thread
+        # consuming its results, so the connection is shared and serialized with a lock
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.execute(MANIFEST_SCHEMA)
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def get(self, fpath):
+
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, inode, md5, exam_id FROM archives WHERE fpath = ?", (str(fpath),)
+            ).fetchone()
+
+        if not row:
+            return None
+
+        return {
+            'signature': tuple(row[:3]),
+            'md5': row[3],
+            'exam_id': row[4],
+        }
+
+    def lookup(self, fpath, stat_result=None):
+        """Returns (md5, exam_id) for an archive if its stat signature matches the manifest entry,
+        otherwise (None, None), e.g. if the archive no longer exists"""
+
+        entry = self.get(fpath)
+
+        if not entry:
+            return None, None
+
+        if stat_result is None:
+            try:
+                stat_result = Path(fpath).stat()
+            except OSError:
+                return None, None
+
+        if entry['signature'] != stat_signature(stat_result):
+            return None, None
+
+        return entry['md5'], entry['exam_id']
+
+    def update(self, fpath, md5, exam_id, stat_result=None):
+        """Records the checksum and exam id of an archive, with its current stat signature unless one is
+        given. Returns False, recording nothing, if the archive can't be stat'ed."""
+
+        fpath = Path(fpath)
+
+        if stat_result is None:
+            try:
+                stat_result = fpath.stat()
+            except OSError:
+                return False
+
+        size, mtime_ns, inode = stat_signature(stat_result)
+
+        # Path is .../<scanner>/YYYY/MM/DD/<subdir>/<archive>.tgz
+        scanner = fpath.parents[4].name
+
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO archives "
+                "(fpath, scanner, size, mtime_ns, inode, md5, exam_id, hashed_on) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (str(fpath), scanner, size, mtime_ns, inode, md5, exam_id, datetime.now().isoformat())
+            )
+
+        return True
+
+    def remove(self, fpath):
+        with self.lock:
+            self.conn.execute("DELETE FROM archives WHERE fpath = ?", (str(fpath),))
+
+    def entries(self, scanners=None):
+        """Yields (fpath, md5, exam_id) for every archive in the manifest, optionally restricted to some
+        scanners"""
+
+        query = "SELECT fpath, md5, exam_id FROM archives"
+        params = ()
+
+        if scanners:
+            query += " WHERE scanner IN ({})".format(", ".join("?" * len(scanners)))
+            params = tuple(scanners)
+
+        query += " ORDER BY fpath"
+
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+
+        for fpath, md5, exam_id in rows:
+            yield Path(fpath), md5, exam_id
+
+
+def resolve_archive_checksums(fpaths, manifest=None, num_workers=4, read_size=CHECKSUM_READ_SIZE, log=None,
+                              metrics=None):
+    """Yields (fpath, checksum, exam_id) for Gold archives. If a manifest is given, archives whose stat
+    signature is unchanged are answered from it and only the remaining ones are hashed (concurrently),
+    with their new entries recorded in the manifest. The checksum is None if an archive could not be
+    hashed. Archives that can't be stat'ed (e.g. moved or deleted since they were listed) are logged and
+    skipped.
+
+    fpaths may be a generator (e.g. from walk_gold_archives); hashing starts as soon as the first archive
+    that needs it is produced."""
+
+    cached = deque()
+    stat_results = {}
+
+    def _uncached(fpaths):
+
+        for fpath in fpaths:
+
+            fpath = Path(fpath)
+
+            if manifest:
+
+                try:
+                    stat_result = fpath.stat()
+                except OSError as e:
+                    if log:
+                        log.error("Unable to stat {}, skipping: {}".format(fpath, e))
+                    continue
+
+                checksum, exam_id = manifest.lookup(fpath, stat_result=stat_result)
+
+                if checksum:
+                    cached.append((fpath, checksum, exam_id))
+                    continue
+
+                stat_results[fpath] = stat_result
+
+            yield fpath
+
+    for fpath, checksum, exam_id in get_archive_checksums(_uncached(fpaths), num_workers=num_workers,
+                                                          read_size=read_size, log=log, metrics=metrics):
+
+        while cached:
+            yield cached.popleft()
+
+        if checksum and manifest:
+            manifest.update(fpath, checksum, exam_id, stat_result=stat_results[fpath])
+            manifest.commit()
+
+        yield fpath, checksum, exam_id
+
+    while cached:
+        yield cached.popleft()
@@ -0,0 +1,280 @@
+import struct
+import warnings
+
+from fmrif_archive.management.utils.dicom_json import VR_ENCODERS
+
+# Load the CSA header utilities and ignore the warnings
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", category=UserWarning)
+    from nibabel.nicom.csareader import CSAReadError, MAX_CSA_ITEMS
+    from nibabel.nicom.utils import find_private_section
+
+
+# Commonly queried CSA fields, stored instead of the whole header with --csa_whitelist
+CSA_WHITELIST = (
+    'AcquisitionMatrixText',
+    'B_value',
+    'B_matrix',
+    'BandwidthPerPixelPhaseEncode',
+    'DiffusionDirectionality',
+    'DiffusionGradientDirection',
+    'ImaCoilString',
+    'MosaicRefAcqTimes',
+    'NumberOfImagesInMosaic',
+    'PhaseEncodingDirectionPositive',
+    'SliceMeasurementDuration',
+    'SliceNormalVector',
+)
+
+# Types of the CSA items of numeric VRs, as converted by nibabel
+_CSA_CONVERTERS = {
+    'FL': float,
+    'FD': float,
+    'DS': float,
+    'SS': int,
+    'US': int,
+    'SL': int,
+    'UL': int,
+    'IS': int,
+}
+
+# VRs whose items are kept as read, rather than converted to their JSON types
+_UNENCODED_VRS = ('OB', 'OD', 'OF', 'OL', 'OW', 'UN', 'SQ', 'PN')
+
+_TAG_HEADER = struct.Struct("<64si4s3i")
+_ITEM_HEADER = struct.Struct("<4i")
+
+
+def _nt_str(s):
+    """Strips a byte string to its first null, decoding it, as nibabel does (strings without a null are
+    left as bytes)"""
+
+    zero_pos = s.find(b"\x00")
+
+    if zero_pos == -1:
+        return s
+
+    return s[:zero_pos].decode('latin-1')
+
+
+def get_csa_bytes(dicom_dataset, csa_type='image'):
+    """The raw bytes of the image (or series) Siemens CSA header of a dataset, None if it has none"""
+
+    if (0x29, 0x10) not in dicom_dataset:
+        return None
+
+    section_start = find_private_section(dicom_dataset, 0x29, 'SIEMENS CSA HEADER')
+
+    if section_start is None:
+        return None
+
+    try:
+        return dicom_dataset[(0x29, section_start + (0x10 if csa_type == 'image' else 0x20))].value
+    except KeyError:
+        return None
+
+
+class LazyCSAHeader:
+    """A Siemens CSA header (CSA1 or CSA2) that is indexed once, recording where the items of each of its
+    tags lie, and whose tags are only decoded when asked for. Decoded tags are cached, so the header of a
+    scan's sample instance can be queried repeatedly at no extra cost.
+
+    Tags are decoded as nibabel's csareader does, then their items are converted to their JSON types
+    (except for binary, SQ and PN items), giving the same structure parse_private_data has always stored."""
+
+    def __init__(self, csa_bytes):
+
+        self.csa_bytes = csa_bytes
+
+        csa_len = len(csa_bytes)
+
+        ptr = 0
+
+        if csa_bytes[:4] == b"SV10":
+            self.type = 2
+            ptr = 8  # Skip the SV10 marker and 4 unused bytes
+        else:
+            self.type = 1
+
+        try:
+            self.n_tags, self.check = struct.unpack_from("<2I", csa_bytes, ptr)
+        except struct.error:
+            raise CSAReadError("CSA header is too short")
+
+        ptr += 8
+
+        if not 0 < self.n_tags <= MAX_CSA_ITEMS:
+            raise CSAReadError("Invalid number of CSA tags: {}".format(self.n_tags))
+
+        # name -> ((vm, vr, syngodt, n_items, last3, tag_no), [(item_no, offset, length)]), where an offset of
+        # None marks a truncated CSA1 item
+        self.index = {}
+        self.decoded = {}
+
+        tag0_n_items = None
+
+        try:
+
+            for tag_no in range(self.n_tags):
+
+                name, vm, vr, syngodt, n_items, last3 = _TAG_HEADER.unpack_from(csa_bytes, ptr)
+                ptr += _TAG_HEADER.size
+
+                if tag_no == 1:
+                    tag0_n_items = n_items
+
+                if n_items > MAX_CSA_ITEMS:
+                    raise CSAReadError("Expected <= {} CSA items, got {}".format(MAX_CSA_ITEMS, n_items))
+
+                items = []
+
+                for item_no in range(n_items):
+
+                    x0, x1, _, _ = _ITEM_HEADER.unpack_from(csa_bytes, ptr)
+                    ptr += _ITEM_HEADER.size
+
+                    if self.type == 1:
+                        # CSA1 item lengths are offset by the number of items of the first tag
+                        item_len = x0 - tag0_n_items
+                        if item_len < 0 or ptr + item_len > csa_len:
+                            if item_no < vm:
+                                items.append((item_no, None, 0))
+                            break
+                    else:
+                        item_len = x1
+                        if ptr + item_len > csa_len:
+                            raise CSAReadError("CSA item is too long")
+
+                    items.append((item_no, ptr, item_len))
+
+                    # Items are padded to 4 byte boundaries
+                    ptr += item_len + (4 - item_len % 4) % 4
+
+                self.index[_nt_str(name)] = ((vm, vr, syngodt, n_items, last3, tag_no), items)
+
+        except (struct.error, TypeError):
+            raise CSAReadError("Unable to index CSA header")
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def names(self):
+        return list(self.index.keys())
+
+    def _read_items(self, name):
+        """The items of a tag as read by nibabel, before their conversion to JSON types"""
+
+        (vm, vr, _, n_items, _, _), positions = self.index[name]
+
+        n_values = vm if vm else n_items
+        converter = _CSA_CONVERTERS.get(_nt_str(vr))
+
+        items = []
+
+        for item_no, offset, item_len in positions:
+
+            if offset is None:
+                items.append('')
+                break
+
+            if item_no >= n_values:
+                if item_len:
+                    raise CSAReadError("Unexpected data in CSA item {} of {}".format(item_no, name))
+                continue
+
+            item = _nt_str(self.csa_bytes[offset:offset + item_len])
+
+            if converter:
+                # Numeric tags may have fewer items than given; the first empty one marks the end
+                if item_len == 0:
+                    n_values = item_no
+                    continue
+                item = converter(item)
+
+            items.append(item)
+
+        return items
+
+    def get_tag(self, name):
+        """The decoded tag with the given name, as a dict with its 'items' converted to their JSON types.
+        Raises KeyError if the header has no such tag, or its VR has no JSON encoding."""
+
+        try:
+            return self.decoded[name]
+        except KeyError:
+            pass
+
+        vm, vr, syngodt, n_items, last3, tag_no = self.index[name][0]
+
+        tag = {
+            'n_items': n_items,
+            'vm': vm,
+            'vr': _nt_str(vr),
+            'syngodt': syngodt,
+            'last3': last3,
+            'tag_no': tag_no,
+        }
+
+        items = self._read_items(name)
+
+        if tag['vr'] not in _UNENCODED_VRS:
+            items = [VR_ENCODERS[tag['vr']](item) for item in items]
+
+        tag['items'] = items
+
+        self.decoded[name] = tag
+
+        return tag
+
+    def get(self, name, default=None):
+        """The items of a tag, or default if the header does not have it"""
+
+        if name not in self.index:
+            return default
+
+        return self.get_tag(name)['items']
+
+    def _get_scalar(self, name):
+
+        if name not in self.index:
+            return None
+
+        items = self._read_items(name)
+
+        return items[0] if items else None
+
+    def is_mosaic(self):
+        """Whether the image is a Siemens mosaic, as determined by nibabel's is_mosaic"""
+
+        if self._get_scalar('AcquisitionMatrixText') is None:
+            return False
+
+        n_mosaic = self._get_scalar('NumberOfImagesInMosaic')
+
+        return n_mosaic is not None and n_mosaic != 0
+
+    def to_dict(self, names=None):
+        """The header as a dict of its type, number of tags, check value and decoded tags, restricted to
+        the tags in names if given. Returns None if any of the tags has items that cannot be stored as
+        JSON (e.g. binary items without a null terminator)."""
+
+        tags = {}
+
+        for name in self.index:
+
+            if names is not None and name not in names:
+                continue
+
+            tag = self.get_tag(name)
+
+            if any(type(item) is bytes for item in tag['items']):
+                return None
+
+            tags[name] = tag
+
+        return {
+            'tags': tags,
+            'type': self.type,
+            'n_tags': self.n_tags,
+            'check': self.check,
+        }
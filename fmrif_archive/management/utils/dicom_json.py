@@ -0,0 +1,148 @@
+import pydicom
+
+from collections import OrderedDict
+from pydicom.datadict import DicomDictionary
+from pydicom.dataset import Dataset
+
+
+def sanitize_unicode(s):
+    """Removes any \u0000 characters from unicode strings in DICOM values, since this character is
+    unsupported in JSON"""
+
+    if type(s) is bytes:
+        s = s.decode('utf-8')
+    return str(s).replace(u"\u0000", "").strip()
+
+
+def parse_pn(value):
+    """Parses a Person Name (VR of type PN) DICOM value into the appropriate JSON Model Object representation"""
+
+    pn = OrderedDict({
+        'Alphabetic': str(value)
+    })
+
+    if value.ideographic:
+        pn["Ideographic"] = value.ideographic
+
+    if value.phonetic:
+        pn["Phonetic"] = value.phonetic
+
+    return pn
+
+
+def parse_at(value):
+    return str(value).replace("(", "").replace(")", "").replace(", ", "")
+
+
+def parse_ui(value):
+    return str(repr(value).replace('"', '').replace("'", ""))
+
+
+# Map of DICOM VRs to the functions converting their values to the JSON types specified in the DICOMweb
+# standard
+VR_ENCODERS = {
+    'AE': sanitize_unicode,
+    'AS': sanitize_unicode,
+    'AT': parse_at,
+    'CS': sanitize_unicode,
+    'DA': sanitize_unicode,
+    'DS': float,
+    'DT': sanitize_unicode,
+    'FL': float,
+    'FD': float,
+    'IS': int,
+    'LO': sanitize_unicode,
+    'LT': sanitize_unicode,
+    'PN': parse_pn,
+    'SH': sanitize_unicode,
+    'SL': int,
+    'SS': int,
+    'ST': sanitize_unicode,
+    'TM': sanitize_unicode,
+    'UC': sanitize_unicode,
+    'UI': parse_ui,
+    'UL': int,
+    'UR': sanitize_unicode,
+    'US': int,
+    'UT': sanitize_unicode
+}
+
+# VRs whose values are not encoded, only flagged as available
+BINARY_VRS = frozenset(('OB', 'OD', 'OF', 'OL', 'OW', 'UN'))
+
+# Types of values that are never multi-valued, which spares the generic (and slower) check for most elements
+_SINGLE_VALUE_TYPES = (str, bytes, int, float)
+
+# JSON keys of the tags in the DICOM dictionary, e.g. 0x00080016 -> "00080016". Keys of other (private)
+# tags are added as they are encountered.
+TAG_KEYS = {tag: "{:08X}".format(tag) for tag in DicomDictionary}
+
+
+def get_tag_key(tag):
+
+    try:
+        return TAG_KEYS[tag]
+    except KeyError:
+        key = TAG_KEYS[tag] = "{:08X}".format(tag)
+        return key
+
+
+def encode_dicom_element(dicom_element):
+    """Creates the JSON Model Object representation of a DICOM element, as a plain dict. Produces the
+    same output as parser_utils.encode_element, which it replaces in the parsing path."""
+
+    vr = dicom_element.VR
+    value = dicom_element.value
+
+    if vr == 'SQ':
+        return {'vr': vr, 'Value': [encode_dataset(item) if item else None for item in value]}
+
+    if not isinstance(value, _SINGLE_VALUE_TYPES) and pydicom.dataelem.isMultiValue(value):
+
+        vals = []
+        encode = None
+
+        for val in value:
+            if val != '' and val is not None:
+                # Looked up on first use, so that unknown VRs only fail when they have a value to encode
+                if encode is None:
+                    encode = VR_ENCODERS[vr]
+                vals.append(encode(val))
+            else:
+                vals.append(None)
+
+        return {'vr': vr, 'Value': vals}
+
+    if type(value) == Dataset:
+        return {'vr': vr, 'Value': [encode_dataset(value)]}
+
+    # Numeric values of 0 need the second clause, as only empty strings should be left out
+    if value or (value != '' and value != b''):
+        return {'vr': vr, 'Value': [VR_ENCODERS[vr](value)]}
+
+    return {'vr': vr}
+
+
+def encode_dataset(dicom_dataset):
+    """Converts a DICOM dataset into its JSON Model Object representation, as a dict of plain dicts keyed
+    by tag. Produces the same JSON as parser_utils.parse_dicom_dataset, which it replaces in the parsing
+    path: the VR dispatch table and the tag keys are built once rather than per element, and no
+    OrderedDicts are allocated."""
+
+    dicom_dict = {}
+
+    for dicom_element in dicom_dataset:
+
+        tag = dicom_element.tag
+
+        try:
+            key = TAG_KEYS[tag]
+        except KeyError:
+            key = get_tag_key(tag)
+
+        if dicom_element.VR in BINARY_VRS:
+            dicom_dict[key] = {'vr': dicom_element.VR, 'Available': True}
+        else:
+            dicom_dict[key] = encode_dicom_element(dicom_element)
+
+    return dicom_dict
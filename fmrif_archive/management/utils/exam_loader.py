@@ -0,0 +1,433 @@
+import traceback
+
+from datetime import datetime
+from datetime import time as datetime_time
+from django.db import Error as DjangoDBError
+from django.db import transaction
+from psycopg2 import Error as PgError
+from pymongo import InsertOne, DESCENDING
+from pymongo.errors import PyMongoError
+from fmrif_archive.models import (
+    Exam,
+    MRScan,
+    FileCollection,
+    DICOMInstance,
+    File,
+)
+from fmrif_archive.management.utils.ge_private import get_ge_protocol_fields
+from fmrif_archive.management.utils.instance_copy import clean_integer_field, ECHO_NUMBER_MAX, SLICE_INDEX_MAX
+from fmrif_archive.management.utils.scan_geometry import SCAN_GEOMETRY_FIELDS
+from fmrif_archive.utils import parse_pn, get_fmrif_scanner
+
+
+# VRs whose values are stored as Base64 or nested JSON, which are not loaded into Mongo for querying
+MONGO_UNSUPPORTED_VRS = ('OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'SQ', 'UN')
+
+
+def _first_value(dicom_data, tag):
+    try:
+        return dicom_data[tag]['Value'][0]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def _parse_da(value):
+    try:
+        return datetime.strptime(value, '%Y%m%d').date()
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_tm(value):
+    try:
+        if "." in value:
+            return datetime.strptime(value, '%H%M%S.%f').time()
+        return datetime.strptime(value, '%H%M%S').time()
+    except (TypeError, ValueError):
+        return None
+
+
+def get_exam_fields(study_meta):
+    """The Exam model fields of a parsed study, derived as in load_parsed_studies. Raises KeyError if
+    the study is missing required metadata, and ValueError if no scan has DICOM metadata."""
+
+    metadata = study_meta['metadata']
+
+    dicom_data = None
+
+    for subdir in study_meta['data']:
+        if subdir.get('dicom_data', None):
+            dicom_data = subdir['dicom_data']
+            break
+
+    if not dicom_data:
+        raise ValueError("No DICOM metadata")
+
+    filepath = metadata['gold_fpath']
+
+    station_name = get_fmrif_scanner(_first_value(dicom_data, "00081010"))
+
+    if not station_name:
+        station_name = filepath.split("/")[0]
+
+    study_date = _parse_da(_first_value(dicom_data, "00080020"))
+
+    if not study_date:
+        study_date = _parse_da("".join(filepath.split("/")[1:4]))
+
+    try:
+        name = dicom_data["00100010"]['Value'][0]['Alphabetic']
+    except (KeyError, IndexError, TypeError):
+        name = None
+
+    name_fields = parse_pn(name) if name else None
+
+    return {
+        'exam_id': metadata['exam_id'],
+        'revision': 1,
+        'parser_version': metadata['parser_version'],
+        'filepath': filepath,
+        'checksum': metadata['gold_archive_checksum'],
+        'station_name': station_name,
+        'study_instance_uid': _first_value(dicom_data, "0020000D"),
+        'study_id': _first_value(dicom_data, "00200010"),
+        'study_date': study_date,
+        'study_time': _parse_tm(_first_value(dicom_data, "00080030")),
+        'study_description': _first_value(dicom_data, "00081030"),
+        'protocol': None,  # Not implemented yet
+        'accession_number': _first_value(dicom_data, "00080050"),
+        'name': name,
+        'last_name': name_fields['family_name'] if name_fields else None,
+        'first_name': name_fields['given_name'] if name_fields else None,
+        'patient_id': _first_value(dicom_data, "00100020"),
+        'sex': _first_value(dicom_data, "00100040"),
+        'birth_date': _parse_da(_first_value(dicom_data, "00100030")),
+    }
+
+
+def get_mr_scan_fields(scan_meta):
+    """The MRScan model fields of a parsed scan, including the DICOM metadata otherwise loaded by
+    load_scan_dicom_metadata. Raises KeyError if the scan is missing required metadata."""
+
+    scan_dicom_data = scan_meta['dicom_data']
+
+    scan_sequence = _first_value(scan_dicom_data, "0019109C")
+
+    if scan_sequence is None:
+        scan_sequence = _first_value(scan_dicom_data, "00180024")
+
+    geometry = scan_meta.get('geometry', None) or {}
+
+    fields = {
+        'name': scan_meta['metadata']['gold_scan_dir'],
+        'num_files': scan_meta['metadata']['num_files'],
+        'series_date': _parse_da(_first_value(scan_dicom_data, "00080021")),
+        'series_time': _parse_tm(_first_value(scan_dicom_data, "00080031")),
+        'series_description': _first_value(scan_dicom_data, "0008103E"),
+        'sop_class_uid': _first_value(scan_dicom_data, "00080016"),
+        'series_instance_uid': _first_value(scan_dicom_data, "0020000E"),
+        'series_number': _first_value(scan_dicom_data, "00200011"),
+        'scan_sequence': scan_sequence,
+        'dicom_metadata': scan_dicom_data,
+        'private_dicom_metadata': scan_meta.get('private_data', None),
+    }
+
+    fields.update((field, geometry.get(field, None)) for field in SCAN_GEOMETRY_FIELDS)
+
+    fields.update(get_ge_protocol_fields(fields['private_dicom_metadata']))
+
+    return fields
+
+
+def get_mongo_exam_doc(exam_fields):
+    """The exam document of the Mongo exam collection, as written by load_parsed_scans_mongo"""
+
+    study_datetime = datetime.combine(exam_fields['study_date'], exam_fields['study_time'] or datetime_time.min)
+
+    birth_date = exam_fields['birth_date']
+
+    return {
+        'exam_id': exam_fields['exam_id'],
+        'revision': exam_fields['revision'],
+        'parser_version': exam_fields['parser_version'],
+        'filepath': exam_fields['filepath'],
+        'checksum': exam_fields['checksum'],
+        'station_name': exam_fields['station_name'],
+        'study_instance_uid': exam_fields['study_instance_uid'],
+        'study_id': exam_fields['study_id'],
+        'study_datetime': study_datetime,
+        'study_description': exam_fields['study_description'],
+        'protocol': exam_fields['protocol'],
+        'accession_number': exam_fields['accession_number'],
+        'name': exam_fields['name'],
+        'last_name': exam_fields['last_name'],
+        'first_name': exam_fields['first_name'],
+        'patient_id': exam_fields['patient_id'],
+        'sex': exam_fields['sex'],
+        'birth_date': datetime.combine(birth_date, datetime_time.min) if birth_date else None,
+    }
+
+
+def get_mongo_tag_doc(parent_exam, tag, scan_name, attribute):
+    """A document of the Mongo tag collection. Raises AttributeError if a string value exceeds the
+    maximum indexable size."""
+
+    values = attribute.get('Value', None)
+
+    new_value = []
+
+    if values:
+
+        if attribute['vr'] == 'PN':
+
+            for val in values:
+
+                if type(val) == dict:
+                    new_value.append(val.get('Alphabetic', None))
+                elif type(val) == str:
+                    new_value.append(val)
+                else:
+                    new_value.append(None)
+
+        else:
+
+            new_value = [val for val in values]
+
+    # Mongo can only index strings shorter than 1024 bytes
+    for val in new_value:
+        if (type(val) == str) and (len(val) >= 1024):
+            raise AttributeError
+
+    return {
+        'parent_exam': parent_exam,
+        'tag': tag,
+        'value': new_value,
+        'scan_name': scan_name,
+    }
+
+
+def _parse_checksum_lines(checksum_lines):
+    """(filename, checksum) pairs of the non-README files in a scan's checksum lines"""
+
+    files = []
+
+    for line in checksum_lines:
+
+        checksum, filename = line.rstrip("\n").split("  ")
+        filename = filename.lstrip("./")
+
+        if "readme" not in filename.lower():
+            files.append((filename, checksum))
+
+    return files
+
+
+class ExamLoader:
+    """Loads parsed exams straight into the SQL database and Mongo, producing the same rows and documents
+    as running load_parsed_studies, load_scan_dicom_metadata, load_parsed_instances and
+    load_parsed_scans_mongo on the text files that parse_gold_data would otherwise have written.
+
+    Each exam is loaded in one transaction, with the rows of each model created in batches. The Mongo
+    documents are inserted last within the transaction, so that if they fail the SQL rows are rolled
+    back too and the exam can simply be loaded again. If the commit itself fails, the Mongo documents are
+    deleted."""
+
+    # Results of load. An exam already in the database needs no more work, unlike a failed one.
+    LOADED = 'loaded'
+    ALREADY_LOADED = 'already_loaded'
+    LOAD_FAILED = 'failed'
+
+    def __init__(self, mongo_client=None, mongo_database="image_archive", exam_collection="mr_exams",
+                 tag_collection="dicom_tags", batch_size=1000, log=None):
+
+        self.batch_size = batch_size
+        self.log = log
+
+        if mongo_client is not None:
+
+            db = mongo_client[mongo_database]
+
+            self.exam_collection = db.get_collection(exam_collection)
+            self.tag_collection = db.get_collection(tag_collection)
+
+            if not self.exam_collection.index_information().get('exam_uniqueness_constraint', None):
+                self.exam_collection.create_index([
+                    ('exam_id', DESCENDING),
+                    ('revision', DESCENDING),
+                ], unique=True, name="exam_uniqueness_constraint")
+
+        else:
+
+            self.exam_collection = None
+            self.tag_collection = None
+
+    def load(self, study_meta, scans):
+        """Loads one exam. scans is a list of (scan_name, instance_results, checksum_lines) tuples, as
+        written to the scan metadata and checksum files. Returns (result, message), result being one of
+        LOADED, ALREADY_LOADED or LOAD_FAILED."""
+
+        try:
+            exam_fields = get_exam_fields(study_meta)
+        except KeyError:
+            return self.LOAD_FAILED, "Required metadata field not available for exam {}".format(
+                study_meta['metadata'].get('gold_fpath', None))
+        except ValueError:
+            return self.LOAD_FAILED, "No DICOM metadata for exam {}".format(
+                study_meta['metadata'].get('gold_fpath', None))
+
+        if Exam.objects.filter(exam_id=exam_fields['exam_id'], revision=exam_fields['revision']).exists():
+            return self.ALREADY_LOADED, "Exam {} already has a database entry. Skipping.".format(
+                exam_fields['exam_id'])
+
+        scan_outputs = {scan_name: (instance_results, checksum_lines)
+                        for scan_name, instance_results, checksum_lines in scans}
+
+        new_exam_id = None
+
+        try:
+
+            with transaction.atomic():
+
+                exam = Exam.objects.create(**exam_fields)
+
+                mr_scans, file_collections = self._create_collections(exam, study_meta)
+
+                self._create_files(mr_scans, file_collections, scan_outputs)
+
+                new_exam_id = self._insert_mongo_docs(exam_fields, study_meta)
+
+        except (DjangoDBError, PgError, PyMongoError) as e:
+
+            if self.log:
+                self.log.error(traceback.format_exc())
+
+            # The Mongo documents were inserted, but the SQL transaction failed to commit
+            if new_exam_id is not None:
+                self._delete_mongo_docs(new_exam_id)
+
+            return self.LOAD_FAILED, "Unable to load exam {}: {}".format(exam_fields['filepath'], e)
+
+        return self.LOADED, "Loaded exam {}".format(exam_fields['filepath'])
+
+    def _create_collections(self, exam, study_meta):
+
+        mr_scans = []
+        file_collections = []
+
+        for subdir in study_meta['data']:
+
+            try:
+
+                if subdir.get('dicom_data', None):
+                    mr_scans.append(MRScan(parent_exam=exam, **get_mr_scan_fields(subdir)))
+                else:
+                    file_collections.append(FileCollection(
+                        parent_exam=exam,
+                        name=subdir['metadata']['gold_scan_dir'],
+                        num_files=subdir['metadata']['num_files']
+                    ))
+
+            except KeyError:
+
+                if self.log:
+                    self.log.error("Missing mandatory scan metadata, omitting scan from exam {}".format(
+                        exam.filepath))
+
+        # Primary keys are only set on the created objects by bulk_create with PostgreSQL
+        mr_scans = MRScan.objects.bulk_create(mr_scans, batch_size=self.batch_size)
+        file_collections = FileCollection.objects.bulk_create(file_collections, batch_size=self.batch_size)
+
+        return mr_scans, file_collections
+
+    def _create_files(self, mr_scans, file_collections, scan_outputs):
+
+        dicom_instances = []
+
+        for mr_scan in mr_scans:
+
+            instance_results, checksum_lines = scan_outputs.get(mr_scan.name, (None, []))
+
+            instances_meta = dict(
+                (fname.lstrip("./"), meta) for fname, meta in instance_results or []
+                if "readme" not in fname.lower()
+            )
+
+            for filename, checksum in _parse_checksum_lines(checksum_lines):
+
+                meta = instances_meta.get(filename, None) or {}
+
+                dicom_instances.append(DICOMInstance(
+                    parent_scan=mr_scan,
+                    file_type='dicom',
+                    filename=filename,
+                    checksum=checksum,
+                    echo_number=clean_integer_field(meta.get('echo_number', None), ECHO_NUMBER_MAX),
+                    sop_instance_uid=meta.get('sop_instance_uid', None),
+                    slice_index=clean_integer_field(meta.get('raw_data_run_number', None), SLICE_INDEX_MAX),
+                    image_position_patient=meta.get('image_position_patient', None),
+                    header_delta=meta.get('header_delta', None)
+                ))
+
+        DICOMInstance.objects.bulk_create(dicom_instances, batch_size=self.batch_size)
+
+        files = []
+
+        for file_collection in file_collections:
+
+            _, checksum_lines = scan_outputs.get(file_collection.name, (None, []))
+
+            for filename, checksum in _parse_checksum_lines(checksum_lines):
+
+                files.append(File(
+                    parent_collection=file_collection,
+                    file_type='other',
+                    filename=filename,
+                    checksum=checksum
+                ))
+
+        File.objects.bulk_create(files, batch_size=self.batch_size)
+
+    def _insert_mongo_docs(self, exam_fields, study_meta):
+        """Inserts the exam and tag documents of an exam, returning the id of the exam document (None
+        without Mongo). Nothing is left behind if the insertion fails."""
+
+        if self.exam_collection is None:
+            return None
+
+        new_exam_id = self.exam_collection.insert_one(get_mongo_exam_doc(exam_fields)).inserted_id
+
+        tags_to_create = []
+
+        for scan in study_meta['data']:
+
+            if not scan.get('dicom_data', None):
+                continue
+
+            scan_name = scan['metadata']['gold_scan_dir']
+
+            for tag, attr in scan['dicom_data'].items():
+
+                if attr.get('vr', None) in (None,) + MONGO_UNSUPPORTED_VRS:
+                    continue
+
+                try:
+                    tags_to_create.append(InsertOne(get_mongo_tag_doc(new_exam_id, tag, scan_name, attr)))
+                except AttributeError:
+                    if self.log:
+                        self.log.warning("Attribute value exceeds indexable size. Skipping tag {} in scan "
+                                         "{} of exam {}".format(tag, scan_name, exam_fields['filepath']))
+
+        try:
+            if tags_to_create:
+                self.tag_collection.bulk_write(tags_to_create)
+        except PyMongoError:
+            # Don't leave an exam document, or the tags written before the failure (the bulk write is ordered),
+            # behind when the SQL transaction is rolled back
+            self._delete_mongo_docs(new_exam_id)
+            raise
+
+        return new_exam_id
+
+    def _delete_mongo_docs(self, new_exam_id):
+        self.tag_collection.delete_many({'parent_exam': new_exam_id})
+        self.exam_collection.delete_one({'_id': new_exam_id})
@@ -0,0 +1,127 @@
+import os
+
+from pathlib import Path
+from threading import Condition
+
+
+def get_tree_size(path):
+    """Total size in bytes of the files under a directory"""
+
+    total = 0
+
+    stack = [str(path)]
+
+    while stack:
+
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+
+    return total
+
+
+def get_archive_scanner(compressed_file):
+    """The scanner of a Gold archive, from its <scanner>/YYYY/MM/DD/<subdir>/<archive>.tgz path"""
+    return Path(compressed_file).parents[4].name
+
+
+class ExtractionBudget:
+    """Admits archives for extraction against a budget of bytes of work directory space.
+
+    The space an archive will take once extracted is estimated from its compressed size and an expansion
+    ratio learned for its scanner, as an exponential moving average of the ratios observed for the
+    archives of that scanner extracted so far. Space is reserved when an archive is admitted, adjusted
+    to the actual extracted size once known, and released when the extracted files are cleaned up.
+
+    An archive larger than the whole budget is still admitted when nothing else is reserved, so that it
+    can be processed on its own instead of blocking the run."""
+
+    def __init__(self, budget_bytes, default_ratio=3.0, smoothing=0.3, safety_factor=1.1):
+
+        self.budget_bytes = budget_bytes
+        self.default_ratio = default_ratio
+        self.smoothing = smoothing
+        self.safety_factor = safety_factor
+
+        self.ratios = {}
+        self.reserved = {}
+
+        self.condition = Condition()
+
+    @property
+    def used_bytes(self):
+        return sum(self.reserved.values())
+
+    def estimate(self, compressed_file):
+
+        scanner = get_archive_scanner(compressed_file)
+
+        ratio = self.ratios.get(scanner, self.default_ratio)
+
+        return int(Path(compressed_file).stat().st_size * ratio * self.safety_factor)
+
+    def _fits(self, num_bytes):
+        return not self.reserved or self.used_bytes + num_bytes <= self.budget_bytes
+
+    def try_acquire(self, compressed_file):
+        """Reserves space for an archive if it fits in the budget. Returns whether it was admitted."""
+
+        num_bytes = self.estimate(compressed_file)
+
+        with self.condition:
+
+            if not self._fits(num_bytes):
+                return False
+
+            self.reserved[str(compressed_file)] = num_bytes
+
+            return True
+
+    def acquire(self, compressed_file):
+        """Reserves space for an archive, waiting for other archives to be released until it fits"""
+
+        num_bytes = self.estimate(compressed_file)
+
+        with self.condition:
+
+            self.condition.wait_for(lambda: self._fits(num_bytes))
+
+            self.reserved[str(compressed_file)] = num_bytes
+
+    def observe(self, compressed_file, extracted_bytes):
+        """Records the actual extracted size of an archive, updating its reservation and the expansion
+        ratio of its scanner"""
+
+        compressed_bytes = Path(compressed_file).stat().st_size
+
+        scanner = get_archive_scanner(compressed_file)
+
+        with self.condition:
+
+            if compressed_bytes:
+
+                ratio = extracted_bytes / compressed_bytes
+
+                if scanner in self.ratios:
+                    self.ratios[scanner] = (1 - self.smoothing) * self.ratios[scanner] + self.smoothing * ratio
+                else:
+                    self.ratios[scanner] = ratio
+
+            if str(compressed_file) in self.reserved:
+                self.reserved[str(compressed_file)] = extracted_bytes
+
+            self.condition.notify_all()
+
+    def release(self, compressed_file):
+
+        with self.condition:
+
+            self.reserved.pop(str(compressed_file), None)
+
+            self.condition.notify_all()
@@ -0,0 +1,163 @@
+import math
+import zlib
+
+from collections import OrderedDict
+
+
+# Largest decompressed size of a GE (0025,101B) protocol data block that is decoded. The blocks are a few
+# KB, so anything larger is treated as corrupt rather than decompressed into memory.
+GE_PRIVATE_MAX_BYTES = 1 << 20
+
+_CHUNK_SIZE = 16384
+
+# Keys of the GE protocol data block stored as MRScan fields, by field: the candidate keys (matched
+# case-insensitively, in order) and the type of the field
+GE_PROTOCOL_FIELDS = OrderedDict([
+    ('b_value', {'keys': ('BVALUE', 'BVAL'), 'type': float}),
+    ('num_diffusion_directions', {'keys': ('DIFFNUMDIRS', 'NUMDIRS', 'NUM_DIRS'), 'type': int}),
+    ('diffusion_tensor', {'keys': ('TENSOR',), 'type': int}),
+    ('multiband_factor', {'keys': ('MBACCEL', 'MBFACTOR'), 'type': int}),
+])
+
+
+class GEPrivateDataError(ValueError):
+    pass
+
+
+def _parse_number(text):
+
+    try:
+        return int(text)
+    except ValueError:
+        pass
+
+    value = float(text)
+
+    # NaN and infinity can't be stored as JSON
+    if not math.isfinite(value):
+        raise ValueError("Non-finite value {}".format(text))
+
+    return value
+
+
+def parse_ge_value(text):
+    """Converts a value of the GE protocol data block to a number, a list of numbers if it is made of
+    several, or otherwise a string (without quotes)"""
+
+    value = text.replace('"', '').strip()
+
+    try:
+        return _parse_number(value)
+    except ValueError:
+        pass
+
+    tokens = value.split()
+
+    if len(tokens) > 1:
+        try:
+            return [_parse_number(t) for t in tokens]
+        except ValueError:
+            pass
+
+    return value
+
+
+def _add_line(private_dat, line):
+
+    try:
+        line = line.decode('ascii').strip()
+    except UnicodeDecodeError:
+        raise GEPrivateDataError("Protocol data block is not ASCII")
+
+    if not line:
+        return
+
+    key, _, value = line.partition(" ")
+
+    private_dat[key.strip()] = parse_ge_value(value)
+
+
+def decode_ge_private_data(byte_seq, max_bytes=GE_PRIVATE_MAX_BYTES):
+    """Decodes the protocol data block in the (0x0025, 0x101B) field of GE scans, which contains useful
+    metadata for DTI scans: padding bytes followed by a gzip-compressed list of "key value" lines. The
+    block is decompressed and parsed a chunk at a time, and at most max_bytes are decompressed.
+
+    Returns an OrderedDict of the typed values (see parse_ge_value) by key. Raises GEPrivateDataError if
+    the block can't be decoded."""
+
+    # Find the beginning of the GZIP sequence, and drop the padding bytes before it
+    pos = byte_seq.find(b"\x1f\x8b")
+
+    if pos == -1:
+        raise GEPrivateDataError("No gzip data in protocol data block")
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    data = byte_seq[pos:]
+
+    private_dat = OrderedDict()
+
+    remainder = b""
+    total_bytes = 0
+
+    try:
+
+        while not decompressor.eof:
+
+            chunk = decompressor.decompress(data, _CHUNK_SIZE)
+            data = decompressor.unconsumed_tail
+
+            if not chunk and not data:
+                break
+
+            total_bytes += len(chunk)
+
+            if total_bytes > max_bytes:
+                raise GEPrivateDataError("Protocol data block exceeds {} bytes".format(max_bytes))
+
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+
+            for line in lines:
+                _add_line(private_dat, line)
+
+    except zlib.error as e:
+        raise GEPrivateDataError("Corrupt gzip data in protocol data block: {}".format(e))
+
+    if not decompressor.eof:
+        raise GEPrivateDataError("Truncated gzip data in protocol data block")
+
+    _add_line(private_dat, remainder)
+
+    return private_dat
+
+
+def get_ge_protocol_fields(private_data):
+    """The values of the GE_PROTOCOL_FIELDS of a scan, from its parsed private data (None for the fields
+    missing from the protocol data block, or for scans without one)"""
+
+    fields = OrderedDict((field, None) for field in GE_PROTOCOL_FIELDS)
+
+    data = private_data.get('data', None) if private_data else None
+
+    # Siemens private data holds a CSA header rather than a protocol data block
+    if not data or 'tags' in data:
+        return fields
+
+    keys = {key.upper(): key for key in data}
+
+    for field, spec in GE_PROTOCOL_FIELDS.items():
+
+        for key in spec['keys']:
+
+            if key not in keys:
+                continue
+
+            try:
+                fields[field] = spec['type'](data[keys[key]])
+            except (TypeError, ValueError):
+                pass
+
+            break
+
+    return fields
@@ -0,0 +1,88 @@
+import os
+import rapidjson as json
+
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+
+
+# Stages an archive goes through, in order. An archive is complete once it reaches the last one.
+JOURNAL_STAGES = (
+    'extracted',  # Archive fully extracted into the work directory
+    'parsed',  # Study, scan metadata and checksum files written
+    'cleaned',  # Extracted files removed from the work directory
+)
+
+
+class IngestJournal:
+    """Append-only record of the stages completed for each archive during a parse_gold_data run, kept in
+    the work directory so that an interrupted run can be resumed with the same work directory.
+
+    Each record is a JSON line that is flushed and fsync'ed before the stage is considered complete. A
+    partially written last line (from a crash mid-write) is ignored when the journal is loaded."""
+
+    def __init__(self, work_dir, fname="ingest_journal.jsonl"):
+
+        self.fpath = Path(work_dir) / fname
+        self.lock = Lock()
+
+        # exam_id -> last completed stage
+        self.stages = {}
+
+        if self.fpath.is_file():
+            self._load()
+
+        self.outfile = open(str(self.fpath), "at")
+
+    def _load(self):
+
+        with open(str(self.fpath), "rt") as infile:
+
+            for line in infile:
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+
+                exam_id = record.get('exam_id', None)
+                stage = record.get('stage', None)
+
+                # The latest record wins, as an archive may be restarted from scratch after a crash
+                if exam_id and stage in JOURNAL_STAGES:
+                    self.stages[exam_id] = stage
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.outfile.close()
+
+    def record(self, compressed_file, exam_id, stage):
+
+        record = {
+            'archive': str(compressed_file),
+            'exam_id': exam_id,
+            'stage': stage,
+            'time': datetime.now().isoformat(),
+        }
+
+        with self.lock:
+
+            self.outfile.write(json.dumps(record) + "\n")
+            self.outfile.flush()
+            os.fsync(self.outfile.fileno())
+
+            self.stages[exam_id] = stage
+
+    def last_stage(self, exam_id):
+        """The last stage completed for an exam, or None if no work was recorded for it"""
+        return self.stages.get(exam_id, None)
+
+    def is_complete(self, exam_id):
+        """Whether an exam went through every stage, i.e. needs no more work"""
+        return self.stages.get(exam_id, None) == JOURNAL_STAGES[-1]
@@ -0,0 +1,221 @@
+import rapidjson as json
+import statistics
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+
+
+# Stages of a parse_gold_data run, in the order they are reported
+INGEST_STAGES = (
+    'discovery',  # Walking the Gold directory tree for archives
+    'hashing',  # Checksumming the archives to get their exam ids
+    'extraction',  # Decompressing the archives (into the work directory, or in memory when streaming)
+    'header_parsing',  # Reading the DICOM headers of the instances
+    'checksum',  # Checksumming the extracted files
+    'cleanup',  # Removing the extracted files from the work directory
+    'load',  # Loading the parsed exams into the databases, with --load
+)
+
+
+class IngestMetrics:
+    """Timings and counters of each stage of a parse_gold_data run, written as a JSON-lines run report.
+
+    Work is recorded per archive as it completes, each record being written to the report straight away
+    so that it survives a crash. Since stages overlap (e.g. when pipelining, or with several workers), a
+    stage's wall time is the span from the start of its first record to the end of its last, while its
+    busy time is the sum of the durations of its records. summarize() appends a summary line for every
+    stage, and a line for each per-archive outlier, i.e. archives that took more than outlier_factor times
+    the median time of the stage.
+
+    Failures that don't stop an archive from being parsed (e.g. undecodable GE private data) are recorded
+    as events, each written to the report as it happens, and counted in a summary line per event."""
+
+    def __init__(self, fpath, outlier_factor=3.0, max_outliers=10):
+
+        self.fpath = fpath
+        self.outlier_factor = outlier_factor
+        self.max_outliers = max_outliers
+
+        self.lock = Lock()
+
+        self.stages = OrderedDict((stage, self._new_stage()) for stage in INGEST_STAGES)
+        self.events = OrderedDict()
+
+        self.outfile = open(str(fpath), "at")
+
+    @staticmethod
+    def _new_stage():
+        return {
+            'start': None,
+            'end': None,
+            'busy_time': 0.0,
+            'files': 0,
+            'bytes': 0,
+            'archives': [],
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.outfile.close()
+
+    def _write(self, record):
+        self.outfile.write(json.dumps(record) + "\n")
+        self.outfile.flush()
+
+    def record(self, stage, start, end, files=0, num_bytes=0, archive=None, busy_time=None):
+        """Records work done in a stage between start and end (time.time() values). busy_time defaults to
+        end - start, but can be given for work spread over several workers."""
+
+        busy_time = end - start if busy_time is None else busy_time
+
+        with self.lock:
+
+            stats = self.stages.setdefault(stage, self._new_stage())
+
+            stats['start'] = start if stats['start'] is None else min(stats['start'], start)
+            stats['end'] = end if stats['end'] is None else max(stats['end'], end)
+            stats['busy_time'] += busy_time
+            stats['files'] += files
+            stats['bytes'] += num_bytes
+
+            if archive is not None:
+
+                stats['archives'].append((str(archive), busy_time))
+
+                self._write({
+                    'type': 'archive',
+                    'stage': stage,
+                    'archive': str(archive),
+                    'seconds': round(busy_time, 4),
+                    'files': files,
+                    'bytes': num_bytes,
+                    'time': datetime.now().isoformat(),
+                })
+
+    def record_event(self, event, archive=None, detail=None):
+        """Records an occurrence of an event, e.g. a failure to decode part of an archive"""
+
+        with self.lock:
+
+            self.events[event] = self.events.get(event, 0) + 1
+
+            self._write({
+                'type': 'event',
+                'event': event,
+                'archive': str(archive) if archive is not None else None,
+                'detail': detail,
+                'time': datetime.now().isoformat(),
+            })
+
+    def timed(self, stage, iterable, num_bytes=None):
+        """Yields the items of iterable, recording the stage as running until it is exhausted, with one
+        file per item. num_bytes, if given, is a function returning the bytes of an item.
+
+        The busy time of the stage only counts the time spent producing the items, not the time spent
+        suspended while the consumer works on them, so that a lazy iterable (e.g. walk_gold_archives
+        feeding the checksum pool) is timed on its own."""
+
+        iterator = iter(iterable)
+
+        start = time.time()
+        busy_time = 0.0
+
+        files = 0
+        total_bytes = 0
+
+        while True:
+
+            item_start = time.perf_counter()
+
+            try:
+                item = next(iterator)
+            except StopIteration:
+                busy_time += time.perf_counter() - item_start
+                break
+
+            busy_time += time.perf_counter() - item_start
+
+            files += 1
+
+            if num_bytes:
+                total_bytes += num_bytes(item)
+
+            yield item
+
+        self.record(stage, start, time.time(), files=files, num_bytes=total_bytes, busy_time=busy_time)
+
+    def summarize(self, log=None):
+
+        with self.lock:
+
+            for stage, stats in self.stages.items():
+
+                if stats['start'] is None:
+                    continue
+
+                wall_time = stats['end'] - stats['start']
+
+                summary = {
+                    'type': 'stage',
+                    'stage': stage,
+                    'wall_time': round(wall_time, 4),
+                    'busy_time': round(stats['busy_time'], 4),
+                    'files': stats['files'],
+                    'bytes': stats['bytes'],
+                    'archives': len(stats['archives']),
+                    'files_per_sec': round(stats['files'] / wall_time, 3) if wall_time else None,
+                    'mb_per_sec': round(stats['bytes'] / wall_time / 1e6, 3) if wall_time else None,
+                }
+
+                self._write(summary)
+
+                if log:
+                    log.info("Stage {}: {:.1f}s wall, {:.1f}s busy, {} files ({} files/s), {:.1f} MB "
+                             "({} MB/s)".format(stage, wall_time, stats['busy_time'], stats['files'],
+                                                summary['files_per_sec'], stats['bytes'] / 1e6,
+                                                summary['mb_per_sec']))
+
+                if len(stats['archives']) < 2:
+                    continue
+
+                median = statistics.median(seconds for _, seconds in stats['archives'])
+
+                outliers = sorted(
+                    [(archive, seconds) for archive, seconds in stats['archives']
+                     if seconds > self.outlier_factor * median],
+                    key=lambda a: a[1],
+                    reverse=True
+                )
+
+                for archive, seconds in outliers[:self.max_outliers]:
+
+                    self._write({
+                        'type': 'outlier',
+                        'stage': stage,
+                        'archive': archive,
+                        'seconds': round(seconds, 4),
+                        'median_seconds': round(median, 4),
+                    })
+
+                    if log:
+                        log.warning("Stage {}: archive {} took {:.1f}s (median {:.1f}s)".format(
+                            stage, archive, seconds, median))
+
+            for event, count in self.events.items():
+
+                self._write({
+                    'type': 'event_count',
+                    'event': event,
+                    'count': count,
+                })
+
+                if log:
+                    log.warning("Event {}: {} occurrences".format(event, count))
@@ -0,0 +1,62 @@
+import traceback
+
+from queue import Queue
+from threading import Thread
+
+
+# Marks the end of the batches flowing through the pipeline
+_PIPELINE_DONE = object()
+
+
+def _run_stage(name, func, in_queue, out_queue, log):
+
+    while True:
+
+        batch = in_queue.get()
+
+        if batch is _PIPELINE_DONE:
+            if out_queue is not None:
+                out_queue.put(_PIPELINE_DONE)
+            return
+
+        try:
+            result = func(batch)
+        except Exception as e:
+            result = None
+            if log:
+                log.error("Pipeline stage '{}' failed: {}".format(name, e))
+                log.error(traceback.format_exc())
+
+        # A stage returns None to drop the batch instead of handing it on
+        if result is not None and out_queue is not None:
+            out_queue.put(result)
+
+
+def run_batch_pipeline(batches, stages, log=None):
+    """Runs batches through a sequence of stages, each in its own thread, so that different batches can
+    be in different stages at the same time (e.g. batch N+1 is extracted while batch N is parsed).
+
+    stages is a list of (name, func, queue_depth) tuples. queue_depth bounds the number of batches
+    waiting to enter that stage; when a queue is full, the previous stage (or the feeder, for the first
+    stage) blocks until there is room, which bounds the work directory usage of extracted batches."""
+
+    queues = [Queue(maxsize=max(1, queue_depth)) for _, _, queue_depth in stages]
+
+    threads = []
+
+    for i, (name, func, _) in enumerate(stages):
+
+        out_queue = queues[i + 1] if i + 1 < len(queues) else None
+
+        thread = Thread(target=_run_stage, args=(name, func, queues[i], out_queue, log), daemon=True)
+        thread.start()
+
+        threads.append(thread)
+
+    for batch in batches:
+        queues[0].put(batch)
+
+    queues[0].put(_PIPELINE_DONE)
+
+    for thread in threads:
+        thread.join()
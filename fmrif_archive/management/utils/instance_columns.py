@@ -0,0 +1,149 @@
+import numpy as np
+import struct
+import zipfile
+
+from pathlib import Path
+from pydicom.tag import Tag
+
+from fmrif_archive.management.utils.dicom_json import encode_dicom_element
+
+
+# Per-instance attributes stored as columns, with the dtype and number of values of each. Missing values
+# are NaN for floats and -1 for integers.
+INSTANCE_COLUMNS = [
+    {'key': 'instance_number', 'tag': (0x0020, 0x0013), 'dtype': 'i4', 'width': 1},
+    {'key': 'image_position_patient', 'tag': (0x0020, 0x0032), 'dtype': 'f8', 'width': 3},
+    {'key': 'image_orientation_patient', 'tag': (0x0020, 0x0037), 'dtype': 'f8', 'width': 6},
+    {'key': 'slice_location', 'tag': (0x0020, 0x1041), 'dtype': 'f8', 'width': 1},
+    {'key': 'slice_thickness', 'tag': (0x0018, 0x0050), 'dtype': 'f8', 'width': 1},
+    {'key': 'acquisition_time', 'tag': (0x0008, 0x0032), 'dtype': 'f8', 'width': 1},  # Seconds since midnight
+    {'key': 'echo_time', 'tag': (0x0018, 0x0081), 'dtype': 'f8', 'width': 1},
+    {'key': 'echo_number', 'tag': (0x0018, 0x0086), 'dtype': 'i4', 'width': 1},
+    {'key': 'slice_index', 'tag': (0x0019, 0x10A2), 'dtype': 'i4', 'width': 1},  # GE raw data run number
+]
+
+COLUMN_TAGS = [Tag(*c['tag']) for c in INSTANCE_COLUMNS]
+
+# Local file header of a ZIP member: 30 fixed bytes, ending with the lengths of the name and extra field
+_ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def _tm_to_seconds(tm):
+    """Converts a DICOM TM value (HHMMSS.FFFFFF, with optional components) to seconds since midnight"""
+
+    tm = tm.replace(":", "").strip()
+
+    seconds = 0.0
+
+    for i, scale in enumerate((3600, 60)):
+        if len(tm) >= 2 * (i + 1):
+            seconds += int(tm[2 * i:2 * (i + 1)]) * scale
+
+    if len(tm) > 4:
+        seconds += float(tm[4:])
+
+    return seconds
+
+
+def get_instance_columns(dicom_dataset):
+    """Collects the values of INSTANCE_COLUMNS from the header of an instance, as a dict of scalars (or
+    lists, for multi-valued attributes), with None for missing or unreadable values"""
+
+    columns = {}
+
+    for column in INSTANCE_COLUMNS:
+
+        try:
+
+            values = encode_dicom_element(dicom_dataset[column['tag']])['Value']
+
+            if column['key'] == 'acquisition_time':
+                values = [_tm_to_seconds(v) for v in values]
+
+            columns[column['key']] = values if column['width'] > 1 else values[0]
+
+        except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+            columns[column['key']] = None
+
+    return columns
+
+
+def get_column_arrays(instance_columns):
+    """Builds the column arrays of the instances of a scan, given as a list of (filename, columns) pairs as
+    returned by get_instance_columns (columns being None for unreadable instances): one array per attribute,
+    plus the filenames"""
+
+    num_instances = len(instance_columns)
+
+    arrays = {'filename': np.array([fname for fname, _ in instance_columns], dtype=np.str_)}
+
+    for column in INSTANCE_COLUMNS:
+
+        shape = (num_instances, column['width']) if column['width'] > 1 else (num_instances,)
+        fill = np.nan if column['dtype'].startswith('f') else -1
+
+        array = np.full(shape, fill, dtype=column['dtype'])
+
+        for i, (_, columns) in enumerate(instance_columns):
+
+            value = columns.get(column['key']) if columns else None
+
+            if value is None:
+                continue
+
+            if column['width'] > 1 and len(value) != column['width']:
+                continue
+
+            array[i] = value
+
+        arrays[column['key']] = array
+
+    return arrays
+
+
+def write_scan_columns(fpath, arrays):
+    """Writes the column arrays of a scan to an uncompressed .npz file"""
+
+    with open(str(fpath), "wb") as outfile:
+        np.savez(outfile, **arrays)
+
+
+def load_scan_columns(fpath, mmap=True):
+    """Reads a file written by write_scan_columns into a dict of arrays. With mmap, the arrays are
+    memory-mapped from the file instead of being read into memory (np.load does not memory-map the
+    members of .npz files, so their offsets are found from the ZIP headers)."""
+
+    if not mmap:
+        with np.load(str(fpath)) as npz:
+            return {key: npz[key] for key in npz.files}
+
+    columns = {}
+
+    with zipfile.ZipFile(str(fpath)) as zf, open(str(fpath), "rb") as infile:
+
+        for info in zf.infolist():
+
+            key = Path(info.filename).stem
+
+            infile.seek(info.header_offset)
+
+            name_len, extra_len = struct.unpack("<HH", infile.read(_ZIP_LOCAL_HEADER_SIZE)[26:30])
+
+            infile.seek(info.header_offset + _ZIP_LOCAL_HEADER_SIZE + name_len + extra_len)
+
+            version = np.lib.format.read_magic(infile)
+
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(infile)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(infile)
+
+            if info.compress_type != zipfile.ZIP_STORED or dtype.hasobject or not int(np.prod(shape)):
+                with zf.open(info) as member:
+                    columns[key] = np.lib.format.read_array(member)
+                continue
+
+            columns[key] = np.memmap(str(fpath), dtype=dtype, mode='r', offset=infile.tell(), shape=shape,
+                                     order='F' if fortran_order else 'C')
+
+    return columns
@@ -0,0 +1,222 @@
+import re
+
+from fmrif_archive.models import DICOMInstance, File
+
+
+# Staging tables for the COPY loaders. They are temporary tables of the database session, emptied at the end of
+# each transaction, so they have to be loaded within a transaction.
+DICOM_INSTANCE_STAGING_SCHEMA = (
+    """
+    CREATE TEMPORARY TABLE IF NOT EXISTS dicominstance_checksum_staging (
+        parent_scan_id INTEGER NOT NULL,
+        filename VARCHAR(255) NOT NULL,
+        checksum VARCHAR(32)
+    ) ON COMMIT DELETE ROWS
+    """,
+    """
+    CREATE TEMPORARY TABLE IF NOT EXISTS dicominstance_metadata_staging (
+        parent_scan_id INTEGER NOT NULL,
+        filename VARCHAR(255) NOT NULL,
+        metadata JSONB
+    ) ON COMMIT DELETE ROWS
+    """,
+)
+
+FILE_STAGING_SCHEMA = (
+    """
+    CREATE TEMPORARY TABLE IF NOT EXISTS file_checksum_staging (
+        parent_collection_id INTEGER NOT NULL,
+        filename VARCHAR(255) NOT NULL,
+        checksum VARCHAR(32)
+    ) ON COMMIT DELETE ROWS
+    """,
+)
+
+
+# Largest values of the integer fields of DICOMInstance (PositiveSmallIntegerField and PositiveIntegerField)
+ECHO_NUMBER_MAX = 32767
+SLICE_INDEX_MAX = 2147483647
+
+
+def clean_integer_field(value, max_value):
+    """An integer field of the instance metadata, or None if it is not a non-negative integer up to max_value,
+    e.g. "1.0" is taken but "", "1.5" or "abc" are not. All loaders store instances by these rules, which
+    _integer_field_sql applies in the database."""
+
+    if value is None or isinstance(value, bool):
+        return None
+
+    match = re.fullmatch(r'([0-9]+)(\.0*)?', str(value))
+
+    if not match:
+        return None
+
+    value = int(match.group(1))
+
+    return value if value <= max_value else None
+
+
+def _integer_field_sql(key, cast, max_value):
+    """SQL extracting an integer field of the instance metadata as clean_integer_field does, as NULL rather
+    than failing the whole insert"""
+
+    value = "(m.metadata->>'{}')".format(key)
+
+    return ("CASE WHEN {value} ~ '^[0-9]+(\\.0*)?$' THEN "
+            "CASE WHEN {value}::numeric <= {max_value} THEN {value}::numeric::{cast} END END").format(
+        value=value, cast=cast, max_value=max_value)
+
+
+# The fields of the instances are extracted from their metadata in the database, as the loader of
+# load_parsed_instances does in Python. Instances already in the table, with the same scan, filename and
+# checksum, are skipped, as are repeated filenames within a scan, and rows conflicting with the unique
+# constraint of the table (e.g. from a concurrent load).
+DICOM_INSTANCE_INSERT = """
+INSERT INTO {table} (parent_scan_id, file_type, filename, checksum, echo_number, sop_instance_uid, slice_index,
+                     image_position_patient, header_delta)
+SELECT DISTINCT ON (c.parent_scan_id, c.filename) c.parent_scan_id, 'dicom', c.filename, c.checksum,
+       {echo_number},
+       m.metadata->>'sop_instance_uid',
+       {slice_index},
+       NULLIF(m.metadata->'image_position_patient', 'null'::jsonb),
+       NULLIF(m.metadata->'header_delta', 'null'::jsonb)
+FROM dicominstance_checksum_staging c
+LEFT JOIN dicominstance_metadata_staging m ON m.parent_scan_id = c.parent_scan_id AND m.filename = c.filename
+WHERE NOT EXISTS (
+    SELECT 1 FROM {table} d
+    WHERE d.parent_scan_id = c.parent_scan_id AND d.filename = c.filename
+    AND d.checksum IS NOT DISTINCT FROM c.checksum
+)
+ORDER BY c.parent_scan_id, c.filename
+ON CONFLICT DO NOTHING
+"""
+
+FILE_INSERT = """
+INSERT INTO {table} (parent_collection_id, file_type, filename, checksum)
+SELECT DISTINCT ON (c.parent_collection_id, c.filename) c.parent_collection_id, 'other', c.filename, c.checksum
+FROM file_checksum_staging c
+WHERE NOT EXISTS (
+    SELECT 1 FROM {table} f
+    WHERE f.parent_collection_id = c.parent_collection_id AND f.filename = c.filename
+    AND f.checksum IS NOT DISTINCT FROM c.checksum
+)
+ORDER BY c.parent_collection_id, c.filename
+ON CONFLICT DO NOTHING
+"""
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _copy_row(*values):
+    """A row of the text format of COPY, with None as NULL"""
+
+    return "\t".join("\\N" if value is None else str(value).translate(_COPY_ESCAPES) for value in values) + "\n"
+
+
+class _CopyStream:
+    """Read-only file-like object over an iterable of lines, for copy_expert to stream rows without the
+    whole input being held in memory"""
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = ""
+
+    def read(self, size=-1):
+
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                break
+
+        if size < 0:
+            size = len(self.buffer)
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def _checksum_rows(parent_id, checksum_file):
+
+    with open(str(checksum_file), "rt") as checksums:
+
+        for line in checksums:
+
+            checksum, filename = line.rstrip("\n").split("  ")
+            filename = filename.lstrip("./")
+
+            if "readme" not in filename.lower():
+                yield _copy_row(parent_id, filename, checksum)
+
+
+def _metadata_rows(parent_id, metadata_file):
+
+    with open(str(metadata_file), "rt") as meta_file:
+
+        for line in meta_file:
+
+            filename, instance_meta = line.rstrip("\n").split("\t")
+            filename = filename.lstrip("./")
+
+            if "readme" not in filename.lower():
+                yield _copy_row(parent_id, filename, instance_meta)
+
+
+def copy_dicom_instances(cursor, scans):
+    """Loads the DICOMInstance rows of scans, given as (MRScan id, checksum file, metadata file) tuples, by
+    streaming the files into staging tables with COPY and inserting the new instances from there in one
+    statement. Requires PostgreSQL and an open transaction.
+
+    Returns the number of rows inserted."""
+
+    scans = list(scans)
+
+    for statement in DICOM_INSTANCE_STAGING_SCHEMA:
+        cursor.execute(statement)
+
+    cursor.execute("TRUNCATE dicominstance_checksum_staging, dicominstance_metadata_staging")
+
+    cursor.copy_expert(
+        "COPY dicominstance_checksum_staging (parent_scan_id, filename, checksum) FROM STDIN",
+        _CopyStream(row for scan_id, checksum_file, _ in scans for row in _checksum_rows(scan_id, checksum_file))
+    )
+
+    cursor.copy_expert(
+        "COPY dicominstance_metadata_staging (parent_scan_id, filename, metadata) FROM STDIN",
+        _CopyStream(row for scan_id, _, metadata_file in scans for row in _metadata_rows(scan_id, metadata_file))
+    )
+
+    cursor.execute("ANALYZE dicominstance_checksum_staging")
+    cursor.execute("ANALYZE dicominstance_metadata_staging")
+
+    cursor.execute(DICOM_INSTANCE_INSERT.format(
+        table=DICOMInstance._meta.db_table,
+        echo_number=_integer_field_sql('echo_number', 'smallint', ECHO_NUMBER_MAX),
+        slice_index=_integer_field_sql('raw_data_run_number', 'integer', SLICE_INDEX_MAX)
+    ))
+
+    return cursor.rowcount
+
+
+def copy_files(cursor, collections):
+    """Loads the File rows of file collections, given as (FileCollection id, checksum file) tuples, as
+    copy_dicom_instances does. Returns the number of rows inserted."""
+
+    for statement in FILE_STAGING_SCHEMA:
+        cursor.execute(statement)
+
+    cursor.execute("TRUNCATE file_checksum_staging")
+
+    cursor.copy_expert(
+        "COPY file_checksum_staging (parent_collection_id, filename, checksum) FROM STDIN",
+        _CopyStream(row for collection_id, checksum_file in collections
+                    for row in _checksum_rows(collection_id, checksum_file))
+    )
+
+    cursor.execute(FILE_INSERT.format(table=File._meta.db_table))
+
+    return cursor.rowcount
@@ -0,0 +1,89 @@
+import os
+import rapidjson as json
+import sqlite3
+
+from pathlib import Path
+
+
+PARSE_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS extracted (
+    checksum TEXT NOT NULL,
+    extractor TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (checksum, extractor)
+) WITHOUT ROWID
+"""
+
+# Caches opened by the current process, by path. Connections can't be shared with forked worker
+# processes, so each worker opens its own.
+_caches = {}
+
+
+class ParseCache:
+    """Persistent cache of the outputs of the extractors that parse the metadata of DICOM instances, keyed
+    by the md5 checksum of the instance file and the name of the extractor.
+
+    Each output is stored with the version of the extractor that computed it, and is only returned for
+    that version, so bumping the version of one extractor recomputes its outputs alone. A recomputed output
+    replaces the stale one. Worker processes share the cache, so it is kept in WAL mode for readers not to
+    block on each other's writes."""
+
+    def __init__(self, db_path, timeout=60.0):
+
+        self.db_path = Path(db_path)
+
+        if not self.db_path.parent.is_dir():
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.conn = sqlite3.connect(str(self.db_path), timeout=timeout)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(PARSE_CACHE_SCHEMA)
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def get(self, checksum, versions):
+        """The cached outputs for a file, as a dict by extractor, for the extractors (and versions) in
+        versions, a dict of extractor name -> version. Missing or outdated outputs are left out."""
+
+        rows = self.conn.execute(
+            "SELECT extractor, version, value FROM extracted WHERE checksum = ?", (checksum,)
+        ).fetchall()
+
+        return {
+            extractor: json.loads(value) for extractor, version, value in rows if versions.get(extractor) == version
+        }
+
+    def put(self, checksum, values, versions):
+        """Stores the outputs of extractors for a file, given as a dict by extractor, along with their
+        versions"""
+
+        if not values:
+            return
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO extracted (checksum, extractor, version, value) VALUES (?, ?, ?, ?)",
+                [(checksum, extractor, versions[extractor], json.dumps(value)) for extractor, value in values.items()]
+            )
+
+
+def get_parse_cache(db_path):
+    """The ParseCache of the current process for a path, opened on first use"""
+
+    key = (os.getpid(), str(db_path))
+
+    if key not in _caches:
+        _caches[key] = ParseCache(db_path)
+
+    return _caches[key]
@@ -0,0 +1,283 @@
+import fnmatch
+import os
+import sqlite3
+
+from datetime import datetime
+from itertools import groupby
+from pathlib import Path
+
+
+PARSED_TREE_INDEX_FNAME = "parsed_tree_index.db"
+
+PARSED_TREE_INDEX_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_dir TEXT PRIMARY KEY,
+        scanner TEXT NOT NULL,
+        year TEXT NOT NULL,
+        month TEXT NOT NULL,
+        day TEXT NOT NULL,
+        exam_dir TEXT NOT NULL,
+        pt_dir TEXT NOT NULL,
+        session TEXT NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        indexed_on TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS sessions_by_date ON sessions (scanner, year, month, day)",
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        fpath TEXT PRIMARY KEY,
+        session_dir TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS files_by_session ON files (session_dir, kind)",
+)
+
+# Kinds of files written by parse_gold_data into each session directory, by filename pattern. The first
+# matching pattern wins, and other files are not indexed.
+PARSED_FILE_KINDS = (
+    ('study', "study_*_metadata.txt"),
+    ('scan_metadata', "*_scan_*_metadata.txt"),
+    ('scan_checksum', "*_scan_*_checksum.txt"),
+    ('scan_columns', "*_scan_*_columns.npz"),
+)
+
+# Levels of the directory tree under the parsed data directory, down to the session directories
+_TREE_LEVELS = ('scanner', 'year', 'month', 'day', 'exam_dir', 'pt_dir', 'session')
+
+
+def get_file_kind(fname):
+
+    for kind, pattern in PARSED_FILE_KINDS:
+        if fnmatch.fnmatchcase(fname, pattern):
+            return kind
+
+    return None
+
+
+def _subdirs(dpath, names=None):
+    """The sorted names of the subdirectories of a directory, restricted to names if given"""
+
+    with os.scandir(dpath) as entries:
+        return sorted(e.name for e in entries if e.is_dir() and (not names or e.name in names))
+
+
+def _filter_clause(scanners=None, years=None, months=None, days=None, prefix=""):
+
+    clauses = []
+    params = []
+
+    for column, values in (('scanner', scanners), ('year', years), ('month', months), ('day', days)):
+        if values:
+            clauses.append("{}{} IN ({})".format(prefix, column, ", ".join("?" * len(values))))
+            params.extend(values)
+
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+class ParsedTreeIndex:
+    """Index of the study, scan metadata, checksum and columns files in a directory of parsed data (as
+    written by parse_gold_data, i.e. scanner/year/month/day/exam/pt/session), with their sizes and mtimes,
+    so that the load_* commands can look up the files to load instead of walking the tree.
+
+    The tree is indexed by refresh(), which walks it once. Session directories whose mtime is unchanged
+    since they were indexed are not listed again. Paths are stored relative to the data directory."""
+
+    def __init__(self, data_dir, db_path=None):
+
+        self.data_dir = Path(data_dir)
+        self.db_path = Path(db_path) if db_path else self.data_dir / PARSED_TREE_INDEX_FNAME
+
+        self.conn = sqlite3.connect(str(self.db_path))
+
+        for statement in PARSED_TREE_INDEX_SCHEMA:
+            self.conn.execute(statement)
+
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def _walk_sessions(self, scanners=None, years=None, months=None, days=None):
+        """Yields the relative paths (as tuples of directory names) of the session directories in the tree"""
+
+        level_filters = (scanners, years, months, days)
+
+        def _walk(dpath, parts):
+
+            if len(parts) == len(_TREE_LEVELS):
+                yield parts
+                return
+
+            names = level_filters[len(parts)] if len(parts) < len(level_filters) else None
+
+            for name in _subdirs(str(dpath), names):
+                yield from _walk(dpath / name, parts + (name,))
+
+        yield from _walk(self.data_dir, ())
+
+    def _index_session(self, parts, mtime_ns):
+
+        session_dir = "/".join(parts)
+
+        self.conn.execute("DELETE FROM files WHERE session_dir = ?", (session_dir,))
+
+        rows = []
+
+        with os.scandir(str(self.data_dir / session_dir)) as entries:
+
+            for entry in entries:
+
+                kind = get_file_kind(entry.name)
+
+                if kind is None or not entry.is_file():
+                    continue
+
+                stat_result = entry.stat()
+
+                rows.append(("{}/{}".format(session_dir, entry.name), session_dir, kind, stat_result.st_size,
+                             stat_result.st_mtime_ns))
+
+        self.conn.executemany("INSERT INTO files (fpath, session_dir, kind, size, mtime_ns) VALUES (?, ?, ?, ?, ?)",
+                              rows)
+
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sessions "
+            "(session_dir, scanner, year, month, day, exam_dir, pt_dir, session, mtime_ns, indexed_on) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (session_dir, *parts, mtime_ns, datetime.now().isoformat())
+        )
+
+        return len(rows)
+
+    def refresh(self, scanners=None, years=None, months=None, days=None, full=False):
+        """Walks the tree (restricted to the given scanners and dates, as lists of directory names), indexing
+        new and modified session directories, and dropping the ones that no longer exist. With full, every
+        session directory is listed again, e.g. to pick up files rewritten in place (which leave the mtime
+        of their directory unchanged).
+
+        Returns a dict of the number of sessions seen, (re)indexed and removed, and of files indexed."""
+
+        where, params = _filter_clause(scanners, years, months, days)
+
+        known = dict(self.conn.execute("SELECT session_dir, mtime_ns FROM sessions" + where, params).fetchall())
+
+        stats = {'sessions': 0, 'indexed': 0, 'removed': 0, 'files': 0}
+
+        with self.conn:
+
+            for parts in self._walk_sessions(scanners, years, months, days):
+
+                session_dir = "/".join(parts)
+
+                mtime_ns = os.stat(str(self.data_dir / session_dir)).st_mtime_ns
+
+                stats['sessions'] += 1
+
+                if not full and known.pop(session_dir, None) == mtime_ns:
+                    continue
+
+                known.pop(session_dir, None)
+
+                stats['files'] += self._index_session(parts, mtime_ns)
+                stats['indexed'] += 1
+
+            for session_dir in known:
+                self.conn.execute("DELETE FROM files WHERE session_dir = ?", (session_dir,))
+                self.conn.execute("DELETE FROM sessions WHERE session_dir = ?", (session_dir,))
+                stats['removed'] += 1
+
+        # The mtime of the index records when it was last refreshed (see open_parsed_tree_index)
+        os.utime(str(self.db_path))
+
+        return stats
+
+    def sessions(self, scanners=None, years=None, months=None, days=None):
+        """Yields the indexed session directories, in the order of the tree, as dicts of their absolute
+        'session_dir', the absolute 'day_dir' containing it, and the absolute paths of their files by kind
+        (as sorted lists, under the kinds of PARSED_FILE_KINDS)"""
+
+        where, params = _filter_clause(scanners, years, months, days, prefix="s.")
+
+        rows = self.conn.execute(
+            "SELECT s.session_dir, s.scanner, s.year, s.month, s.day, f.kind, f.fpath FROM sessions s "
+            "LEFT JOIN files f ON f.session_dir = s.session_dir" + where +
+            " ORDER BY s.scanner, s.year, s.month, s.day, s.exam_dir, s.pt_dir, s.session, f.fpath",
+            params
+        )
+
+        for session_dir, session_rows in groupby(rows, key=lambda r: r[0]):
+
+            session_rows = list(session_rows)
+
+            session = {
+                'session_dir': self.data_dir / session_dir,
+                'day_dir': self.data_dir.joinpath(*session_rows[0][1:5]),
+            }
+
+            session.update((kind, []) for kind, _ in PARSED_FILE_KINDS)
+
+            for row in session_rows:
+                if row[5] is not None:
+                    session[row[5]].append(self.data_dir / row[6])
+
+            yield session
+
+
+def add_index_arguments(parser):
+    """Adds the arguments of the commands that look up the parsed files to load in a ParsedTreeIndex"""
+
+    parser.add_argument(
+        "--index",
+        help="Path to the index of the parsed data directory. Defaults to {} in --data.".format(
+            PARSED_TREE_INDEX_FNAME),
+        default=None
+    )
+
+    parser.add_argument(
+        "--no_refresh_index",
+        help="Load from the index of the parsed data as it is, without first refreshing it for the given scanners "
+             "and dates. Data parsed into --data since it was last refreshed is not loaded. The whole directory "
+             "is still indexed if it has no index yet.",
+        action='store_true',
+    )
+
+
+def open_parsed_tree_index(data_dir, options, stdout=None):
+    """Opens the ParsedTreeIndex of a parsed data directory for a load_* command. The whole directory is
+    indexed if the index does not exist. Otherwise the part of it to load is refreshed (only listing the
+    session directories modified since they were indexed), unless options['no_refresh_index'] is set."""
+
+    db_path = Path(options['index']) if options.get('index', None) else Path(data_dir) / PARSED_TREE_INDEX_FNAME
+
+    exists = db_path.is_file()
+
+    index = ParsedTreeIndex(data_dir, db_path=db_path)
+
+    stats = None
+
+    if not exists:
+        stats = index.refresh()
+    elif not options.get('no_refresh_index', False):
+        stats = index.refresh(scanners=options['scanners'], years=options['years'], months=options['months'],
+                              days=options['days'])
+    elif stdout and os.stat(str(data_dir)).st_mtime_ns > os.stat(str(db_path)).st_mtime_ns:
+        stdout.write("Warning: {} was modified after its index {} was last refreshed, data parsed since then "
+                     "will not be loaded".format(data_dir, db_path))
+
+    if stats and stdout:
+        stdout.write("Indexed {} of {} sessions ({} files) in {}, removed {}".format(
+            stats['indexed'], stats['sessions'], stats['files'], data_dir, stats['removed']))
+
+    return index
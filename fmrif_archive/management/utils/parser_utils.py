@@ -1,26 +1,55 @@
-import gzip
+import hashlib
 import warnings
 import base64
 import pydicom
 import rapidjson as json
 import os
 import shutil
+import tarfile
+import time
 import traceback
 
 from multiprocessing.dummy import Pool as ThreadPool  # Use threads
-from multiprocessing import Pool as ProcessPool
 from subprocess import check_output
 from pydicom.errors import InvalidDicomError
-from subprocess import STDOUT, run, CalledProcessError, PIPE
-from pathlib import Path
+from pydicom.filereader import read_partial
+from pydicom.tag import Tag
+from subprocess import STDOUT, DEVNULL, PIPE, Popen, CalledProcessError
+from pathlib import Path, PurePosixPath
+from io import BytesIO
 from collections import OrderedDict
 from Crypto.Hash import SHA512
+from fmrif_archive.management.utils.csa_header import CSA_WHITELIST, LazyCSAHeader, get_csa_bytes
+from fmrif_archive.management.utils.dicom_json import (
+    encode_dataset,
+    encode_dicom_element,
+    parse_at,
+    parse_pn,
+    parse_ui,
+    sanitize_unicode,
+)
+from fmrif_archive.management.utils.instance_columns import (
+    COLUMN_TAGS,
+    get_column_arrays,
+    get_instance_columns,
+    write_scan_columns,
+)
+from fmrif_archive.management.utils.ge_private import GEPrivateDataError, decode_ge_private_data
+from fmrif_archive.management.utils.parse_cache import get_parse_cache
+from fmrif_archive.management.utils.scan_geometry import compute_scan_geometry
+from fmrif_archive.management.utils.worker_pool import ParserWorkerPool, get_worker_log
+from fmrif_archive.utils import get_header_delta
 
 
 # Load the functions to read CSA Headers and ignore the warnings
 with warnings.catch_warnings():
     warnings.simplefilter("ignore", category=UserWarning)
-    from nibabel.nicom.csareader import get_csa_header, is_mosaic, CSAError, CSAReadError
+    from nibabel.nicom.csareader import CSAError
+
+
+CHECKSUM_ALGORITHMS = ("md5", "sha256")
+
+CHECKSUM_READ_SIZE = 4 * 1024 * 1024
 
 
 class UtilsLogger:
@@ -70,31 +99,6 @@ def parse_date(date):
     return date
 
 
-def sanitize_unicode(s):
-    """Removes any \u0000 characters from unicode strings in DICOM values, since this character is
-    unsupported in JSON"""
-
-    if type(s) is bytes:
-        s = s.decode('utf-8')
-    return str(s).replace(u"\u0000", "").strip()
-
-
-def parse_pn(value):
-    """Parses a Person Name (VR of type PN) DICOM value into the appropriate JSON Model Object representation"""
-
-    pn = OrderedDict({
-        'Alphabetic': str(value)
-    })
-
-    if value.ideographic:
-        pn["Ideographic"] = value.ideographic
-
-    if value.phonetic:
-        pn["Phonetic"] = value.phonetic
-
-    return pn
-
-
 def parse_seq(seq):
     """Parses a sequence (VR of type SQ) of DICOM values into the appropriate JSON Model Object representation"""
 
@@ -108,14 +112,6 @@ def parse_seq(seq):
     return vals
 
 
-def parse_at(value):
-    return str(value).replace("(", "").replace(")", "").replace(", ", "")
-
-
-def parse_ui(value):
-    return str(repr(value).replace('"', '').replace("'", ""))
-
-
 def _vr_encoding(vr):
     """A map of DICOM VRs to corresponding JSON types as specified in the DICOMweb standard"""
 
@@ -149,6 +145,12 @@ def _vr_encoding(vr):
     return vr_json_encodings[vr]
 
 
+# encode_element and parse_dicom_dataset are the original DICOM to JSON encoder. Parsing now goes
+# through dicom_json.encode_dicom_element and dicom_json.encode_dataset, which produce the same output
+# faster; these are kept as the reference they are checked and benchmarked against (see the
+# check_dicom_encoder command).
+
+
 def encode_element(dicom_element):
     """Creates the appropriate JSON Model Object representation for a DICOM element"""
 
@@ -219,47 +221,11 @@ def parse_dicom_dataset(dicom_dataset):
     return dicom_dict
 
 
-def decode_ge_private_data(byte_seq):
-    """Attempts to uncompress the data in the (0x0025, 0x101B) field of GE Scans, which contains
-    useful metadata for DTI scans"""
-
-    # Find the beginning of the GZIP sequence, and drop the padding bytes before it
-    pos = byte_seq.find(b"\x1f\x8b")
-
-    if pos == -1:
-
-        return None
-
-    else:
-
-        try:
-
-            uncompressed_bytes = gzip.decompress(byte_seq[pos:])
-
-            decoded_bytes = uncompressed_bytes.decode('ascii').strip().split("\n")
-
-            private_dat = OrderedDict()
-
-            for item in decoded_bytes:
-
-                first_space = item.find(" ")
-
-                key = item[:first_space + 1].strip()
-
-                val = item[first_space:].replace('"', '').strip()
-
-                private_dat[key] = val
-
-            return private_dat
-
-        except (ValueError, OSError, TypeError, AttributeError, KeyError):
-
-            pass
-
-    return None
-
-
-def parse_private_data(dicom_dataset):
+def parse_private_data(dicom_dataset, csa_fields=None, errors=None):
+    """Parses the vendor private metadata of a scan's sample instance: the Siemens CSA image header, or
+    the GE (0025,101B) protocol data block. The CSA header is decoded lazily, so that if csa_fields is
+    given, only those of its tags are decoded and stored. If errors is given, the reasons the GE protocol
+    data block could not be decoded are appended to it."""
 
     private_data = {
         'is_mosaic': False,
@@ -273,53 +239,28 @@ def parse_private_data(dicom_dataset):
         if "siemens" in manufacturer.lower():
 
             try:
-                siemens_header = get_csa_header(dicom_dataset)
-            except:
+                csa_bytes = get_csa_bytes(dicom_dataset)
+                siemens_header = LazyCSAHeader(csa_bytes) if csa_bytes else None
+            except Exception:
                 siemens_header = None
 
             if siemens_header:
 
-                private_data['is_mosaic'] = is_mosaic(siemens_header)
-
-                # Remove an unused key that is composed of random bytes and seems to be used for padding
-                # (can't be converted to json easily)
-                siemens_header.pop('unused0', None)
-
-                # # For the remember of the entries, check that the values in the 'items' key of the 'tags'
-                # # field in the header are of the proper type according to the specified VR for that tag.
-                # # Additionally, ignore tags that are of VR SQ, PN, or any of the binary types.
-                if siemens_header.get('tags', None):
-
-                    for tag, val in siemens_header['tags'].items():
-
-                        vr = val['vr']
-
-                        if vr in ('OB', 'OD', 'OF', 'OL', 'OW', 'UN', 'SQ', 'PN'):
-                            continue
-
-                        sanitized_items = []
+                private_data['is_mosaic'] = siemens_header.is_mosaic()
 
-                        for item in val['items']:
-                            sanitized_items.append(_vr_encoding(vr)(item))
-
-                        siemens_header['tags'][tag]['items'] = sanitized_items
-
-                # Make sure the remaining csa headers are json serializable
-                try:
-
-                    _ = json.dumps(siemens_header)
-
-                    private_data['data'] = siemens_header
-
-                except TypeError:
-
-                    pass
+                # Tags with items that can't be stored as JSON (e.g. binary data) leave the header out
+                private_data['data'] = siemens_header.to_dict(names=csa_fields)
 
         elif ("ge" in manufacturer.lower()) or ("general electric" in manufacturer.lower()):
 
             ge_dat = dicom_dataset[(0x0025, 0x101B)].value
 
-            ge_priv_data = decode_ge_private_data(ge_dat)
+            try:
+                ge_priv_data = decode_ge_private_data(ge_dat)
+            except (GEPrivateDataError, TypeError, AttributeError) as e:
+                ge_priv_data = None
+                if errors is not None:
+                    errors.append(str(e) if isinstance(e, GEPrivateDataError) else "Invalid protocol data block")
 
             if ge_priv_data:
                 private_data['data'] = ge_priv_data
@@ -328,7 +269,7 @@ def parse_private_data(dicom_dataset):
 
         pass
 
-    except (CSAError, CSAReadError):
+    except CSAError:
 
         pass
 
@@ -381,14 +322,30 @@ def parse_json_pn(alphabetic_pn):
     return res
 
 
-def get_checksum(fpath, algorithm="md5", log=None):
-
-    cmd = "{}sum {}".format(algorithm, fpath)
+def get_checksum(fpath, algorithm="md5", log=None, read_size=CHECKSUM_READ_SIZE):
+    """Computes the checksum of a file in-process, reading it in chunks of read_size bytes"""
 
     try:
-        res = run(cmd, check=True, shell=True, universal_newlines=True, stderr=STDOUT, stdout=PIPE)
-        checksum = res.stdout.split(" ")[0]
-    except CalledProcessError as e:
+
+        h = hashlib.new(algorithm)
+
+        buf = bytearray(read_size)
+        view = memoryview(buf)
+
+        with open(str(fpath), "rb", buffering=0) as infile:
+
+            while True:
+
+                num_read = infile.readinto(buf)
+
+                if not num_read:
+                    break
+
+                h.update(view[:num_read])
+
+        checksum = h.hexdigest()
+
+    except (OSError, ValueError) as e:
         checksum = None
 
         if log:
@@ -399,6 +356,35 @@ def get_checksum(fpath, algorithm="md5", log=None):
     return checksum
 
 
+def _hash_archive(fpath, algorithm, read_size, log, metrics=None):
+
+    start = time.time()
+
+    checksum = get_checksum(fpath, algorithm=algorithm, log=log, read_size=read_size)
+
+    exam_id = get_exam_id(checksum, fpath) if checksum else None
+
+    if metrics and checksum:
+        metrics.record('hashing', start, time.time(), files=1, num_bytes=os.path.getsize(str(fpath)),
+                       archive=fpath)
+
+    return fpath, checksum, exam_id
+
+
+def get_archive_checksums(fpaths, algorithm="md5", num_workers=4, read_size=CHECKSUM_READ_SIZE, log=None,
+                          metrics=None):
+    """Hashes Gold archives on a bounded pool of threads and yields (fpath, checksum, exam_id) tuples as
+    each archive completes. The exam id is derived in the same task, right after the archive is hashed."""
+
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ValueError("Unsupported checksum algorithm: {}".format(algorithm))
+
+    with ThreadPool(num_workers) as pool:
+
+        for res in pool.imap_unordered(lambda f: _hash_archive(f, algorithm, read_size, log, metrics), fpaths):
+            yield res
+
+
 def get_exam_id(checksum, fpath):
 
     fpath = Path(fpath)
@@ -433,33 +419,44 @@ def get_scan_id(exam_id, scan_name):
     return h.hexdigest()
 
 
-def get_scan_checksums(cmd):
-    checksum_cmd = cmd[0]
-    scan = cmd[1]
+def get_extract_dir(compressed_file, exam_id, work_dir):
+    """Directory of the work directory into which an archive is extracted and its outputs are written"""
 
-    try:
-        run(checksum_cmd, check=True, shell=True, cwd=str(scan))
-        msg = "Computing checksums for scan {}".format(scan)
-    except CalledProcessError:
-        msg = "Could not generate checksums for scan {}".format(scan)
+    parents = Path(compressed_file).parents
 
-    return msg
+    day = parents[1].name
+    month = parents[2].name
+    year = parents[3].name
+    scanner = parents[4].name
+
+    return Path(work_dir) / scanner / year / month / day / exam_id
+
+
+def cleanup_extracted_exam(exam_dir):
+    """Removes the extracted scan directories and any remaining extracted files of an exam, keeping only
+    the metadata, checksum and columns outputs"""
+
+    exam_dir = Path(exam_dir)
 
+    for scan_dir in [d for d in exam_dir.iterdir() if d.is_dir()]:
+        shutil.rmtree(str(scan_dir))
 
-def _multithreaded_tgz_extraction(filepath, exam_checksum, exam_id, settings):
+    readme_files = [str(f) for f in exam_dir.glob("**/*") if
+                    f.is_file() and ("_metadata.txt" not in f.name) and ("_checksum.txt" not in f.name) and
+                    ("_filelist.txt" not in f.name) and ("_columns.npz" not in f.name)]
+
+    list(map(os.remove, readme_files))
+
+
+def _multithreaded_tgz_extraction(filepath, exam_checksum, exam_id, settings, metrics=None):
     """Uncompresses a TGZ image archive from Gold into the specified work directory, or inside a temporary directory
      with randomly generated name within the work directory"""
 
-    compressed_file = Path(filepath)
-
-    parents = compressed_file.parents
+    start = time.time()
 
-    day = parents[1].name
-    month = parents[2].name
-    year = parents[3].name
-    scanner = parents[4].name
+    compressed_file = Path(filepath)
 
-    extract_dir = settings['work_dir'] / scanner / year / month / day / exam_id
+    extract_dir = get_extract_dir(compressed_file, exam_id, settings['work_dir'])
 
     if not extract_dir.is_dir():
         extract_dir.mkdir(parents=True, exist_ok=True)
@@ -472,81 +469,358 @@ def _multithreaded_tgz_extraction(filepath, exam_checksum, exam_id, settings):
     except CalledProcessError:
         success = False
 
+    if success and metrics:
+        metrics.record('extraction', start, time.time(), files=1, num_bytes=compressed_file.stat().st_size,
+                       archive=compressed_file)
+
     if success:
         return success, extract_dir, compressed_file, exam_id, exam_checksum
     else:
         return success, None, compressed_file, exam_id, exam_checksum
 
 
-def _get_dicom_meta(dcm, ge_extra_meta, log):
+# Metadata collected from every DICOM instance of a scan, in the order it is written to the scan metadata
+# files. 'multi' keeps every value of the element rather than the first one, and 'ge_extra' marks the
+# fields only collected to sort the instances of GE multiecho series.
+INSTANCE_TAGS = [
+    {'key': 'echo_number', 'tag': (0x0018, 0x0086), 'multi': False, 'ge_extra': True},
+    {'key': 'raw_data_run_number', 'tag': (0x0019, 0x10A2), 'multi': False, 'ge_extra': True},
+    {'key': 'image_position_patient', 'tag': (0x0020, 0x0032), 'multi': True, 'ge_extra': True},
+    {'key': 'sop_instance_uid', 'tag': (0x0008, 0x0018), 'multi': False, 'ge_extra': False},
+]
+
+
+def _instance_tags(ge_extra_meta):
+    return [t for t in INSTANCE_TAGS if ge_extra_meta or not t['ge_extra']]
+
+
+def _extract_instance_tags(dicom_dataset, ge_extra):
+    """The values of the INSTANCE_TAGS that are (or are not, if ge_extra is False) only collected for GE
+    multiecho scans"""
+
+    values = {}
+
+    for instance_tag in INSTANCE_TAGS:
+
+        if instance_tag['ge_extra'] != ge_extra:
+            continue
+
+        try:
+            value = encode_dicom_element(dicom_dataset[instance_tag['tag']])['Value']
+            values[instance_tag['key']] = value if instance_tag['multi'] else value[0]
+        except (KeyError, TypeError, AttributeError):
+            values[instance_tag['key']] = None
+
+    return values
+
+
+# Extractors of the per-instance metadata, from which _build_instance_meta builds it. Each has its own version,
+# to be bumped whenever its output changes, so that only its outputs are recomputed for the instances
+# found in the parse cache (see parse_cache.ParseCache).
+INSTANCE_EXTRACTORS = OrderedDict([
+    ('instance_tags', {'version': 1, 'extract': lambda ds: _extract_instance_tags(ds, False)}),
+    ('ge_extra_tags', {'version': 1, 'extract': lambda ds: _extract_instance_tags(ds, True)}),
+    ('columns', {'version': 2, 'extract': get_instance_columns}),
+    ('header', {'version': 1, 'extract': encode_dataset}),  # From which header deltas are computed
+])
+
+EXTRACTOR_VERSIONS = {name: extractor['version'] for name, extractor in INSTANCE_EXTRACTORS.items()}
+
+
+def _instance_extractors(ge_extra_meta, header=False, columns=False):
+    """The names of the extractors needed for the metadata of an instance (see _build_instance_meta)"""
+
+    names = ['instance_tags']
+
+    if ge_extra_meta:
+        names.append('ge_extra_tags')
+
+    if columns:
+        names.append('columns')
+
+    if header:
+        names.append('header')
+
+    return names
+
+
+def _run_extractors(dicom_dataset, names):
+    return {name: INSTANCE_EXTRACTORS[name]['extract'](dicom_dataset) for name in names}
+
+
+def _build_instance_meta(extracted, ge_extra_meta, series_header=None, columns=False):
+    """Assembles the per-instance metadata stored for each DICOM file of a scan from the outputs of its
+    extractors. If the JSON header of the series is given, the elements of the instance header that differ
+    from it are kept as 'header_delta'. If columns is set, the attributes from which the geometry (and
+    columns file) of the scan are computed are kept as 'columns', to be removed from the metadata before
+    it is written."""
+
+    tag_values = dict(extracted['instance_tags'], **(extracted['ge_extra_tags'] if ge_extra_meta else {}))
+
+    dicom_data = {t['key']: tag_values[t['key']] for t in _instance_tags(ge_extra_meta)}
+
+    if series_header is not None:
+        dicom_data['header_delta'] = get_header_delta(series_header, extracted['header'])
+
+    if columns:
+        dicom_data['columns'] = extracted['columns']
+
+    return dicom_data
+
+
+def _read_instance_header(fp, ge_extra_meta=True, targeted=False, extra_tags=()):
+    """Reads the header of a DICOM instance from a path or file-like object. In targeted mode, only the
+    elements in INSTANCE_TAGS (and extra_tags) are kept, and parsing stops as soon as the highest of them
+    has been passed, so the rest of the header (e.g. large private groups) is never decoded."""
+
+    if not targeted:
+        return pydicom.dcmread(fp, stop_before_pixels=True)
+
+    tags = [Tag(*t['tag']) for t in _instance_tags(ge_extra_meta)] + list(extra_tags)
+
+    # Keep the private creators of any private tags, which can be needed to resolve their VRs
+    tags.extend([Tag(t.group, t.element >> 8) for t in tags if t.is_private])
+
+    last_tag = max(tags)
+
+    if isinstance(fp, (str, Path)):
+        with open(str(fp), "rb") as infile:
+            return read_partial(infile, stop_when=lambda tag, vr, length: tag > last_tag, specific_tags=tags)
+
+    return read_partial(fp, stop_when=lambda tag, vr, length: tag > last_tag, specific_tags=tags)
+
 
-    dcm = Path(dcm)
+def _extract_cached(data, checksum, names, parse_cache=None, targeted=False, ge_extra_meta=True, sample=False):
+    """The outputs of the extractors in names for a DICOM file read into data. If the path of a parse cache
+    is given, the outputs cached for the checksum of the file are used, and the header is only read to
+    compute the missing ones, which are then cached. The whole header is read if the 'header' extractor
+    has to run, regardless of targeted.
+
+    Returns (extracted, dicom_dataset), dicom_dataset being None if the header was not read. If sample is
+    set, the cache is not consulted, as the header of a scan's sample instance is needed."""
+
+    cache = get_parse_cache(parse_cache) if parse_cache else None
+
+    extracted = cache.get(checksum, EXTRACTOR_VERSIONS) if cache and not sample else {}
+
+    missing = [name for name in names if name not in extracted]
+
+    if not missing:
+        return extracted, None
+
+    dicom_dataset = _read_instance_header(BytesIO(data), ge_extra_meta, targeted=targeted and 'header' not in missing,
+                                          extra_tags=COLUMN_TAGS if 'columns' in missing else ())
+
+    computed = _run_extractors(dicom_dataset, missing)
+
+    if cache:
+        cache.put(checksum, computed, EXTRACTOR_VERSIONS)
+
+    extracted.update(computed)
+
+    return extracted, dicom_dataset
+
+
+def _get_dicom_meta_and_checksum(fpath, parse_dicom, ge_extra_meta, targeted=False, series_header=None,
+                                 columns=False, parse_cache=None):
+    """Reads a file once, computing its checksum and, if parse_dicom is set, the per-instance metadata
+    parsed from the header in the same buffer. Returns (fpath, checksum, dicom_data, timings), where
+    dicom_data is None if the file was not parsed, and timings holds the bytes read and the time spent
+    checksumming and parsing the file. If series_header is given, the whole header is read to compute the
+    delta of the instance (see _build_instance_meta), regardless of targeted. If columns is set, the
+    attributes of the instance columns (see instance_columns.INSTANCE_COLUMNS) are collected too. If the
+    path of a parse cache is given, the metadata cached for the checksum of the file is used instead of
+    parsing its header (see _extract_cached)."""
+
+    log = UtilsLogger(log=get_worker_log())
+
+    fpath = Path(fpath)
+
+    timings = {'bytes': 0, 'checksum': 0.0, 'header_parsing': 0.0}
+
+    start = time.perf_counter()
+
+    try:
+        with open(str(fpath), "rb") as infile:
+            data = infile.read()
+    except OSError as e:
+        log.error("Unable to read: {}".format(str(fpath)))
+        log.error(e)
+        return fpath, None, {'sop_instance_uid': None} if parse_dicom else None, timings
+
+    checksum = hashlib.md5(data).hexdigest()
+
+    timings['bytes'] = len(data)
+    timings['checksum'] = time.perf_counter() - start
+
+    if not parse_dicom:
+        return fpath, checksum, None, timings
+
+    start = time.perf_counter()
 
     try:
-        dicom_dataset = pydicom.dcmread(str(dcm), stop_before_pixels=True)
+        extracted, _ = _extract_cached(
+            data, checksum, _instance_extractors(ge_extra_meta, header=series_header is not None, columns=columns),
+            parse_cache=parse_cache, targeted=targeted, ge_extra_meta=ge_extra_meta)
+        dicom_data = _build_instance_meta(extracted, ge_extra_meta, series_header=series_header, columns=columns)
     except (InvalidDicomError, IOError, OSError) as e:
-        log.error("Unable to read: {}".format(str(dcm)))
+        log.error("Unable to read: {}".format(str(fpath)))
         log.error(e)
         log.error(traceback.format_exc())
-        return dcm, {'sop_instance_uid': None}
+        dicom_data = {'sop_instance_uid': None}
 
-    if ge_extra_meta:
+    timings['header_parsing'] = time.perf_counter() - start
 
-        dicom_data = {
-            'echo_number': None,
-            'raw_data_run_number': None,
-            'image_position_patient': None,
-            'sop_instance_uid': None,
-        }
+    return fpath, checksum, dicom_data, timings
 
-        try:
-            echo_number = encode_element(dicom_dataset[(0x0018, 0x0086)])['Value'][0]
-        except (KeyError, TypeError, AttributeError):
-            echo_number = None
 
-        try:
-            raw_data_run_number = encode_element(dicom_dataset[(0x0019, 0x10A2)])['Value'][0]
-        except (KeyError, TypeError, AttributeError):
-            raw_data_run_number = None
+def _new_study_meta(exam_id, compressed_file, exam_checksum, parser_version):
 
-        try:
-            image_position_patient = encode_element(dicom_dataset[(0x0020, 0x0032)])['Value']
-        except (KeyError, TypeError, AttributeError):
-            image_position_patient = None
+    return OrderedDict({
+        'metadata': OrderedDict({
+            'exam_id': exam_id,
+            'gold_fpath': "/".join(str(compressed_file).split("/")[-6:]),
+            'gold_archive_checksum': exam_checksum,
+            'parser_version': parser_version,
+        }),
+        'data': [],
+    })
 
-        try:
-            sop_instance_uid = encode_element(dicom_dataset[(0x0008, 0x0018)])['Value'][0]
-        except (KeyError, TypeError, AttributeError):
-            sop_instance_uid = None
 
-        dicom_data['echo_number'] = echo_number
-        dicom_data['raw_data_run_number'] = raw_data_run_number
-        dicom_data['image_position_patient'] = image_position_patient
-        dicom_data['sop_instance_uid'] = sop_instance_uid
+def _new_scan_meta(exam_id, scan_name, num_files, parser_version):
 
-    else:
+    return OrderedDict({
+        'metadata': {
+            'parent_exam_id': exam_id,
+            'gold_scan_dir': scan_name,
+            'scan_id': get_scan_id(exam_id, scan_name),
+            'num_files': num_files,
+            'parser_version': parser_version,
+        },
+        'dicom_data': None,
+        'private_data': None,
+        'geometry': None,
+    })
 
-        dicom_data = {
-            'sop_instance_uid': None,
-        }
 
-        try:
-            sop_instance_uid = encode_element(dicom_dataset[(0x0008, 0x0018)])['Value'][0]
-        except (KeyError, TypeError, AttributeError):
-            sop_instance_uid = None
+def _scan_outfname(compressed_file, exam_id, scan_name, suffix, ext="txt"):
+    """Name of the per-scan output files, where suffix is either 'metadata', 'checksum' or 'columns'"""
+
+    return "{}_{}_scan_{}_{}.{}".format(
+        str(Path(compressed_file).name).replace(".tgz", ""),
+        exam_id,
+        scan_name,
+        suffix,
+        ext
+    )
 
-        dicom_data['sop_instance_uid'] = sop_instance_uid
 
-    return dcm, dicom_data
+def _is_ge_multiecho(dicom_data, log):
+    """Determines from the parsed header of a representative instance whether a scan is a GE multiecho
+    series, in which case extra per-instance metadata is collected to order its files"""
 
+    try:
+        sop_class = dicom_data['00080016']['Value'][0]
+    except (KeyError, IndexError):
+        sop_class = None
 
-def parse_metadata(extracted_archives, parser_version, log=None):
+    try:
+        manufacturer = dicom_data['00080070']['Value'][0]
+    except (KeyError, IndexError):
+        manufacturer = None
 
-    log = UtilsLogger(log=log)
+    if not (sop_class and manufacturer):
+        return False
+
+    if not ((sop_class in ["1.2.840.10008.5.1.4.1.1.4", "1.2.840.10008.5.1.4.1.1.4.1"]) and
+            ("ge" in manufacturer.lower() or "general electric" in manufacturer.lower())):
+        return False
+
+    # Determine if series is likely to be multiecho and if so, collect the relevant metadata
+    # to order the scans
+    try:
+        num_indices = dicom_data["00201002"]['Value'][0]
+    except (KeyError, IndexError):
+        num_indices = None
+
+    try:
+        num_slices = dicom_data["0021104F"]['Value'][0]
+    except (KeyError, IndexError):
+        num_slices = None
+
+    if not num_indices or not num_slices:
+        log.info("Scan did not have number of slices or number of indices in metadata. Treating"
+                 " as non-multiecho.")
+        return False
+
+    log.info("Num Indices: {}".format(num_indices))
+    log.info("Num Slices: {}".format(num_slices))
+
+    if num_indices == num_slices:
+        return False
+
+    if num_indices % num_slices != 0:
+        log.warning("Multiecho testing detected possible un-accounted for slices in this "
+                    "acquisition. Treating as a non-multiecho series.")
+        return False
+
+    num_echoes = num_indices // num_slices
+
+    log.info("Number of echoes detected: {}".format(num_echoes))
+
+    # Try to fetch a slice representative slice index - if unable, might be CBV scan
+    try:
+        sample_slice_index = dicom_data['001910A2']['Value'][0]
+    except (KeyError, IndexError):
+        sample_slice_index = None
+
+    if not sample_slice_index:
+        log.warning("Unable to retrieve slice indices "
+                    "(usually happens with CBV scans), treating "
+                    "as non-multiecho series.")
+        return False
+
+    # Collect GE metadata for sorting
+    log.info("Scan is probable multiecho - collecting extra metadata for sorting")
+
+    return True
+
+
+def parse_metadata(extracted_archives, parser_version, log=None, pool=None, targeted_reads=False, journal=None,
+                   metrics=None, budget=None, loader=None, instance_headers=False, instance_columns=False,
+                   csa_whitelist=False, parse_cache=None):
 
     # extracted_archives is a list of tuples of the form
     # (extract_dir, compressed_file, exam_id, exam_checksum)
 
+    # If an ExtractionBudget is given, the space of each archive is released as soon as its extracted files
+    # are removed, so that more archives can be admitted for extraction
+
+    # If an ExamLoader is given, each exam is loaded into the databases instead of writing the study, scan
+    # metadata and checksum files, and its whole extraction directory is removed once loaded
+
+    # If instance_headers is set, the header of every instance is stored as its delta from the header of
+    # its scan, from which it can be reconstructed (see fmrif_archive.utils.apply_header_delta)
+
+    # The varying attributes of the instances of each scan (see instance_columns.INSTANCE_COLUMNS) are
+    # collected to compute its slice geometry. If instance_columns is set, they are also written as typed
+    # arrays to a columns file (see instance_columns.write_scan_columns), unless loading
+
+    # If csa_whitelist is set, only the Siemens CSA header fields in CSA_WHITELIST are kept
+
+    # If the path of a parse cache is given, the metadata of instances already parsed (by the same version
+    # of each extractor) is taken from it rather than from their headers (see parse_cache.ParseCache)
+
+    if pool is None:
+        with ParserWorkerPool(log=log) as pool:
+            return parse_metadata(extracted_archives, parser_version, log=log, pool=pool,
+                                  targeted_reads=targeted_reads, journal=journal, metrics=metrics, budget=budget,
+                                  loader=loader, instance_headers=instance_headers,
+                                  instance_columns=instance_columns, csa_whitelist=csa_whitelist,
+                                  parse_cache=parse_cache)
+
+    log = UtilsLogger(log=log)
+
     for extract_dir, compressed_file, exam_id, exam_checksum in extracted_archives:
 
         extract_dir = Path(extract_dir)
@@ -557,6 +831,9 @@ def parse_metadata(extracted_archives, parser_version, log=None):
             log.error("Extraction directory {} for compressed {} file is missing. "
                       "Skipping DICOM parsing.".format(extract_dir, compressed_file))
 
+            if budget:
+                budget.release(compressed_file)
+
             continue
 
         if not compressed_file.is_file():
@@ -568,6 +845,9 @@ def parse_metadata(extracted_archives, parser_version, log=None):
 
             shutil.rmtree(str(extract_dir))
 
+            if budget:
+                budget.release(compressed_file)
+
             continue
 
         session_dirs = list([session for session in Path(extract_dir).glob("*/*") if session.is_dir()])
@@ -583,6 +863,9 @@ def parse_metadata(extracted_archives, parser_version, log=None):
 
                 shutil.rmtree(str(extract_dir))
 
+            if budget:
+                budget.release(compressed_file)
+
             continue
 
         exam_dir = session_dirs[0]
@@ -597,231 +880,218 @@ def parse_metadata(extracted_archives, parser_version, log=None):
 
             shutil.rmtree(str(extract_dir))
 
+            if budget:
+                budget.release(compressed_file)
+
             continue
 
-        study_meta = OrderedDict({
-            'metadata': OrderedDict({
-                'exam_id': exam_id,
-                'gold_fpath': "/".join(str(compressed_file).split("/")[-6:]),
-                'gold_archive_checksum': exam_checksum,
-                'parser_version': parser_version,
-            }),
-            'data': [],
-        })
+        study_meta = _new_study_meta(exam_id, compressed_file, exam_checksum, parser_version)
+
+        exam_scans = []
+
+        # Per-archive totals of the time spent by the workers on each file, for the run metrics
+        parse_start = time.time()
+        archive_timings = {'parsed_files': 0, 'checksum_files': 0, 'parsed_bytes': 0, 'bytes': 0,
+                           'checksum': 0.0, 'header_parsing': 0.0}
 
         for scan in scans:
 
-            scan_id = get_scan_id(exam_id, scan.name)
+            # Every file in the scan directory is checksummed, but only the DICOMs directly inside it
+            # are parsed
+            scan_files = sorted(f for f in scan.glob("**/*") if f.is_file())
 
             instance_files = [f for f in scan.iterdir() if f.is_file() and "README" not in f.name]
 
+            parse_instances = False
+            collect_ge_extra_meta = False
+            series_header = None
+
             if not instance_files:
 
                 log.error("No instances files found in subdirectory {}".format(scan))
 
-                continue
+            else:
 
-            scan_outfname = "{}_{}_scan_{}_metadata.txt".format(
-                str(compressed_file.name).replace(".tgz", ""),
-                exam_id,
-                scan.name
-            )
-
-            scan_meta = OrderedDict({
-                'metadata': {
-                    'parent_exam_id': exam_id,
-                    'gold_scan_dir': scan.name,
-                    'scan_id': scan_id,
-                    'num_files': len(instance_files),
-                    'parser_version': parser_version,
-                },
-                'dicom_data': None,
-                'private_data': None,
-            })
+                scan_meta = _new_scan_meta(exam_id, scan.name, len(instance_files), parser_version)
 
-            dicom_instances = [i for i in instance_files if i.name.endswith(".dcm")]
+                study_meta['data'].append(scan_meta)
 
-            if not dicom_instances:
+                dicom_instances = [i for i in instance_files if i.name.endswith(".dcm")]
 
-                # There are files in the subdirectory, but none of them are DICOM.
-                # Save basic metadata about directory
+                # There are dicom instances - try to open at least one of them to get
+                # basic metadata for this scan
+                sample_file = None
 
-                study_meta['data'].append(scan_meta)
+                sample_start = time.perf_counter()
 
-                continue
+                for dcm_instance in dicom_instances:
 
-            # There are dicom instances - try to open at least one of them to get
-            # basic metadata for this scan
-            sample_file = None
+                    try:
 
-            for dcm_instance in dicom_instances:
+                        sample_file = pydicom.dcmread(str(dcm_instance), stop_before_pixels=True)
 
-                try:
+                        break
 
-                    sample_file = pydicom.dcmread(str(dcm_instance), stop_before_pixels=True)
+                    except (InvalidDicomError, IOError, OSError):
 
-                    break
+                        log.error("Unable to open invalid DICOM file {}".format(dcm_instance))
 
-                except (InvalidDicomError, IOError, OSError):
+                        sample_file = None
 
-                    log.error("Unable to open invalid DICOM file {}".format(sample_file))
+                archive_timings['header_parsing'] += time.perf_counter() - sample_start
 
-                    sample_file = None
+                if dicom_instances and not sample_file:
 
-            if not sample_file:
+                    # None of the DICOM files in subirectory was readable, log an error
+                    # and keep only the basic subdirectory metadata in the study metadata file
 
-                # None of the DICOM files in subirectory was readable, log an error
-                # and add basic subdirectory metadata to study metadata file
+                    log.error("Unable to open any DICOMs for scan {}".format(scan))
 
-                study_meta['data'].append(scan_meta)
+                elif sample_file:
 
-                log.error("Unable to open any DICOMs for scan {}".format(scan))
+                    log.info("Found {} DICOM files for scan {} of exam {}".format(
+                        len(instance_files),
+                        scan.name,
+                        exam_dir)
+                    )
 
-                continue
+                    dicom_data = encode_dataset(sample_file)
 
-            log.info("Found {} DICOM files for scan {} of exam {}".format(
-                len(instance_files),
-                scan.name,
-                exam_dir)
-            )
+                    scan_meta['dicom_data'] = dicom_data
 
-            dicom_data = parse_dicom_dataset(sample_file)
+                    private_data_errors = []
 
-            scan_meta['dicom_data'] = parse_dicom_dataset(sample_file)
+                    scan_meta['private_data'] = parse_private_data(
+                        sample_file, csa_fields=CSA_WHITELIST if csa_whitelist else None, errors=private_data_errors)
 
-            scan_meta['private_data'] = parse_private_data(sample_file)
+                    for error in private_data_errors:
+                        log.warning("Unable to decode the GE private data of scan {}: {}".format(scan, error))
+                        if metrics:
+                            metrics.record_event('ge_private_data_error', archive=compressed_file, detail=error)
 
-            study_meta['data'].append(scan_meta)
+                    collect_ge_extra_meta = _is_ge_multiecho(dicom_data, log)
 
-            collect_ge_extra_meta = False
+                    if instance_headers:
+                        series_header = dicom_data
 
-            try:
-                sop_class = dicom_data['00080016']['Value'][0]
-            except (KeyError, IndexError):
-                sop_class = None
+                    parse_instances = True
 
-            try:
-                manufacturer = dicom_data['00080070']['Value'][0]
-            except (KeyError, IndexError):
-                manufacturer = None
+            instance_fnames = set(f.name for f in instance_files) if parse_instances else set()
 
-            if sop_class and manufacturer:
+            checksum_lines = []
+            instance_results = {}
 
-                if (sop_class in ["1.2.840.10008.5.1.4.1.1.4", "1.2.840.10008.5.1.4.1.1.4.1"]) and \
-                        ("ge" in manufacturer.lower() or "general electric" in manufacturer.lower()):
+            # Each file is read once, to both checksum it and (for instances) parse its header
+            for fpath, checksum, dicom_data, timings in pool.imap(
+                    _get_dicom_meta_and_checksum,
+                    [(f, f.parent == scan and f.name in instance_fnames, collect_ge_extra_meta, targeted_reads,
+                      series_header, True, parse_cache) for f in scan_files]
+            ):
 
-                    # Determine if series is likely to be multiecho and if so, collect the relevant metadata
-                    # to order the scans
-                    try:
-                        num_indices = dicom_data["00201002"]['Value'][0]
-                    except (KeyError, IndexError):
-                        num_indices = None
+                archive_timings['checksum_files'] += 1
+                archive_timings['bytes'] += timings['bytes']
+                archive_timings['checksum'] += timings['checksum']
+                archive_timings['header_parsing'] += timings['header_parsing']
 
-                    try:
-                        num_slices = dicom_data["0021104F"]['Value'][0]
-                    except (KeyError, IndexError):
-                        num_slices = None
+                if dicom_data is not None:
+                    archive_timings['parsed_files'] += 1
+                    archive_timings['parsed_bytes'] += timings['bytes']
+
+                if checksum:
+                    checksum_lines.append("{}  ./{}".format(checksum, fpath.relative_to(scan).as_posix()))
+                else:
+                    log.error("Could not compute checksum for {}".format(fpath))
 
-                    if not num_indices or not num_slices:
-                        log.info("Scan did not have number of slices or number of indices in metadata. Treating"
-                                 " as non-multiecho.")
-                    else:
+                if dicom_data is not None:
+                    instance_results[fpath.name] = dicom_data
 
-                        log.info("Num Indices: {}".format(num_indices))
-                        log.info("Num Slices: {}".format(num_slices))
+            instance_results = [(f.name, instance_results[f.name]) for f in instance_files] if parse_instances else None
 
-                        if num_indices != num_slices:
+            column_arrays = None
+
+            if instance_results:
+                column_arrays = get_column_arrays(_pop_instance_columns(instance_results))
+                scan_meta['geometry'] = compute_scan_geometry(column_arrays)
+
+            if loader:
+                exam_scans.append((scan.name, instance_results, checksum_lines))
+            else:
+                _write_scan_outputs(exam_dir, compressed_file, exam_id, scan.name, instance_results, checksum_lines,
+                                    column_arrays=column_arrays if instance_columns else None)
 
-                            if num_indices % num_slices != 0:
-                                log.warning("Multiecho testing detected possible un-accounted for slices in this "
-                                            "acquisition. Treating as a non-multiecho series.")
-                            else:
+            log.info("Computed checksums for scan {}".format(scan))
 
-                                num_echoes = num_indices // num_slices
+        if loader:
 
-                                log.info("Number of echoes detected: {}".format(num_echoes))
+            load_start = time.time()
 
-                                # Try to fetch a slice representative slice index - if unable, might be CBV scan
-                                try:
-                                    sample_slice_index = dicom_data['001910A2']['Value'][0]
-                                except (KeyError, IndexError):
-                                    sample_slice_index = None
+            load_result, msg = loader.load(study_meta, exam_scans)
 
-                                if not sample_slice_index:
-                                    log.warning("Unable to retrieve slice indices "
-                                                "(usually happens with CBV scans), treating "
-                                                "as non-multiecho series.")
-                                else:
+            if metrics:
+                metrics.record('load', load_start, time.time(), files=1, archive=compressed_file)
 
-                                    # Collect GE metadata for sorting
-                                    log.info("Scan is probable multiecho - collecting extra metadata for sorting")
-                                    collect_ge_extra_meta = True
+            if load_result == loader.LOAD_FAILED:
 
-            with open(str(exam_dir / scan_outfname), mode="wt") as outfile:
+                # Nothing is kept in the journal for the exam, so that it is processed again on resume
+                log.error(msg)
 
-                num_workers = 32
+                log.error("Removing extracted archive: {}".format(extract_dir))
 
-                with ProcessPool(num_workers) as pool:
-                    instance_results = []
+                shutil.rmtree(str(extract_dir))
 
-                    for dcm, dicom_data in pool.starmap(
-                            _get_dicom_meta,
-                            [(dcm, collect_ge_extra_meta, log) for dcm in instance_files]
-                    ):
-                        instance_results.append("{}\t{}".format(
-                            Path(dcm).name,
-                            json.dumps(dicom_data)
-                        ))
+                if budget:
+                    budget.release(compressed_file)
 
-                outfile.write("\n".join(instance_results))
+                continue
 
-        checksum_cmds = []
+            elif load_result == loader.ALREADY_LOADED:
 
-        for scan in [d for d in exam_dir.iterdir() if d.is_dir()]:
+                # Journaled as any other loaded exam, so that it is not extracted again on resume
+                log.warning(msg)
 
-            # Get checksum for files in scan
+            else:
 
-            checksum_cmd = "touch {}/{}_{}_scan_{}_checksum.txt " \
-                           "&& find . -type f | xargs -I {{}} md5sum {{}} " \
-                           ">> {}/{}_{}_scan_{}_checksum.txt".format(
-                                exam_dir,
-                                compressed_file.name.replace(".tgz", ""),
-                                exam_id,
-                                scan.name,
-                                exam_dir,
-                                compressed_file.name.replace(".tgz", ""),
-                                exam_id,
-                                scan.name
-                            )
+                log.info(msg)
 
-            checksum_cmds.append([checksum_cmd, str(scan)])
+        else:
 
-        with ProcessPool(16) as pool:
+            study_outfname = exam_dir / "study_{}_metadata.txt".format(study_meta['metadata']['exam_id'])
 
-            for msg in pool.imap(get_scan_checksums, checksum_cmds):
-                if "Could not" in msg:
-                    log.error(msg)
-                else:
-                    log.info(msg)
+            with open(str(study_outfname), "wt") as study_outfile:
+                json.dump(study_meta, study_outfile)
 
-        study_outfname = exam_dir / "study_{}_metadata.txt".format(study_meta['metadata']['exam_id'])
+        if journal:
+            journal.record(compressed_file, exam_id, 'parsed')
 
-        with open(str(study_outfname), "wt") as study_outfile:
-            json.dump(study_meta, study_outfile)
+        if metrics:
+            parse_end = time.time()
+            metrics.record('checksum', parse_start, parse_end, files=archive_timings['checksum_files'],
+                           num_bytes=archive_timings['bytes'], archive=compressed_file,
+                           busy_time=archive_timings['checksum'])
+            metrics.record('header_parsing', parse_start, parse_end, files=archive_timings['parsed_files'],
+                           num_bytes=archive_timings['parsed_bytes'], archive=compressed_file,
+                           busy_time=archive_timings['header_parsing'])
 
         log.info("Removing tmp files...")
 
-        for scan_dir in [d for d in exam_dir.iterdir() if d.is_dir()]:
-            shutil.rmtree(scan_dir)
+        cleanup_start = time.time()
 
-        readme_files = [str(f) for f in exam_dir.glob("**/*") if
-                        f.is_file() and ("_metadata.txt" not in f.name) and
-                        ("_checksum.txt" not in f.name) and ("_filelist.txt" not in f.name)]
+        if loader:
+            shutil.rmtree(str(extract_dir))
+        else:
+            cleanup_extracted_exam(exam_dir)
+
+        if budget:
+            budget.release(compressed_file)
 
-        list(map(os.remove, readme_files))
+        if metrics:
+            metrics.record('cleanup', cleanup_start, time.time(), files=1, archive=compressed_file)
 
+        if journal:
+            journal.record(compressed_file, exam_id, 'cleaned')
 
-def uncompress_tgz_files(compressed_files, settings):
+
+def uncompress_tgz_files(compressed_files, settings, metrics=None):
 
     # Note compressed_files is a list of tuples with items (filepath, exam_checksum, exam_id)
 
@@ -834,7 +1104,7 @@ def uncompress_tgz_files(compressed_files, settings):
 
         for success, extract_dir, compressed_file, exam_id, exam_checksum in pool.starmap(
                 _multithreaded_tgz_extraction,
-                [(*compressed_file, settings) for compressed_file in compressed_files]
+                [(*compressed_file, settings, metrics) for compressed_file in compressed_files]
         ):
             if success:
                 extracted_archives.append((extract_dir, compressed_file, exam_id, exam_checksum))
@@ -843,3 +1113,343 @@ def uncompress_tgz_files(compressed_files, settings):
                 msgs.append("Unable to extract archive {}".format(compressed_file))
 
     return extracted_archives, msgs
+
+
+def _pop_instance_columns(instance_results):
+    """Removes the columns collected by _build_instance_meta from the metadata of the instances of a scan,
+    returning them as (filename, columns) pairs"""
+
+    return [(fname, meta.pop('columns', None) if meta else None) for fname, meta in instance_results]
+
+
+def _write_scan_outputs(exam_dir, compressed_file, exam_id, scan_name, instance_results, checksum_lines,
+                        column_arrays=None):
+
+    if column_arrays is not None:
+        write_scan_columns(exam_dir / _scan_outfname(compressed_file, exam_id, scan_name, "columns", ext="npz"),
+                           column_arrays)
+
+    if instance_results is not None:
+
+        with open(str(exam_dir / _scan_outfname(compressed_file, exam_id, scan_name, "metadata")), "wt") as outfile:
+            outfile.write("\n".join(
+                "{}\t{}".format(fname, json.dumps(dicom_data)) for fname, dicom_data in instance_results
+            ))
+
+    with open(str(exam_dir / _scan_outfname(compressed_file, exam_id, scan_name, "checksum")), "wt") as outfile:
+        outfile.write("".join("{}\n".format(line) for line in checksum_lines))
+
+
+def _add_timing(timing, seconds, num_bytes):
+    timing['seconds'] += seconds
+    timing['files'] += 1
+    timing['bytes'] += num_bytes
+
+
+def _trim_instance_meta(meta):
+    """Drops the metadata only collected for GE multiecho scans from the metadata of an instance"""
+
+    if not meta:
+        return {'sop_instance_uid': None}
+
+    trimmed = {t['key']: meta[t['key']] for t in _instance_tags(False)}
+
+    if 'header_delta' in meta:
+        trimmed['header_delta'] = meta['header_delta']
+
+    return trimmed
+
+
+def _parse_tgz_stream(compressed_file, exam_checksum, exam_id, settings, parser_version, log=None):
+    """Parses a Gold TGZ archive straight from its decompressed stream, without extracting it. Each member
+    is read into memory, hashed and (header only) parsed by pydicom before being discarded. Produces the
+    same study, scan metadata and checksum files as uncompress_tgz_files followed by parse_metadata.
+
+    Returns (success, message, timings, exam), timings holding the time spent on each stage (and the
+    failure events to record in the run metrics, under 'events'). If settings['load'] is set, no files are
+    written and exam is the (study_meta, scans) pair to hand to ExamLoader.load, otherwise it is None."""
+
+    log = UtilsLogger(log=log if log is not None else get_worker_log())
+
+    compressed_file = Path(compressed_file)
+
+    exam_root = get_extract_dir(compressed_file, exam_id, settings['work_dir'])
+
+    session_dirs = set()
+
+    # Keyed by (pt_dir, session_dir, scan_dir)
+    scans = OrderedDict()
+
+    # Time spent decompressing, checksumming and parsing the members of the archive, for the run metrics
+    timings = {
+        'extraction': {'seconds': 0.0, 'files': 0, 'bytes': 0},
+        'checksum': {'seconds': 0.0, 'files': 0, 'bytes': 0},
+        'header_parsing': {'seconds': 0.0, 'files': 0, 'bytes': 0},
+        'events': [],  # (event, detail) of the failures to record, e.g. undecodable GE private data
+    }
+
+    def _get_scan(scan_key):
+        return scans.setdefault(scan_key, {
+            'instances': [],
+            'checksums': [],
+            'errors': [],
+            'sample': None,
+            'header': None,  # JSON header of the sample, with --instance_headers
+            'unsampled': [],  # (index, JSON header) of the instances read before the sample
+        })
+
+    instance_headers = settings.get('instance_headers', False)
+    write_columns = settings.get('instance_columns', False) and not settings.get('load', False)
+
+    proc = Popen(["unpigz", "--keep", "--stdout", str(compressed_file)], stdout=PIPE, stderr=DEVNULL)
+
+    try:
+
+        with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+
+            for member in tar:
+
+                parts = tuple(p for p in PurePosixPath(member.name).parts if p not in (".", "/"))
+
+                if len(parts) >= 2:
+                    session_dirs.add(parts[:2])
+
+                if member.isdir():
+
+                    if len(parts) == 3:
+                        _get_scan(parts)
+
+                    continue
+
+                if not member.isfile() or len(parts) < 4:
+                    continue
+
+                scan = _get_scan(parts[:3])
+
+                start = time.perf_counter()
+
+                data = tar.extractfile(member).read()
+
+                read_end = time.perf_counter()
+
+                checksum = hashlib.md5(data).hexdigest()
+
+                scan['checksums'].append("{}  ./{}".format(checksum, "/".join(parts[3:])))
+
+                _add_timing(timings['extraction'], read_end - start, len(data))
+                _add_timing(timings['checksum'], time.perf_counter() - read_end, len(data))
+
+                fname = parts[3]
+
+                if len(parts) > 4 or "README" in fname:
+                    continue
+
+                # The first DICOM of each scan is read in full to provide the scan-level metadata
+                is_sample = scan['sample'] is None and fname.endswith(".dcm")
+
+                start = time.perf_counter()
+
+                # Whether the scan is GE multiecho is only known once its sample header is parsed, so
+                # collect the extended metadata for every instance and trim it down when writing
+                try:
+                    extracted, dicom_dataset = _extract_cached(
+                        data, checksum, _instance_extractors(True, header=instance_headers, columns=True),
+                        parse_cache=settings.get('parse_cache', None),
+                        targeted=settings.get('targeted_reads', False) and not is_sample, sample=is_sample)
+                except (InvalidDicomError, IOError, OSError) as e:
+                    # Only reported if the scan turns out to contain DICOMs, as in parse_metadata
+                    scan['errors'].append((member.name, e))
+                    scan['instances'].append((fname, None))
+                    _add_timing(timings['header_parsing'], time.perf_counter() - start, len(data))
+                    continue
+
+                _add_timing(timings['header_parsing'], time.perf_counter() - start, len(data))
+
+                if is_sample:
+                    scan['sample'] = dicom_dataset
+                    if instance_headers:
+                        scan['header'] = extracted['header']
+
+                # The header deltas of instances read before the sample are computed once it is known
+                if instance_headers and scan['header'] is None:
+                    scan['unsampled'].append((len(scan['instances']), extracted['header']))
+
+                scan['instances'].append((fname, _build_instance_meta(extracted, True, series_header=scan['header'],
+                                                                      columns=True)))
+
+        proc.stdout.close()
+        proc.wait()
+
+    except (tarfile.TarError, OSError) as e:
+
+        proc.kill()
+        proc.wait()
+
+        return False, "Unable to stream archive {}: {}".format(compressed_file, e), timings, None
+
+    if proc.returncode != 0:
+        return False, "Unable to stream archive {}".format(compressed_file), timings, None
+
+    if len(session_dirs) != 1:
+        return False, "Invalid number of session directories for exam {}. " \
+                      "Skipping DICOM parsing.".format(compressed_file), timings, None
+
+    session = session_dirs.pop()
+
+    exam_dir = exam_root.joinpath(*session)
+
+    session_scans = [(key[2], scan) for key, scan in scans.items() if key[:2] == session]
+
+    if not session_scans:
+        return False, "No scans found in exam {}".format(compressed_file), timings, None
+
+    load = settings.get('load', False)
+
+    if not (load or exam_dir.is_dir()):
+        exam_dir.mkdir(parents=True, exist_ok=True)
+
+    study_meta = _new_study_meta(exam_id, compressed_file, exam_checksum, parser_version)
+
+    exam_scans = []
+
+    for scan_name, scan in session_scans:
+
+        instance_results = None
+        column_arrays = None
+
+        if not scan['instances']:
+
+            log.error("No instances files found in subdirectory {}".format(scan_name))
+
+        else:
+
+            scan_meta = _new_scan_meta(exam_id, scan_name, len(scan['instances']), parser_version)
+
+            study_meta['data'].append(scan_meta)
+
+            if scan['sample'] is None:
+
+                if any(fname.endswith(".dcm") for fname, _ in scan['instances']):
+                    log.error("Unable to open any DICOMs for scan {}".format(scan_name))
+
+            else:
+
+                log.info("Found {} DICOM files for scan {} of exam {}".format(
+                    len(scan['instances']),
+                    scan_name,
+                    compressed_file)
+                )
+
+                dicom_data = scan['header'] if scan['header'] is not None else encode_dataset(scan['sample'])
+
+                scan_meta['dicom_data'] = dicom_data
+
+                for index, header in scan['unsampled']:
+                    scan['instances'][index][1]['header_delta'] = get_header_delta(dicom_data, header)
+
+                column_arrays = get_column_arrays(_pop_instance_columns(scan['instances']))
+
+                scan_meta['geometry'] = compute_scan_geometry(column_arrays)
+
+                private_data_errors = []
+
+                scan_meta['private_data'] = parse_private_data(
+                    scan['sample'], csa_fields=CSA_WHITELIST if settings.get('csa_whitelist', False) else None,
+                    errors=private_data_errors)
+
+                for error in private_data_errors:
+                    log.warning("Unable to decode the GE private data of scan {}: {}".format(scan_name, error))
+                    timings['events'].append(('ge_private_data_error', error))
+
+                for member_name, e in scan['errors']:
+                    log.error("Unable to read: {}".format(member_name))
+                    log.error(e)
+
+                if _is_ge_multiecho(dicom_data, log):
+                    instance_results = [
+                        (fname, meta if meta else {'sop_instance_uid': None})
+                        for fname, meta in scan['instances']
+                    ]
+                else:
+                    instance_results = [
+                        (fname, _trim_instance_meta(meta))
+                        for fname, meta in scan['instances']
+                    ]
+
+        if load:
+            exam_scans.append((scan_name, instance_results, scan['checksums']))
+        else:
+            _write_scan_outputs(exam_dir, compressed_file, exam_id, scan_name, instance_results, scan['checksums'],
+                                column_arrays=column_arrays if write_columns else None)
+
+    if load:
+        return True, "Parsed archive {}".format(compressed_file), timings, (study_meta, exam_scans)
+
+    study_outfname = exam_dir / "study_{}_metadata.txt".format(exam_id)
+
+    with open(str(study_outfname), "wt") as study_outfile:
+        json.dump(study_meta, study_outfile)
+
+    return True, "Parsed archive {}".format(compressed_file), timings, None
+
+
+def stream_tgz_files(compressed_files, settings, parser_version, log=None, pool=None, journal=None, metrics=None,
+                     loader=None):
+    """Parses Gold TGZ archives directly from their compressed streams, without extracting them to the
+    work directory. Archives are processed in parallel, one per worker process. If a loader is given (and
+    settings['load'] is set), each parsed exam is loaded into the databases from this process."""
+
+    # Note compressed_files is a list of tuples with items (filepath, exam_checksum, exam_id)
+
+    if pool is None:
+        with ParserWorkerPool(num_workers=settings['tgz_cores'], chunksize=1, log=log) as pool:
+            return stream_tgz_files(compressed_files, settings, parser_version, log=log, pool=pool,
+                                    journal=journal, metrics=metrics, loader=loader)
+
+    msgs = []
+
+    # Archives vary wildly in size, so hand them out one at a time
+    results = pool.imap(
+        _parse_tgz_stream,
+        [(*compressed_file, settings, parser_version) for compressed_file in compressed_files],
+        chunksize=1
+    )
+
+    start = time.time()
+
+    for (compressed_file, _, exam_id), (success, msg, timings, exam) in zip(compressed_files, results):
+
+        # Archives are handled concurrently, so the time between results bounds the span of each one
+        end = time.time()
+
+        if metrics:
+            for event, detail in timings.pop('events', []):
+                metrics.record_event(event, archive=compressed_file, detail=detail)
+            for stage, timing in timings.items():
+                metrics.record(stage, start, end, files=timing['files'], num_bytes=timing['bytes'],
+                               archive=compressed_file, busy_time=timing['seconds'])
+
+        start = end
+
+        if success and loader and exam:
+
+            msgs.append(msg)
+
+            load_result, msg = loader.load(*exam)
+
+            # An exam already in the database is journaled as loaded
+            success = load_result != loader.LOAD_FAILED
+
+            if metrics:
+                metrics.record('load', end, time.time(), files=1, archive=compressed_file)
+
+            start = time.time()
+
+        # Nothing is extracted when streaming, so there is nothing left to clean up once parsed
+        if success and journal:
+            journal.record(compressed_file, exam_id, 'parsed')
+            journal.record(compressed_file, exam_id, 'cleaned')
+
+        msgs.append(msg)
+
+    return msgs
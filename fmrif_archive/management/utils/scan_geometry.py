@@ -0,0 +1,151 @@
+import numpy as np
+
+
+# MRScan fields filled from the geometry computed by compute_scan_geometry
+SCAN_GEOMETRY_FIELDS = (
+    'num_slices',
+    'slice_spacing',
+    'num_echoes',
+    'num_volumes',
+    'missing_slices',
+    'missing_instances',
+    'instance_order',
+)
+
+
+def _rank_within_groups(groups, *sort_keys):
+    """Rank of each element within its group, ordered by sort_keys (the last one being the primary key)"""
+
+    order = np.lexsort(sort_keys + (groups,))
+
+    sorted_groups = groups[order]
+
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    lengths = np.diff(np.r_[starts, len(order)])
+
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - np.repeat(starts, lengths)
+
+    return ranks
+
+
+def _slice_tolerance(distances, slice_thickness, slice_tolerance):
+    """The distance (mm) within which instance positions along the slice normal are taken as the same slice
+    position: slice_tolerance times the slice thickness or, for instances without one, times the slice
+    spacing estimated from the gaps between the positions"""
+
+    thickness = slice_thickness[np.isfinite(slice_thickness) & (slice_thickness > 0)]
+
+    if len(thickness):
+        return slice_tolerance * float(np.median(thickness))
+
+    gaps = np.diff(np.sort(distances))
+
+    # All the instances at one position
+    if not len(gaps) or gaps.max() <= 0:
+        return 0.0
+
+    # Gaps between slice positions are the ones of the order of the largest gap, as opposed to the jitter
+    # between instances at the same position
+    spacing = float(np.median(gaps[gaps > slice_tolerance * gaps.max()]))
+
+    return slice_tolerance * spacing
+
+
+def _bin_slices(distances, tolerance):
+    """Groups positions along the slice normal into slice positions, starting a new one wherever the gap to
+    the previous position (in sorted order) exceeds tolerance. Returns the mean position of each slice, in
+    increasing order, and the index of the slice of each position."""
+
+    order = np.argsort(distances, kind='stable')
+
+    sorted_distances = distances[order]
+
+    sorted_indices = np.cumsum(np.r_[True, np.diff(sorted_distances) > tolerance]) - 1
+
+    slice_indices = np.empty(len(distances), dtype=np.int64)
+    slice_indices[order] = sorted_indices
+
+    slice_locations = np.bincount(sorted_indices, weights=sorted_distances) / np.bincount(sorted_indices)
+
+    return slice_locations, slice_indices
+
+
+def compute_scan_geometry(columns, tolerance=1e-3, slice_tolerance=0.1):
+    """Computes the slice geometry of a scan from the column arrays of its instances (see
+    instance_columns.get_column_arrays):
+
+    - num_slices: number of distinct slice positions along the slice normal, within slice_tolerance times
+      the slice thickness (see _slice_tolerance), so that jitter in the positions of the instances of a
+      slice does not split it
+    - slice_spacing: median distance between adjacent slice positions
+    - num_echoes: number of distinct echo numbers
+    - num_volumes: largest number of instances at any slice position and echo
+    - missing_slices: number of slice positions missing from gaps in the slice stack
+    - missing_instances: number of instances missing for every slice position and echo to have num_volumes
+    - instance_order: filenames ordered by volume, echo and slice position, volumes being numbered by
+      instance number (then acquisition time) within each slice position and echo
+
+    Instances without a position are left out. Returns None if no instance has a position, or if the
+    instances do not share an orientation, within tolerance (e.g. localizers)."""
+
+    positions = columns['image_position_patient']
+    orientations = columns['image_orientation_patient']
+
+    has_orientation = np.isfinite(orientations).all(axis=1)
+
+    if not has_orientation.any():
+        return None
+
+    if np.abs(orientations[has_orientation] - orientations[has_orientation][0]).max() > tolerance:
+        return None
+
+    orientation = orientations[has_orientation][0]
+
+    distances = positions @ np.cross(orientation[:3], orientation[3:])
+
+    valid = np.isfinite(distances)
+
+    if not valid.any():
+        return None
+
+    distances = distances[valid]
+
+    slice_locations, slice_indices = _bin_slices(
+        distances, _slice_tolerance(distances, columns['slice_thickness'][valid], slice_tolerance))
+    echo_numbers, echo_indices = np.unique(columns['echo_number'][valid], return_inverse=True)
+
+    num_slices = len(slice_locations)
+    num_echoes = len(echo_numbers)
+
+    slice_spacing = None
+    missing_slices = 0
+
+    if num_slices > 1:
+
+        gaps = np.diff(slice_locations)
+
+        slice_spacing = float(np.median(gaps))
+
+        missing_slices = int(np.maximum(np.round(gaps / slice_spacing) - 1, 0).sum())
+
+    groups = slice_indices * num_echoes + echo_indices
+
+    counts = np.bincount(groups, minlength=num_slices * num_echoes)
+
+    num_volumes = int(counts.max())
+
+    volume_indices = _rank_within_groups(groups, columns['acquisition_time'][valid],
+                                         columns['instance_number'][valid])
+
+    order = np.lexsort((slice_indices, echo_indices, volume_indices))
+
+    return {
+        'num_slices': num_slices,
+        'slice_spacing': round(slice_spacing, 6) if slice_spacing is not None else None,
+        'num_echoes': num_echoes,
+        'num_volumes': num_volumes,
+        'missing_slices': missing_slices,
+        'missing_instances': int(num_slices * num_echoes * num_volumes - valid.sum()),
+        'instance_order': columns['filename'][valid][order].tolist(),
+    }
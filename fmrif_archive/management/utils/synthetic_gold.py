@@ -0,0 +1,238 @@
+import gzip
+import random
+import struct
+import tarfile
+
+from datetime import date, timedelta
+from io import BytesIO
+from pathlib import Path
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+
+MR_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.4"
+
+SYNTHETIC_MANUFACTURERS = {
+    'fmrif3ta': "SIEMENS",
+    'fmrif3tb': "SIEMENS",
+    'fmrif3tc': "GE MEDICAL SYSTEMS",
+    'fmrif3td': "GE MEDICAL SYSTEMS",
+    'fmrif7t': "SIEMENS",
+}
+
+
+def _csa_header(tags):
+    """Packs a list of (name, vr, items) tuples into a Siemens CSA2 ("SV10") header"""
+
+    out = [b"SV10", b"\x04\x03\x02\x01", struct.pack("<2I", len(tags), 77)]
+
+    for name, vr, items in tags:
+
+        out.append(struct.pack("<64si4s3i", name.encode('ascii'), len(items), vr.encode('ascii'), 0,
+                               len(items), 77))
+
+        for item in items:
+
+            item = item.encode('ascii') + b"\x00"
+
+            out.append(struct.pack("<4i", len(item), len(item), 77, len(item)))
+            out.append(item + b"\x00" * ((4 - len(item) % 4) % 4))
+
+    return b"".join(out)
+
+
+def _ge_private_blob(num_dirs, bvalue):
+    """A (0025,101B) value: padding bytes followed by a gzip-compressed list of key/value pairs"""
+
+    private_dat = "bvalue {}\nnum_dirs \"{}\"\ntensor 1\nuser_data \"{}\"\n".format(bvalue, num_dirs,
+                                                                                     "0.0 " * 16)
+
+    return b"\x00\x00" + gzip.compress(private_dat.encode('ascii'))
+
+
+def make_synthetic_instance(manufacturer, station_name, study, series, instance_number, slice_index, echo,
+                            num_slices, num_echoes, matrix=64):
+    """Generates the bytes of one MR image instance, with the vendor private data the parser decodes"""
+
+    sop_instance_uid = generate_uid(entropy_srcs=[series['uid'], str(instance_number)])
+
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = MR_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = FileDataset("", {}, file_meta=file_meta, preamble=b"\x00" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    ds.SOPClassUID = MR_IMAGE_STORAGE
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.Modality = "MR"
+    ds.Manufacturer = manufacturer
+    ds.StationName = station_name
+    ds.StudyInstanceUID = study['uid']
+    ds.StudyID = study['id']
+    ds.StudyDate = study['date']
+    ds.StudyTime = study['time']
+    ds.StudyDescription = "SYNTHETIC^BENCHMARK"
+    ds.AccessionNumber = study['accession']
+    ds.PatientName = study['patient_name']
+    ds.PatientID = study['patient_id']
+    ds.PatientSex = "O"
+    ds.PatientBirthDate = "19800101"
+    ds.SeriesInstanceUID = series['uid']
+    ds.SeriesNumber = series['number']
+    ds.SeriesDescription = series['description']
+    ds.ProtocolName = series['description']
+    ds.InstanceNumber = instance_number
+    ds.AcquisitionNumber = 1
+    ds.AcquisitionTime = study['time']
+    ds.EchoNumbers = echo
+    ds.EchoTime = "{:.1f}".format(10.0 * echo)
+    ds.RepetitionTime = "2000.0"
+    ds.MagneticFieldStrength = "3.0"
+    ds.SliceThickness = "2.5"
+    ds.SliceLocation = "{:.1f}".format(slice_index * 2.5)
+    ds.ImagePositionPatient = ["-120.0", "-120.0", "{:.1f}".format(slice_index * 2.5)]
+    ds.ImageOrientationPatient = ["1", "0", "0", "0", "1", "0"]
+    ds.PixelSpacing = ["3.75", "3.75"]
+    ds.ImagesInAcquisition = num_slices * num_echoes
+
+    if manufacturer == "SIEMENS":
+
+        ds.add_new((0x0029, 0x0010), 'LO', "SIEMENS CSA HEADER")
+        ds.add_new((0x0029, 0x1010), 'OB', _csa_header([
+            ("EchoLinePosition", "IS", ["32"]),
+            ("EchoColumnPosition", "IS", ["32"]),
+            ("NumberOfImagesInMosaic", "US", [str(num_slices)]),
+            ("SliceMeasurementDuration", "DS", ["{:.1f}".format(2000.0 / num_slices)]),
+            ("B_value", "IS", [str(series['bvalue'])]),
+            ("DiffusionGradientDirection", "FD", ["0.0", "0.0", "1.0"]),
+            ("ImaAbsTablePosition", "SL", ["0", "0", "-1200"]),
+            ("MosaicRefAcqTimes", "FD", ["{:.1f}".format(i * 2000.0 / num_slices)
+                                         for i in range(num_slices)]),
+        ]))
+        ds.add_new((0x0029, 0x1020), 'OB', _csa_header([
+            ("UsedPatientWeight", "IS", ["70"]),
+            ("CoilForGradient", "SH", ["AS82"]),
+        ]))
+
+    else:
+
+        ds.add_new((0x0019, 0x0010), 'LO', "GEMS_ACQU_01")
+        ds.add_new((0x0019, 0x10A2), 'SL', slice_index + 1)
+        ds.add_new((0x0021, 0x0010), 'LO', "GEMS_RELA_01")
+        ds.add_new((0x0021, 0x104F), 'SS', num_slices)
+        ds.add_new((0x0025, 0x0010), 'LO', "GEMS_SERS_01")
+        ds.add_new((0x0025, 0x101B), 'OB', _ge_private_blob(series['num_dirs'], series['bvalue']))
+
+    ds.Rows = matrix
+    ds.Columns = matrix
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.SamplesPerPixel = 1
+    ds.PixelRepresentation = 0
+    ds.PhotometricInterpretation = "MONOCHROME2"
+
+    # 12-bit noise, so that the archives compress roughly like real images
+    num_pixels = matrix * matrix
+    pixel_rng = random.Random(sop_instance_uid)
+    ds.PixelData = struct.pack("<{}H".format(num_pixels), *(pixel_rng.getrandbits(12) for _ in range(num_pixels)))
+
+    outfile = BytesIO()
+    ds.save_as(outfile, write_like_original=False)
+
+    return outfile.getvalue()
+
+
+def make_synthetic_archive(fpath, scanner, exam_date, exam_no, scans_per_exam=4, num_slices=16, num_echoes=3,
+                           matrix=64, rng=None):
+    """Writes a Gold-like TGZ archive of one exam: a patient/session directory with one directory per
+    series, README files, and a non-DICOM directory. Every other series is multiecho."""
+
+    rng = rng if rng else random.Random(str(fpath))
+
+    manufacturer = SYNTHETIC_MANUFACTURERS.get(scanner, "SIEMENS")
+
+    study = {
+        'uid': generate_uid(entropy_srcs=[scanner, str(exam_date), str(exam_no)]),
+        'id': str(exam_no + 1),
+        'date': exam_date.strftime("%Y%m%d"),
+        'time': "{:02d}{:02d}{:02d}".format(rng.randint(7, 19), rng.randint(0, 59), rng.randint(0, 59)),
+        'accession': "{:08d}".format(rng.randint(0, 99999999)),
+        'patient_name': "SYNTHETIC^SUBJECT{:04d}".format(rng.randint(0, 9999)),
+        'patient_id': "{:06d}".format(rng.randint(0, 999999)),
+    }
+
+    pt_dir = "{}-{}".format(study['patient_name'].replace("^", "_"), study['patient_id'])
+    session_dir = "{}-{}".format(study['date'], exam_no + 1)
+
+    Path(fpath).parent.mkdir(parents=True, exist_ok=True)
+
+    with tarfile.open(str(fpath), "w:gz") as tar:
+
+        def _add(name, data):
+            info = tarfile.TarInfo("{}/{}/{}".format(pt_dir, session_dir, name))
+            info.size = len(data)
+            tar.addfile(info, BytesIO(data))
+
+        for scan_no in range(scans_per_exam):
+
+            echoes = num_echoes if scan_no % 2 else 1
+
+            series = {
+                'uid': generate_uid(entropy_srcs=[study['uid'], str(scan_no)]),
+                'number': scan_no + 1,
+                'description': "ep2d_multiecho" if echoes > 1 else "ep2d_diff",
+                'bvalue': 0 if echoes > 1 else 1000,
+                'num_dirs': 0 if echoes > 1 else 30,
+            }
+
+            scan_name = "mr_{:04d}".format(scan_no + 1)
+
+            instance_number = 0
+
+            for slice_index in range(num_slices):
+                for echo in range(1, echoes + 1):
+
+                    instance_number += 1
+
+                    _add("{}/{}_{:04d}.dcm".format(scan_name, scan_name, instance_number),
+                         make_synthetic_instance(manufacturer, scanner, study, series, instance_number,
+                                                 slice_index, echo, num_slices, echoes, matrix=matrix))
+
+            _add("{}/README.txt".format(scan_name), "Series {}\n".format(series['number']).encode('ascii'))
+
+        _add("other/notes.txt", b"Synthetic exam generated for benchmarking\n")
+        _add("README_session.txt", b"Synthetic session\n")
+
+
+def make_synthetic_gold_tree(data_dir, scanners, start_date=date(2019, 1, 1), num_days=2, exams_per_day=2,
+                             scans_per_exam=4, num_slices=16, num_echoes=3, matrix=64, seed=0):
+    """Writes a synthetic Gold archive tree of the form <scanner>/YYYY/MM/DD/<subdir>/<archive>.tgz and
+    returns the paths of the archives written"""
+
+    rng = random.Random(seed)
+
+    archives = []
+
+    for scanner in scanners:
+        for day_no in range(num_days):
+
+            exam_date = start_date + timedelta(days=day_no)
+
+            for exam_no in range(exams_per_day):
+
+                subdir = "{}_{:03d}".format(exam_date.strftime("%Y%m%d"), exam_no + 1)
+
+                fpath = Path(data_dir) / scanner / exam_date.strftime("%Y/%m/%d") / subdir / \
+                    "{}.tgz".format(subdir)
+
+                make_synthetic_archive(fpath, scanner, exam_date, exam_no, scans_per_exam=scans_per_exam,
+                                       num_slices=num_slices, num_echoes=num_echoes, matrix=matrix,
+                                       rng=random.Random(rng.random()))
+
+                archives.append(fpath)
+
+    return archives
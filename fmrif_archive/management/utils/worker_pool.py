@@ -0,0 +1,107 @@
+import logging
+import os
+import time
+
+from collections import defaultdict
+from functools import partial
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import Pool as ProcessPool
+from multiprocessing import Queue as ProcessQueue
+
+
+# Logger used by tasks running inside the worker processes. Its records are forwarded through a queue
+# to the parent process, which writes them with the handlers of the parser's log.
+_worker_log = None
+
+
+def _init_worker(log_queue):
+
+    global _worker_log
+
+    _worker_log = logging.getLogger("parser.worker")
+    _worker_log.handlers = [QueueHandler(log_queue)]
+    _worker_log.setLevel(logging.INFO)
+    _worker_log.propagate = False
+
+
+def get_worker_log():
+    """The logger to use inside a pool task, or None when not running inside a ParserWorkerPool"""
+    return _worker_log
+
+
+def _timed_call(func, args):
+
+    start = time.perf_counter()
+
+    res = func(*args)
+
+    return os.getpid(), time.perf_counter() - start, res
+
+
+class ParserWorkerPool:
+    """A process pool shared by all the parsing work of a run, so that workers are started once rather
+    than per scan or per exam. Tasks are submitted in chunks, logging from the workers is funnelled to the
+    parent through a queue, and per-worker task counts and busy time are kept for a final report."""
+
+    def __init__(self, num_workers=32, chunksize=8, log=None):
+
+        self.num_workers = num_workers
+        self.chunksize = chunksize
+
+        handlers = list(getattr(log, 'handlers', []) or [logging.StreamHandler()])
+
+        self.log_queue = ProcessQueue()
+        self.listener = QueueListener(self.log_queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+
+        self.pool = ProcessPool(num_workers, initializer=_init_worker, initargs=(self.log_queue,))
+
+        self.started = time.perf_counter()
+
+        self.stats = defaultdict(lambda: {'tasks': 0, 'busy_time': 0.0})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def imap(self, func, args_list, chunksize=None):
+        """Yields func(*args) for each args tuple, in order"""
+
+        chunksize = chunksize if chunksize else self.chunksize
+
+        for pid, elapsed, res in self.pool.imap(partial(_timed_call, func), args_list, chunksize=chunksize):
+
+            self.stats[pid]['tasks'] += 1
+            self.stats[pid]['busy_time'] += elapsed
+
+            yield res
+
+    def starmap(self, func, args_list, chunksize=None):
+        return list(self.imap(func, args_list, chunksize=chunksize))
+
+    def report(self, log):
+
+        wall_time = time.perf_counter() - self.started
+
+        log.info("Worker pool: {} workers, {:.1f}s wall time".format(self.num_workers, wall_time))
+
+        for pid, stats in sorted(self.stats.items()):
+
+            rate = stats['tasks'] / stats['busy_time'] if stats['busy_time'] else 0.0
+
+            log.info("Worker {}: {} tasks, {:.1f}s busy ({:.0%} utilization), {:.1f} tasks/s".format(
+                pid,
+                stats['tasks'],
+                stats['busy_time'],
+                stats['busy_time'] / wall_time if wall_time else 0.0,
+                rate
+            ))
+
+    def close(self):
+
+        self.pool.close()
+        self.pool.join()
+
+        self.listener.stop()
@@ -3,6 +3,7 @@ from fmrif_base.models import Protocol, ResearchGroup
 from django.utils import timezone
 from django.contrib.postgres.fields import ArrayField, JSONField
 from django.core.exceptions import ValidationError
+from fmrif_archive.utils import apply_header_delta
 
 
 class Exam(models.Model):
@@ -98,6 +99,24 @@ class MRScan(BaseFileCollection):
     dicom_metadata = JSONField(null=True, blank=True)
     private_dicom_metadata = JSONField(null=True, blank=True)
 
+    # Slice geometry computed at ingest from the positions and echo numbers of the instances (see
+    # compute_scan_geometry in management/utils/scan_geometry.py). instance_order lists the filenames of the
+    # instances ordered by volume, echo and slice position.
+    num_slices = models.PositiveIntegerField(null=True)
+    slice_spacing = models.FloatField(null=True)
+    num_echoes = models.PositiveSmallIntegerField(null=True)
+    num_volumes = models.PositiveIntegerField(null=True)
+    missing_slices = models.PositiveIntegerField(null=True)
+    missing_instances = models.PositiveIntegerField(null=True)
+    instance_order = JSONField(null=True, blank=True)
+
+    # Diffusion and acquisition parameters decoded from the protocol data block of GE scans (see
+    # GE_PROTOCOL_FIELDS in management/utils/ge_private.py), null for other scans
+    b_value = models.FloatField(null=True, db_index=True)
+    num_diffusion_directions = models.PositiveIntegerField(null=True, db_index=True)
+    diffusion_tensor = models.PositiveSmallIntegerField(null=True)
+    multiband_factor = models.PositiveSmallIntegerField(null=True, db_index=True)
+
 
 class FileCollection(BaseFileCollection):
 
@@ -130,13 +149,40 @@ class DICOMInstance(BaseFile):
     slice_index = models.PositiveIntegerField(null=True)
     image_position_patient = JSONField(null=True)
 
+    # Elements of the DICOM header that differ from the header of the parent scan (dicom_metadata), for
+    # exams parsed with --instance_headers. See get_dicom_metadata.
+    header_delta = JSONField(null=True, blank=True)
+
     parent_scan = models.ForeignKey('MRScan', related_name='dicom_files', on_delete=models.PROTECT)
 
+    def get_dicom_metadata(self):
+        """Full DICOM header of the instance, reconstructed from the header of its scan. None if the
+        instance was parsed without its header delta."""
+
+        if self.header_delta is None or self.parent_scan.dicom_metadata is None:
+            return None
+
+        return apply_header_delta(self.parent_scan.dicom_metadata, self.header_delta)
+
+    class Meta(BaseFile.Meta):
+        unique_together = (
+            'parent_scan',
+            'filename',
+            'checksum',
+        )
+
 
 class File(BaseFile):
 
     parent_collection = models.ForeignKey('FileCollection', related_name='files', on_delete=models.PROTECT)
 
+    class Meta(BaseFile.Meta):
+        unique_together = (
+            'parent_collection',
+            'filename',
+            'checksum',
+        )
+
 
 class MRBIDSAnnotation(models.Model):
 
@@ -133,6 +133,16 @@ class MRScanSerializer(serializers.ModelSerializer):
             'series_instance_uid',
             'series_number',
             'scan_sequence',
+            'num_slices',
+            'slice_spacing',
+            'num_echoes',
+            'num_volumes',
+            'missing_slices',
+            'missing_instances',
+            'b_value',
+            'num_diffusion_directions',
+            'diffusion_tensor',
+            'multiband_factor',
             'dicom_metadata',
             'private_dicom_metadata',
             'dicom_files',
@@ -156,6 +166,16 @@ class MRScanSerializer(serializers.ModelSerializer):
             'series_instance_uid',
             'series_number',
             'scan_sequence',
+            'num_slices',
+            'slice_spacing',
+            'num_echoes',
+            'num_volumes',
+            'missing_slices',
+            'missing_instances',
+            'b_value',
+            'num_diffusion_directions',
+            'diffusion_tensor',
+            'multiband_factor',
             'dicom_metadata',
             'private_dicom_metadata',
             'dicom_files',
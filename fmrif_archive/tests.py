@@ -1,3 +1,119 @@
-from django.test import TestCase
+import json
+import shutil
+import tempfile
+import unittest
 
-# Create your tests here.
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from pathlib import Path
+from fmrif_archive.models import Exam, MRScan, FileCollection, DICOMInstance, File
+from fmrif_archive.management.utils.instance_copy import (
+    clean_integer_field,
+    copy_dicom_instances,
+    copy_files,
+    ECHO_NUMBER_MAX,
+    SLICE_INDEX_MAX,
+)
+from fmrif_archive.utils import get_header_delta
+
+
+class CleanIntegerFieldTests(SimpleTestCase):
+
+    def test_clean_integer_field(self):
+
+        self.assertEqual(clean_integer_field(1, ECHO_NUMBER_MAX), 1)
+        self.assertEqual(clean_integer_field("7", SLICE_INDEX_MAX), 7)
+        self.assertEqual(clean_integer_field("1.0", ECHO_NUMBER_MAX), 1)
+        self.assertEqual(clean_integer_field(2.0, ECHO_NUMBER_MAX), 2)
+
+        for value in (None, "", "1.5", "abc", "-1", " 1", True, 70000):
+            self.assertIsNone(clean_integer_field(value, ECHO_NUMBER_MAX), value)
+
+        self.assertEqual(clean_integer_field(70000, SLICE_INDEX_MAX), 70000)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "COPY loaders require PostgreSQL")
+class InstanceCopyTests(TestCase):
+
+    def setUp(self):
+
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tmp_dir))
+
+        exam = Exam.objects.create(exam_id="e" * 64, parser_version="1", filepath="/gold/exam.tgz", checksum="c" * 32)
+
+        self.scan = MRScan.objects.create(parent_exam=exam, name="1", num_files=4)
+        self.collection = FileCollection.objects.create(parent_exam=exam, name="2", num_files=2)
+
+        self.checksum_file = self.tmp_dir / "exam_scan_1_checksum.txt"
+        self.metadata_file = self.tmp_dir / "exam_scan_1_metadata.txt"
+        self.other_checksum_file = self.tmp_dir / "exam_scan_2_checksum.txt"
+
+        self.header_delta = get_header_delta(
+            {"00080008": {"vr": "CS", "Value": ["ORIGINAL"]}, "00200013": {"vr": "IS", "Value": [2]}},
+            {"00200013": {"vr": "IS", "Value": [1]}}
+        )
+
+        self.checksum_file.write_text(
+            "{}  ./mr_0001.dcm\n{}  ./mr_0002.dcm\n{}  ./mr_0003.dcm\n{}  ./mr_0004.dcm\n{}  ./README\n".format(
+                *("{:032x}".format(i) for i in range(5)))
+        )
+
+        self.metadata_file.write_text(
+            './mr_0001.dcm\t{"echo_number": 1, "raw_data_run_number": 7, "sop_instance_uid": "1.2.3", '
+            '"image_position_patient": [0.0, 1.5, -2.0], "header_delta": ' + json.dumps(self.header_delta) + '}\n'
+            './mr_0002.dcm\t{"echo_number": "1.0", "raw_data_run_number": "", "sop_instance_uid": "a\\\\b\\"c"}\n'
+            './mr_0003.dcm\t{"echo_number": 70000, "raw_data_run_number": "1.5", "image_position_patient": null}\n'
+        )
+
+        self.other_checksum_file.write_text("{}  ./notes.txt\n{}  ./readme.txt\n".format("a" * 32, "b" * 32))
+
+    def copy(self):
+
+        with connection.cursor() as cursor:
+            num_instances = copy_dicom_instances(cursor, [(self.scan.id, self.checksum_file, self.metadata_file)])
+            num_files = copy_files(cursor, [(self.collection.id, self.other_checksum_file)])
+
+        return num_instances, num_files
+
+    def test_copy_instances(self):
+
+        self.assertEqual(self.copy(), (4, 1))
+
+        instances = dict((inst.filename, inst) for inst in DICOMInstance.objects.filter(parent_scan=self.scan))
+
+        self.assertEqual(sorted(instances), ["mr_0001.dcm", "mr_0002.dcm", "mr_0003.dcm", "mr_0004.dcm"])
+
+        inst = instances["mr_0001.dcm"]
+        self.assertEqual((inst.file_type, inst.checksum), ('dicom', "{:032x}".format(0)))
+        self.assertEqual((inst.echo_number, inst.slice_index, inst.sop_instance_uid), (1, 7, "1.2.3"))
+        self.assertEqual(inst.image_position_patient, [0.0, 1.5, -2.0])
+        self.assertEqual(inst.header_delta, {'set': {"00200013": {"vr": "IS", "Value": [1]}}, 'unset': ["00080008"]})
+
+        # Values that are not valid integers are stored as NULL rather than failing the exam, as clean_integer_field
+        # does for the other loaders
+        inst = instances["mr_0002.dcm"]
+        self.assertEqual((inst.echo_number, inst.slice_index, inst.sop_instance_uid), (1, None, 'a\\b"c'))
+
+        inst = instances["mr_0003.dcm"]
+        self.assertEqual((inst.echo_number, inst.slice_index, inst.image_position_patient), (None, None, None))
+
+        # Instances without metadata
+        inst = instances["mr_0004.dcm"]
+        self.assertEqual((inst.echo_number, inst.sop_instance_uid, inst.header_delta), (None, None, None))
+
+        self.assertEqual(list(File.objects.values_list('filename', 'file_type')), [("notes.txt", 'other')])
+
+    def test_copy_skips_existing(self):
+
+        self.copy()
+
+        self.assertEqual(self.copy(), (0, 0))
+        self.assertEqual(DICOMInstance.objects.count(), 4)
+        self.assertEqual(File.objects.count(), 1)
+
+        # A changed checksum is a new instance
+        self.checksum_file.write_text("{}  ./mr_0001.dcm\n".format("f" * 32))
+
+        self.assertEqual(self.copy(), (1, 0))
+        self.assertEqual(DICOMInstance.objects.filter(filename="mr_0001.dcm").count(), 2)
@@ -99,3 +99,37 @@ def dicom_json_to_keyword_and_flatten(dicom_json):
                 new_summary[key] = val.get('Value', None)
 
     return OrderedDict(sorted(new_summary.items()))
+
+
+def get_header_delta(series_header, instance_header):
+    """Difference between the DICOM JSON header of an instance and the header of its series: 'set' holds
+    the elements of the instance that differ from (or are missing in) the series header, and 'unset' the
+    tags of the series header missing from the instance. Empty entries are left out."""
+
+    delta = {}
+
+    changed = {tag: elem for tag, elem in instance_header.items() if series_header.get(tag) != elem}
+
+    if changed:
+        delta['set'] = changed
+
+    missing = [tag for tag in series_header if tag not in instance_header]
+
+    if missing:
+        delta['unset'] = missing
+
+    return delta
+
+
+def apply_header_delta(series_header, header_delta):
+    """Reconstructs the full DICOM JSON header of an instance from the header of its series and the delta
+    computed by get_header_delta"""
+
+    unset = set(header_delta.get('unset', []))
+
+    header = {tag: elem for tag, elem in series_header.items() if tag not in unset}
+
+    header.update(header_delta.get('set', {}))
+
+    # Tags are fixed-width hexadecimal strings, so sorting them restores the order of the DICOM dataset
+    return OrderedDict(sorted(header.items()))
@@ -1,6 +1,7 @@
 import os
 import rapidjson as json
 
+from django.db.models import Prefetch
 from django.http import HttpResponse
 from fmrif_archive.models import Exam, MRScan, FileCollection, MRBIDSAnnotation
 from fmrif_archive.serializers import (
@@ -284,10 +285,10 @@ class ExamView(APIView):
 
         if not revision:
             exam = Exam.objects.filter(exam_id=exam_id).order_by('-revision').prefetch_related(
-                'mr_scans', 'other_data').first()
+                Prefetch('mr_scans', queryset=MRScan.objects.defer('instance_order')), 'other_data').first()
         else:
             exam = Exam.objects.filter(exam_id=exam_id, revision=revision).prefetch_related(
-                'mr_scans', 'other_data').first()
+                Prefetch('mr_scans', queryset=MRScan.objects.defer('instance_order')), 'other_data').first()
 
         if not exam:
             raise NotFound
@@ -323,7 +324,7 @@ class MRScanView(APIView):
 
     permission_classes = (HasActiveAccount,)
 
-    def get_object(self, exam_id, scan_name, revision=None):
+    def get_object(self, exam_id, scan_name, revision=None, instance_order=False):
 
         if not revision:
             exam = Exam.objects.filter(exam_id=exam_id).order_by('-revision').first()
@@ -333,8 +334,13 @@ class MRScanView(APIView):
         if not exam:
             raise NotFound
 
-        scan = MRScan.objects.filter(parent_exam=exam,
-                                     name=scan_name).prefetch_related('dicom_files').first()
+        scans = MRScan.objects.filter(parent_exam=exam, name=scan_name).prefetch_related('dicom_files')
+
+        # The instance order lists every file of the scan, so it is only read when requested
+        if not instance_order:
+            scans = scans.defer('instance_order')
+
+        scan = scans.first()
 
         if not scan:
             raise NotFound
@@ -342,9 +348,20 @@ class MRScanView(APIView):
         return scan
 
     def get(self, request, exam_id, scan_name, revision=None):
-        scan = self.get_object(exam_id=exam_id, scan_name=scan_name, revision=revision)
+
+        instance_order = request.query_params.get('instance_order', None) == 'true'
+
+        scan = self.get_object(exam_id=exam_id, scan_name=scan_name, revision=revision,
+                               instance_order=instance_order)
+
         serializer = MRScanSerializer(scan)
-        return Response(serializer.data)
+
+        data = serializer.data
+
+        if instance_order:
+            data['instance_order'] = scan.instance_order
+
+        return Response(data)
 
 
 class FileCollectionView(APIView):